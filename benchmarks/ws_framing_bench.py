@@ -0,0 +1,145 @@
+"""
+So sánh kích thước frame và CPU mã hóa của các định dạng WebSocket
+(JSON chuẩn, orjson, MessagePack), có và không có permessage-deflate.
+
+Chạy từ thư mục gốc của repo:
+    python benchmarks/ws_framing_bench.py [--iterations 20000]
+
+Script nạp trực tiếp src/realtime/codec.py nên không cần cài FastAPI/MongoDB.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import time
+import zlib
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_codec():
+    path = os.path.join(ROOT, "src", "realtime", "codec.py")
+    spec = importlib.util.spec_from_file_location("relo_codec", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+codec = load_codec()
+
+def new_message_event(i: int) -> dict:
+    """Sự kiện new_message điển hình: tin nhắn + hội thoại 3 thành viên."""
+    now = datetime(2025, 1, 1, 12, 0, 0).isoformat()
+    participants = [
+        {
+            "userId": f"65a1f0c2e4b0a1b2c3d4e5f{n}",
+            "displayName": f"Người dùng {n}",
+            "avatarUrl": f"https://res.cloudinary.com/relo/image/upload/v1/avatars/{n}.jpg",
+            "nickname": None,
+            "muteNotifications": False,
+        }
+        for n in range(3)
+    ]
+    return {
+        "type": "new_message",
+        "payload": {
+            "message": {
+                "id": f"65b2c3d4e5f6a7b8c9d0{i:04d}",
+                "senderId": participants[0]["userId"],
+                "conversationId": "65a9b8c7d6e5f4a3b2c1d0e9",
+                "avatarUrl": participants[0]["avatarUrl"],
+                "senderName": participants[0]["displayName"],
+                "content": {"type": "text", "text": f"Chào cả nhóm, tối nay mấy giờ mình gặp nhau? #{i}"},
+                "createdAt": now,
+            },
+            "conversation": {
+                "id": "65a9b8c7d6e5f4a3b2c1d0e9",
+                "participants": participants,
+                "isGroup": True,
+                "name": "Nhóm bạn thân",
+                "avatarUrl": None,
+                "lastMessage": {
+                    "content": {"type": "text", "text": f"Chào cả nhóm, tối nay mấy giờ mình gặp nhau? #{i}"},
+                    "senderId": participants[0]["userId"],
+                    "createdAt": now,
+                },
+                "updatedAt": now,
+                "seenIds": [participants[0]["userId"]],
+                "isDeleted": False,
+            },
+        },
+    }
+
+def new_post_event(i: int) -> dict:
+    """Sự kiện new_post điển hình gửi tới bạn bè."""
+    return {
+        "type": "new_post",
+        "payload": {
+            "authorId": "65a1f0c2e4b0a1b2c3d4e5f0",
+            "authorName": "Nguyễn Văn A",
+            "postId": f"65c3d4e5f6a7b8c9d0e1{i:04d}",
+        },
+    }
+
+def std_json(data) -> bytes:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def codec_json(data) -> bytes:
+    return codec.encode_event(data).encode("utf-8")
+
+def deflate_frame(payload: bytes) -> bytes:
+    """permessage-deflate không giữ ngữ cảnh giữa các frame (no_context_takeover)."""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-4]  # RFC 7692: bỏ 4 byte 00 00 ff ff cuối
+
+def deflate_stream_sizes(payloads) -> int:
+    """permessage-deflate mặc định: giữ ngữ cảnh nén giữa các frame của cùng kết nối."""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    total = 0
+    for payload in payloads:
+        total += len(compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+    return total
+
+def measure(name, encoder, events, iterations):
+    payloads = [encoder(e) for e in events]
+    raw = sum(len(p) for p in payloads) / len(payloads)
+    deflated = sum(len(deflate_frame(p)) for p in payloads) / len(payloads)
+    streamed = deflate_stream_sizes(payloads) / len(payloads)
+
+    n = len(events)
+    start = time.perf_counter()
+    for k in range(iterations):
+        encoder(events[k % n])
+    encode_us = (time.perf_counter() - start) / iterations * 1e6
+
+    start = time.perf_counter()
+    for k in range(iterations):
+        deflate_frame(encoder(events[k % n]))
+    deflate_us = (time.perf_counter() - start) / iterations * 1e6
+
+    print(f"  {name:<10} {raw:>8.0f} {deflated:>10.0f} {streamed:>10.0f} {encode_us:>11.2f} {deflate_us:>13.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    encoders = [("json", std_json)]
+    if codec.orjson is not None:
+        encoders.append(("orjson", codec_json))
+    else:
+        print("orjson chưa được cài, bỏ qua")
+    if codec.msgpack_available():
+        encoders.append(("msgpack", codec.encode_event_msgpack))
+    else:
+        print("msgpack chưa được cài, bỏ qua")
+
+    for label, factory in (("new_message", new_message_event), ("new_post", new_post_event)):
+        events = [factory(i) for i in range(100)]
+        print(f"\n{label} (byte/frame trung bình, µs/sự kiện)")
+        print(f"  {'format':<10} {'raw':>8} {'deflate':>10} {'deflate+ctx':>10} {'encode µs':>11} {'+deflate µs':>13}")
+        for name, encoder in encoders:
+            measure(name, encoder, events, args.iterations)
+
+if __name__ == "__main__":
+    main()
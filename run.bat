@@ -1 +1 @@
-uvicorn src.main:app --host 0.0.0.0 --port 8000 --reload
\ No newline at end of file
+uvicorn src.main:app --host 0.0.0.0 --port 8000 --reload --ws-ping-interval 20 --ws-ping-timeout 20
\ No newline at end of file
@@ -1,10 +1,13 @@
 from fastapi import FastAPI, Request, status
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
-from src.routers import auth_router, user_router, post_router, message_router, notification_router, comment_router
+from src.routers import auth_router, user_router, post_router, message_router, notification_router, comment_router, ops_router
 from src import websocket
 from src.models import init_db
 from src.configs import init_cloudinary
+from src.services.password_hasher import password_hasher
+from src.services.email_service import email_pool
+from src.services.session_service import revoked_sessions
 
 #Khởi tạo kết nối đến Cloudinary
 init_cloudinary()
@@ -40,6 +43,16 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 @app.on_event("startup")
 async def startup_db_client():
     await init_db()
+    await revoked_sessions.start()
+    await websocket.manager.start()
+
+# Giải phóng các worker nền khi tắt ứng dụng
+@app.on_event("shutdown")
+async def shutdown_background_workers():
+    password_hasher.shutdown()
+    await email_pool.stop()
+    await revoked_sessions.stop()
+    await websocket.manager.stop()
 
 # Gắn các router
 app.include_router(auth_router.router, prefix="/api/auth", tags=["Xác thực"])
@@ -49,6 +62,7 @@ app.include_router(message_router.router, prefix="/api/messages", tags=["Tin nh
 app.include_router(notification_router.router, prefix="/api", tags=["Thông báo"])
 app.include_router(comment_router.router, prefix="/api", tags=["Bình luận"])
 app.include_router(websocket.router, prefix="/websocket", tags=["Connect real-time"])
+app.include_router(ops_router.router, prefix="/api/ops", tags=["Vận hành"], include_in_schema=False)
 
 @app.get("/")
 def read_root():
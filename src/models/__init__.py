@@ -1,8 +1,10 @@
-from .user import User
+from .user import User, UserPrincipal, UserFriends, UserSummary
 from .post import Post, AuthorInfo, Reaction, MediaItem
 from .message import Message
-from .conversation import Conversation, ParticipantInfo, LastMessage
+from .conversation import Conversation, ParticipantInfo, LastMessage, ConversationMembers, make_pair_key
 from .friend_request import FriendRequest
 from .notification import Notification
 from .comment import Comment
+from .session import Session, SessionRevocation
+from .inbox import InboxEntry, InboxState, UnreadCounter
 from .database import init_db
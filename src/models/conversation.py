@@ -1,5 +1,6 @@
-from beanie import Document
-from pydantic import Field, BaseModel
+from beanie import Document, PydanticObjectId
+from pydantic import Field, BaseModel, ConfigDict
+from pymongo import IndexModel, ASCENDING, DESCENDING
 from typing import Optional, List
 from datetime import datetime
 
@@ -27,11 +28,36 @@ class Conversation(Document):
     isGroup: bool = Field(default=False, description="Xác định đây có phải là nhóm không.")
     name: Optional[str] = Field(default=None, description="Tên nhóm (nếu là group).")
     avatarUrl: Optional[str] = Field(default=None, description="Ảnh đại diện nhóm (nếu là group).")
+    pairKey: Optional[str] = Field(default=None, description="Khóa của chat 1-1: hai ID người tham gia đã sắp xếp, nối bằng ':' (nhóm: None; chat 1-1 cũ bị trùng: 'duplicate:<id>').")
 
     class Settings:
         name = "conversations"
         indexes = [
-            "participants.userId",
+            # Danh sách hội thoại của user, phân trang theo cursor (updatedAt, _id) giảm dần
+            IndexModel(
+                [("participants.userId", ASCENDING), ("updatedAt", DESCENDING), ("_id", DESCENDING)],
+                name="participant_updated_desc"
+            ),
             "updatedAt",
             "seenIds",
+            # Mỗi cặp người dùng chỉ có một chat 1-1; nhóm (pairKey null) không nằm trong index
+            IndexModel(
+                [("pairKey", ASCENDING)],
+                name="pair_key_unique",
+                unique=True,
+                partialFilterExpression={"pairKey": {"$type": "string"}}
+            ),
         ]
+
+def make_pair_key(user_ids: List[str]) -> str:
+    """Khóa chuẩn của chat 1-1, không phụ thuộc thứ tự người tham gia."""
+    return ":".join(sorted(set(user_ids)))
+
+class ConversationMembers(BaseModel):
+    """
+    Projection của Conversation chỉ gồm danh sách thành viên (dùng cho sự kiện realtime).
+    """
+    model_config = ConfigDict(populate_by_name=True)
+
+    id: PydanticObjectId = Field(..., alias="_id")
+    participants: List[ParticipantInfo] = Field(default_factory=list)
@@ -3,24 +3,163 @@ import os
 from motor.motor_asyncio import AsyncIOMotorClient # Thư viện bất đồng bộ cho MongoDB
 from beanie import init_beanie # ODM (Object-Document Mapper) cho MongoDB
 from dotenv import load_dotenv # Để tải các biến môi trường từ file .env
+from datetime import datetime
 from typing import Type
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 # Nhập các model từ các file khác
-from .user import User
-from .conversation import Conversation
+from .user import User, CASE_INSENSITIVE
+from .conversation import Conversation, make_pair_key
 from .message import Message
 from .post import Post
 from .friend_request import FriendRequest
 from .otp import OTP
 from .notification import Notification
 from .comment import Comment
+from .session import Session
+from .inbox import InboxEntry, InboxState, UnreadCounter
 
 # Danh sách các model Beanie sẽ được khởi tạo
 # Thêm tất cả các model của bạn vào đây
-DOCUMENT_MODELS: list[Type] = [User, Conversation, Message, Post, FriendRequest, OTP, Notification, Comment]
+DOCUMENT_MODELS: list[Type] = [User, Conversation, Message, Post, FriendRequest, OTP, Notification, Comment, Session, InboxEntry, InboxState, UnreadCounter]
 
 client = None  # 🔹 client global, dùng 1 lần suốt vòng đời app
 
+# Đánh dấu migration gán pairKey đã chạy xong (collection 'migrations')
+PAIR_KEY_MIGRATION = "backfill_pair_keys"
+PAIR_KEY_BACKFILL_BATCH_SIZE = 1000
+
+async def drop_outdated_indexes(database):
+    """
+    Xóa các index cũ trùng tên nhưng khác tùy chọn với định nghĩa hiện tại trong model,
+    để Beanie có thể tạo lại chúng.
+    """
+    # OTP.expires_at: index thường được thay bằng TTL index (cùng tên expires_at_1)
+    otp_indexes = await database["otps"].index_information()
+    legacy_index = otp_indexes.get("expires_at_1")
+    if legacy_index and "expireAfterSeconds" not in legacy_index:
+        await database["otps"].drop_index("expires_at_1")
+
+async def check_user_duplicates(database):
+    """
+    Kiểm tra trước khi tạo index duy nhất không phân biệt hoa thường trên users.username/email.
+    Nếu dữ liệu cũ có các tài khoản chỉ khác nhau về hoa thường, dừng khởi động với thông báo rõ ràng
+    (cần gộp hoặc đổi tên các tài khoản này thủ công) thay vì để init_beanie lỗi khi tạo index.
+    """
+    users = database["users"]
+    existing = await users.index_information()
+    conflicts = []
+    for field in ("username", "email"):
+        if f"{field}_unique_ci" in existing:
+            continue
+        cursor = users.aggregate(
+            [
+                {"$group": {"_id": f"${field}", "count": {"$sum": 1}, "ids": {"$push": "$_id"}}},
+                {"$match": {"count": {"$gt": 1}}},
+                {"$limit": 20},
+            ],
+            collation=CASE_INSENSITIVE.document
+        )
+        async for group in cursor:
+            conflicts.append(f"{field}={group['_id']!r}: {', '.join(str(i) for i in group['ids'])}")
+
+    if conflicts:
+        raise RuntimeError(
+            "Không thể tạo index duy nhất cho users: có tài khoản trùng username/email (không phân biệt hoa thường). "
+            "Hãy xử lý các bản ghi sau rồi khởi động lại:\n" + "\n".join(conflicts)
+        )
+
+async def drop_redundant_indexes(database):
+    """
+    Xóa các index đã được index kép thay thế.
+    Chạy sau init_beanie để index mới đã sẵn sàng trước khi bỏ index cũ.
+    """
+    # User.username/email: index thường được thay bằng index duy nhất không phân biệt hoa thường
+    user_indexes = await database["users"].index_information()
+    for name in ("username_1", "email_1"):
+        if name in user_indexes:
+            await database["users"].drop_index(name)
+
+    # Message.conversationId: là tiền tố của index kép conversation_created_desc nên thừa
+    message_indexes = await database["messages"].index_information()
+    if "conversationId_1" in message_indexes:
+        await database["messages"].drop_index("conversationId_1")
+
+    # Conversation.participants.userId: là tiền tố của index kép participant_updated_desc
+    conversation_indexes = await database["conversations"].index_information()
+    if "participants.userId_1" in conversation_indexes:
+        await database["conversations"].drop_index("participants.userId_1")
+
+async def backfill_pair_keys(database):
+    """
+    Gán pairKey cho các chat 1-1 tạo trước khi có trường này (chạy một lần, đánh dấu trong 'migrations').
+    Duyệt bằng cursor theo từng lô, chat cũ nhất của mỗi cặp được gán khóa (index duy nhất);
+    các bản trùng được gán khóa riêng "duplicate:<id>" để không bị quét lại và không được tìm thấy khi tạo chat mới.
+    """
+    migrations = database["migrations"]
+    if await migrations.find_one({"_id": PAIR_KEY_MIGRATION}):
+        return
+
+    conversations = database["conversations"]
+    cursor = conversations.find(
+        {"isGroup": False, "pairKey": None},
+        projection={"participants.userId": 1, "createdAt": 1}
+    ).sort([("createdAt", 1), ("_id", 1)]).batch_size(PAIR_KEY_BACKFILL_BATCH_SIZE)
+
+    assigned = duplicates = 0
+    batch = []
+    async for convo in cursor:
+        batch.append(convo)
+        if len(batch) >= PAIR_KEY_BACKFILL_BATCH_SIZE:
+            a, d = await _backfill_pair_key_batch(conversations, batch)
+            assigned, duplicates, batch = assigned + a, duplicates + d, []
+    if batch:
+        a, d = await _backfill_pair_key_batch(conversations, batch)
+        assigned, duplicates = assigned + a, duplicates + d
+
+    await migrations.update_one(
+        {"_id": PAIR_KEY_MIGRATION},
+        {"$set": {"completedAt": datetime.utcnow(), "assigned": assigned, "duplicates": duplicates}},
+        upsert=True
+    )
+    if assigned or duplicates:
+        print(f"Đã gán pairKey cho {assigned} cuộc trò chuyện 1-1 ({duplicates} bản trùng)")
+
+async def _backfill_pair_key_batch(conversations, batch) -> tuple:
+    """Gán pairKey cho một lô (đã sắp xếp từ cũ đến mới). Trả về (số chat được gán khóa, số bản trùng)."""
+    candidates = {}
+    duplicate_ids = []
+    for convo in batch:
+        user_ids = {p.get("userId") for p in convo.get("participants", []) if p.get("userId")}
+        if len(user_ids) != 2:
+            continue
+        pair_key = make_pair_key(list(user_ids))
+        if pair_key in candidates:
+            duplicate_ids.append(convo["_id"])
+        else:
+            candidates[pair_key] = convo["_id"]
+
+    taken = set(await conversations.distinct("pairKey", {"pairKey": {"$in": list(candidates)}})) if candidates else set()
+    operations = []
+    for pair_key, convo_id in candidates.items():
+        if pair_key in taken:
+            duplicate_ids.append(convo_id)
+        else:
+            operations.append(UpdateOne({"_id": convo_id, "pairKey": None}, {"$set": {"pairKey": pair_key}}))
+    operations.extend(
+        UpdateOne({"_id": convo_id, "pairKey": None}, {"$set": {"pairKey": f"duplicate:{convo_id}"}})
+        for convo_id in duplicate_ids
+    )
+    if operations:
+        try:
+            await conversations.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Instance khác đang chạy cùng lúc đã gán khóa cho cặp này: bỏ qua lỗi trùng khóa
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+    return len(operations) - len(duplicate_ids), len(duplicate_ids)
+
 async def init_db():
     """
     Khởi tạo kết nối cơ sở dữ liệu và Beanie ODM.
@@ -41,7 +180,11 @@ async def init_db():
     client = AsyncIOMotorClient(mongo_uri)
     database = client.get_database("relo-social-network")
 
+    await drop_outdated_indexes(database)
+    await check_user_duplicates(database)
     await init_beanie(database=database, document_models=DOCUMENT_MODELS)
+    await drop_redundant_indexes(database)
+    await backfill_pair_keys(database)
 
     return client
 
@@ -0,0 +1,65 @@
+from beanie import Document
+from pydantic import Field
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from datetime import datetime
+from typing import Optional
+from .conversation import LastMessage
+
+class InboxEntry(Document):
+    """
+    Một dòng trong hộp thư của người dùng (collection 'inbox_entries').
+    Bản sao phi chuẩn hóa của Conversation theo từng người tham gia,
+    được cập nhật khi có tin nhắn / thay đổi nhóm để đọc hộp thư bằng một lần quét index.
+    """
+    userId: str = Field(..., description="ID của người sở hữu hộp thư.")
+    conversationId: str = Field(..., description="ID của cuộc trò chuyện.")
+    isGroup: bool = Field(default=False, description="Cuộc trò chuyện là nhóm.")
+    name: Optional[str] = Field(default=None, description="Tên nhóm, hoặc tên người còn lại trong chat 1-1.")
+    avatarUrl: Optional[str] = Field(default=None, description="Ảnh nhóm, hoặc ảnh của người còn lại trong chat 1-1.")
+    peerId: Optional[str] = Field(default=None, description="ID người còn lại trong chat 1-1.")
+    lastMessage: Optional[LastMessage] = Field(default=None, description="Tin nhắn cuối cùng để xem trước.")
+    updatedAt: datetime = Field(default_factory=datetime.utcnow, description="Thời điểm có tin nhắn mới.")
+    unreadCount: int = Field(default=0, description="Số tin nhắn chưa đọc.")
+    muted: bool = Field(default=False, description="Người dùng đã tắt thông báo cuộc trò chuyện.")
+    hidden: bool = Field(default=False, description="Người dùng đã xóa cuộc trò chuyện và chưa có tin nhắn mới.")
+
+    class Settings:
+        name = "inbox_entries"
+        indexes = [
+            IndexModel([("userId", ASCENDING), ("conversationId", ASCENDING)], name="user_conversation_unique", unique=True),
+            # Đọc hộp thư: lọc theo user, bỏ mục đã ẩn, sắp xếp theo (updatedAt, conversationId) giảm dần
+            IndexModel(
+                [("userId", ASCENDING), ("hidden", ASCENDING), ("updatedAt", DESCENDING), ("conversationId", DESCENDING)],
+                name="user_inbox_desc"
+            ),
+            "conversationId",
+            "peerId",
+        ]
+
+class InboxState(Document):
+    """
+    Đánh dấu hộp thư của người dùng đã được dựng từ dữ liệu Conversation (collection 'inbox_states').
+    User chưa có bản ghi này sẽ được dựng lại hộp thư ở lần đọc đầu tiên.
+    """
+    userId: str = Field(..., description="ID của người dùng.")
+    builtAt: datetime = Field(default_factory=datetime.utcnow, description="Thời điểm dựng hộp thư.")
+
+    class Settings:
+        name = "inbox_states"
+        indexes = [
+            IndexModel([("userId", ASCENDING)], name="user_unique", unique=True),
+        ]
+
+class UnreadCounter(Document):
+    """
+    Tổng số tin nhắn chưa đọc của người dùng trên mọi hội thoại (collection 'unread_counters'),
+    dùng làm badge của ứng dụng mà không cần quét tin nhắn.
+    """
+    userId: str = Field(..., description="ID của người dùng.")
+    total: int = Field(default=0, description="Tổng số tin nhắn chưa đọc.")
+
+    class Settings:
+        name = "unread_counters"
+        indexes = [
+            IndexModel([("userId", ASCENDING)], name="user_unique", unique=True),
+        ]
@@ -1,5 +1,6 @@
 from beanie import Document
 from pydantic import Field
+from pymongo import IndexModel, ASCENDING, DESCENDING
 from typing import Dict
 from datetime import datetime
 
@@ -15,6 +16,10 @@ class Message(Document):
     class Settings:
         name = "messages"
         indexes = [
-            "conversationId",
+            # Phân trang theo cursor: lọc theo hội thoại, sắp xếp theo (createdAt, _id) giảm dần
+            IndexModel(
+                [("conversationId", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)],
+                name="conversation_created_desc"
+            ),
             "createdAt",
         ]
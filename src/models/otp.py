@@ -1,5 +1,6 @@
 from beanie import Document
 from pydantic import Field
+from pymongo import IndexModel, ASCENDING
 from datetime import datetime, timedelta
 from typing import Optional
 
@@ -7,16 +8,18 @@ class OTP(Document):
     """
     Đại diện cho mã OTP trong collection 'otps'.
     """
-    email: str = Field(..., description="Email của người dùng.")
-    otp_code: str = Field(..., description="Mã OTP đã được hash.")
+    email: str = Field(..., description="Email của người dùng (chữ thường).")
+    otp_code: str = Field(..., description="Mã OTP đã được hash (HMAC-SHA256).")
     expires_at: datetime = Field(..., description="Thời gian hết hạn của OTP.")
     is_used: bool = Field(default=False, description="Trạng thái đã sử dụng OTP.")
+    attempts: int = Field(default=0, description="Số lần nhập mã đã thử.")
     created_at: datetime = Field(default_factory=datetime.utcnow, description="Thời điểm tạo OTP.")
     
     class Settings:
         name = "otps"
         indexes = [
             "email",
-            "expires_at",
+            # TTL index: MongoDB tự xóa OTP ngay khi qua thời điểm expires_at
+            IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
         ]
 
@@ -0,0 +1,38 @@
+from beanie import Document, PydanticObjectId
+from pydantic import Field, BaseModel, ConfigDict
+from pymongo import IndexModel, ASCENDING
+from datetime import datetime
+from typing import Optional
+
+class Session(Document):
+    """
+    Đại diện cho một phiên đăng nhập (một thiết bị / một họ refresh token) trong collection 'sessions'.
+    """
+    userId: str = Field(..., description="ID của người dùng sở hữu phiên.")
+    currentJti: str = Field(..., description="jti của refresh token hợp lệ hiện tại trong họ token.")
+    deviceToken: Optional[str] = Field(default=None, description="Device token FCM của thiết bị (nếu có).")
+    createdAt: datetime = Field(default_factory=datetime.utcnow, description="Thời điểm tạo phiên.")
+    lastUsedAt: datetime = Field(default_factory=datetime.utcnow, description="Lần refresh gần nhất.")
+    expiresAt: datetime = Field(..., description="Thời điểm refresh token của phiên hết hạn.")
+    revoked: bool = Field(default=False, description="Phiên đã bị thu hồi.")
+    revokedAt: Optional[datetime] = Field(default=None, description="Thời điểm thu hồi phiên.")
+
+    class Settings:
+        name = "sessions"
+        indexes = [
+            "userId",
+            "deviceToken",
+            "revokedAt",
+            # TTL index: MongoDB tự xóa phiên khi refresh token đã hết hạn
+            IndexModel([("expiresAt", ASCENDING)], expireAfterSeconds=0),
+        ]
+
+class SessionRevocation(BaseModel):
+    """
+    Projection gọn của Session, chỉ dùng để đồng bộ danh sách phiên bị thu hồi.
+    """
+    model_config = ConfigDict(populate_by_name=True)
+
+    id: PydanticObjectId = Field(..., alias="_id")
+    revokedAt: Optional[datetime] = None
+    expiresAt: datetime
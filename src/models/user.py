@@ -1,8 +1,13 @@
-from beanie import Document
-from pydantic import Field, EmailStr
+from beanie import Document, PydanticObjectId, after_event, Insert, Replace, Save, SaveChanges, Update, Delete
+from pydantic import Field, EmailStr, BaseModel, ConfigDict
+from pymongo import IndexModel, ASCENDING
+from pymongo.collation import Collation
 from typing import Optional, List
 from datetime import datetime
 
+# Collation so sánh không phân biệt hoa thường (strength=2)
+CASE_INSENSITIVE = Collation(locale="en", strength=2)
+
 class User(Document):
     """
     Đại diện cho một người dùng trong collection 'users'.
@@ -25,11 +30,62 @@ class User(Document):
     status: Optional[str] = Field(default=None, description="Trạng thái tài khoản: None (mặc định), 'available', 'deleted'.")
     createdAt: datetime = Field(default_factory=datetime.utcnow, description="Thời điểm người dùng được tạo.")
     updatedAt: datetime = Field(default_factory=datetime.utcnow, description="Thời điểm thông tin người dùng được cập nhật lần cuối.")
+
+    @after_event(Insert, Replace, Save, SaveChanges, Update, Delete)
+    def invalidate_principal_cache(self):
+        """Xóa principal đã cache của user (trên mọi worker/node) mỗi khi document bị thay đổi."""
+        # Import tại chỗ để tránh vòng lặp import (websocket -> security -> models)
+        from ..websocket import manager
+        manager.invalidate("principal", str(self.id))
+
+    @after_event(Insert, Replace, Save, SaveChanges, Update, Delete)
+    def invalidate_friend_cache(self):
+        """Xóa danh sách bạn bè đã cache cho presence (trên mọi worker/node) khi document bị thay đổi."""
+        from ..websocket import manager
+        manager.invalidate("friends", str(self.id))
     
     class Settings:
         name = "users"
         # Thêm các chỉ mục để tối ưu hóa truy vấn
         indexes = [
-            "username",
-            "email",
+            # Index duy nhất, không phân biệt hoa thường: chặn đăng ký trùng ngay tại DB
+            IndexModel([("username", ASCENDING)], name="username_unique_ci", unique=True, collation=CASE_INSENSITIVE),
+            IndexModel([("email", ASCENDING)], name="email_unique_ci", unique=True, collation=CASE_INSENSITIVE),
         ]
+        # Truy vấn theo username/email phải dùng collation này để khớp (và dùng được) các index trên
+
+class UserPrincipal(BaseModel):
+    """
+    Projection gọn của User dùng cho xác thực.
+    Không chứa mật khẩu, danh sách bạn bè, danh sách chặn hay device tokens.
+    """
+    model_config = ConfigDict(populate_by_name=True)
+
+    id: PydanticObjectId = Field(..., alias="_id")
+    status: Optional[str] = None
+    displayName: str
+    avatarUrl: Optional[str] = None
+
+class UserFriends(BaseModel):
+    """
+    Projection của User chỉ gồm danh sách bạn bè (dùng cho presence).
+    """
+    model_config = ConfigDict(populate_by_name=True)
+
+    id: PydanticObjectId = Field(..., alias="_id")
+    friendIds: List[str] = Field(default_factory=list)
+
+class UserSummary(BaseModel):
+    """
+    Projection của User gồm các trường hiển thị công khai (dùng khi dựng danh sách hội thoại).
+    """
+    model_config = ConfigDict(populate_by_name=True)
+
+    id: PydanticObjectId = Field(..., alias="_id")
+    username: str
+    email: str
+    displayName: str
+    avatarUrl: Optional[str] = None
+    backgroundUrl: Optional[str] = None
+    bio: Optional[str] = None
+    status: Optional[str] = None
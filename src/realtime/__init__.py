@@ -0,0 +1,12 @@
+from .backplane import Backplane, InMemoryBackplane, InMemoryHub, RedisBackplane, create_backplane
+from .codec import (
+    EncodedEvent, SequencedEvent, encode_event, decode_event, decode_event_msgpack, msgpack_available,
+    JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL
+)
+from .connection import Connection
+from .heartbeat import HeartbeatMonitor
+from .replay import ReplayBuffer, is_replayable
+from .fanout import FanoutScheduler, LANE_CHAT, LANE_SOCIAL
+from .commands import CommandQueue, dispatch_command, COMMAND_HANDLERS
+from .presence import PresenceTracker, get_friend_ids, invalidate_friends
+from .activity import ActivityChannel, invalidate_membership, membership_cache, MEMBERSHIP_CACHE_DISTRIBUTED_TTL_SECONDS
@@ -0,0 +1,156 @@
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+from ..utils.ttl_cache import TTLCache
+
+load_dotenv()
+
+# Mỗi (cuộc trò chuyện, người gửi, loại) gửi tối đa một sự kiện trong khoảng này
+ACTIVITY_COALESCE_SECONDS = float(os.getenv("ACTIVITY_COALESCE_MS", 1000)) / 1000
+# Không được làm mới trong khoảng này thì tự phát sự kiện dừng
+ACTIVITY_EXPIRE_SECONDS = float(os.getenv("ACTIVITY_EXPIRE_MS", 6000)) / 1000
+# Cache danh sách thành viên cuộc trò chuyện
+MEMBERSHIP_CACHE_TTL_SECONDS = int(os.getenv("MEMBERSHIP_CACHE_TTL_SECONDS", 300))
+MEMBERSHIP_CACHE_MAX_SIZE = int(os.getenv("MEMBERSHIP_CACHE_MAX_SIZE", 50000))
+# TTL khi chạy nhiều node: giới hạn thời gian dùng danh sách cũ nếu thông điệp xóa cache qua backplane bị mất
+MEMBERSHIP_CACHE_DISTRIBUTED_TTL_SECONDS = int(os.getenv("MEMBERSHIP_CACHE_DISTRIBUTED_TTL_SECONDS", 30))
+
+# Các loại hoạt động tạm thời được hỗ trợ
+ACTIVITY_KINDS = ("typing", "recording")
+
+membership_cache = TTLCache(maxsize=MEMBERSHIP_CACHE_MAX_SIZE, ttl=MEMBERSHIP_CACHE_TTL_SECONDS)
+
+def invalidate_membership(conversation_id: str):
+    """
+    Xóa danh sách thành viên đã cache tại process này.
+    Service gọi ConnectionManager.invalidate_membership để xóa trên mọi node.
+    """
+    membership_cache.invalidate(str(conversation_id))
+
+async def get_participant_ids(conversation_id: str) -> Optional[Tuple[str, ...]]:
+    """Lấy ID thành viên của cuộc trò chuyện từ cache, nếu chưa có thì đọc projection từ DB."""
+    from bson import ObjectId
+    from ..models.conversation import Conversation, ConversationMembers
+
+    participant_ids = membership_cache.get(conversation_id)
+    if participant_ids is not None:
+        return participant_ids
+    if not ObjectId.is_valid(conversation_id):
+        return None
+
+    conversation = await Conversation.find_one(
+        Conversation.id == ObjectId(conversation_id)
+    ).project(ConversationMembers)
+    if conversation is None:
+        return None
+
+    participant_ids = tuple(p.userId for p in conversation.participants)
+    membership_cache.set(conversation_id, participant_ids)
+    return participant_ids
+
+ActivityKey = Tuple[str, str, str]  # (conversation_id, user_id, kind)
+
+class ActivityChannel:
+    """
+    Kênh sự kiện tạm thời (đang nhập, đang ghi âm) giữa các thành viên cuộc trò chuyện.
+    Không ghi MongoDB, không lưu lại để phát lại; mỗi người gửi chỉ phát tối đa một sự kiện
+    trong mỗi khoảng coalesce và tự phát sự kiện dừng khi hết hạn.
+    """
+
+    def __init__(
+        self,
+        is_reachable: Callable[[str], bool],
+        broadcast: Callable[[Iterable[str], dict], Awaitable[None]],
+        window: float = ACTIVITY_COALESCE_SECONDS,
+        expire: float = ACTIVITY_EXPIRE_SECONDS
+    ):
+        self.is_reachable = is_reachable
+        self.broadcast = broadcast
+        self.window = window
+        self.expire = expire
+        self._last_sent: Dict[ActivityKey, float] = {}  # Chỉ chứa các hoạt động đang diễn ra
+        self._expiry: Dict[ActivityKey, asyncio.TimerHandle] = {}
+
+        # Metrics
+        self.sent = 0
+        self.coalesced = 0
+        self.expired = 0
+
+    async def publish(self, conversation_id: str, user_id: str, kind: str, active: bool):
+        """
+        Phát trạng thái hoạt động của user trong cuộc trò chuyện.
+
+        Raises:
+            ValueError: Nếu loại hoạt động không được hỗ trợ
+            PermissionError: Nếu user không thuộc cuộc trò chuyện
+        """
+        if kind not in ACTIVITY_KINDS:
+            raise ValueError(f"Loại hoạt động không được hỗ trợ: {kind}")
+
+        participant_ids = await get_participant_ids(conversation_id)
+        if not participant_ids or user_id not in participant_ids:
+            raise PermissionError("Bạn không được phép xem cuộc trò chuyện này.")
+
+        key = (conversation_id, user_id, kind)
+        now = time.monotonic()
+        if active:
+            self._schedule_expiry(key)
+            last_sent = self._last_sent.get(key)
+            if last_sent is not None and now - last_sent < self.window:
+                self.coalesced += 1
+                return
+            self._last_sent[key] = now
+        else:
+            self._cancel_expiry(key)
+            if self._last_sent.pop(key, None) is None:
+                # Chưa từng báo bắt đầu (hoặc đã dừng): không cần báo dừng
+                return
+
+        await self._send(key, active, participant_ids)
+
+    def _schedule_expiry(self, key: ActivityKey):
+        self._cancel_expiry(key)
+        loop = asyncio.get_running_loop()
+        self._expiry[key] = loop.call_later(self.expire, self._on_expired, key)
+
+    def _cancel_expiry(self, key: ActivityKey):
+        handle = self._expiry.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+
+    def _on_expired(self, key: ActivityKey):
+        self._expiry.pop(key, None)
+        if self._last_sent.pop(key, None) is None:
+            return
+        self.expired += 1
+        participant_ids = membership_cache.get(key[0])
+        if participant_ids:
+            asyncio.create_task(self._send(key, False, participant_ids))
+
+    async def _send(self, key: ActivityKey, active: bool, participant_ids: Iterable[str]):
+        conversation_id, user_id, kind = key
+        recipients = [uid for uid in participant_ids if uid != user_id and self.is_reachable(uid)]
+        if not recipients:
+            return
+        await self.broadcast(recipients, {
+            "type": "activity",
+            "payload": {
+                "conversationId": conversation_id,
+                "userId": user_id,
+                "kind": kind,
+                "active": active,
+                "expiresInMs": int(self.expire * 1000) if active else 0
+            }
+        })
+        self.sent += 1
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self._last_sent),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "expired": self.expired,
+            "membershipCache": membership_cache.stats(),
+        }
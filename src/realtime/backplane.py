@@ -0,0 +1,276 @@
+import asyncio
+import os
+import socket
+import uuid
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Backplane pub/sub giữa các worker/node: "none" (một process), "memory" (test), "redis"
+REALTIME_BACKPLANE = os.getenv("REALTIME_BACKPLANE", "none").lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REALTIME_CHANNEL_PREFIX = os.getenv("REALTIME_CHANNEL_PREFIX", "relo:ws")
+
+# Hàm giao sự kiện (chuỗi JSON đã mã hóa) tới các socket cục bộ của user: deliver(user_id, text)
+DeliverCallback = Callable[[str, str], Awaitable[None]]
+# Hàm xử lý thông điệp điều khiển (vd: xóa cache) từ node khác: handler(key)
+ControlHandler = Callable[[str], None]
+
+def new_node_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+class Backplane:
+    """
+    Kênh pub/sub giữa các node realtime, mỗi user một kênh.
+    Node chỉ đăng ký kênh của những user đang có socket tại node đó, nên sự kiện
+    publish một lần cho mỗi user chỉ được giao ở các node đang giữ socket của user.
+
+    Bản thân lớp này là backplane rỗng cho trường hợp chạy một process.
+    """
+
+    # True nếu user có thể đang kết nối ở node khác
+    distributed = False
+
+    def __init__(self, node_id: Optional[str] = None):
+        self.node_id = node_id or new_node_id()
+        self._deliver: Optional[DeliverCallback] = None
+        self._subscribed: Set[str] = set()
+        self._control_handlers: Dict[str, ControlHandler] = {}
+
+        # Metrics
+        self.published = 0
+        self.received = 0
+        self.controls_received = 0
+
+    async def start(self, deliver: DeliverCallback):
+        self._deliver = deliver
+
+    async def stop(self):
+        self._subscribed.clear()
+
+    async def subscribe(self, user_id: str):
+        """Đăng ký kênh của user (gọi khi user có socket đầu tiên tại node này)."""
+        self._subscribed.add(user_id)
+
+    async def unsubscribe(self, user_id: str):
+        """Hủy kênh của user (gọi khi socket cuối cùng của user tại node này đóng)."""
+        self._subscribed.discard(user_id)
+
+    async def publish(self, user_id: str, text: str):
+        """Gửi sự kiện (chuỗi JSON đã mã hóa) tới các node khác đang giữ socket của user."""
+
+    async def publish_many(self, user_ids: Iterable[str], text: str):
+        """Gửi cùng một sự kiện tới nhiều user."""
+        for user_id in user_ids:
+            await self.publish(user_id, text)
+
+    def on_control(self, kind: str, handler: ControlHandler):
+        """Đăng ký hàm xử lý cho một loại thông điệp điều khiển."""
+        self._control_handlers[kind] = handler
+
+    async def publish_control(self, kind: str, key: str):
+        """
+        Gửi thông điệp điều khiển (vd: xóa cache theo key) tới mọi node khác.
+        Node gửi tự xử lý cục bộ, không nhận lại bản sao của chính mình.
+        """
+
+    def _receive_control(self, origin: str, kind: str, key: str):
+        handler = self._control_handlers.get(kind)
+        if origin == self.node_id or handler is None:
+            return
+        self.controls_received += 1
+        handler(key)
+
+    async def _receive(self, origin: str, user_id: str, text: str):
+        # Node gốc đã tự giao cục bộ, bỏ qua bản sao của chính mình
+        if origin == self.node_id or self._deliver is None or user_id not in self._subscribed:
+            return
+        self.received += 1
+        await self._deliver(user_id, text)
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self).__name__,
+            "nodeId": self.node_id,
+            "subscribedUsers": len(self._subscribed),
+            "published": self.published,
+            "received": self.received,
+            "controlsReceived": self.controls_received,
+        }
+
+class InMemoryHub:
+    """Bộ định tuyến dùng chung cho nhiều InMemoryBackplane trong cùng process (dùng cho test)."""
+
+    def __init__(self):
+        self.channels: Dict[str, Set["InMemoryBackplane"]] = {}
+        self.nodes: Set["InMemoryBackplane"] = set()
+
+class InMemoryBackplane(Backplane):
+    """
+    Backplane trong bộ nhớ: nhiều ConnectionManager trong cùng process dùng chung một hub
+    để mô phỏng nhiều node.
+    """
+
+    default_hub = InMemoryHub()
+    distributed = True
+
+    def __init__(self, hub: Optional[InMemoryHub] = None, node_id: Optional[str] = None):
+        super().__init__(node_id)
+        self.hub = hub or InMemoryBackplane.default_hub
+
+    async def start(self, deliver: DeliverCallback):
+        await super().start(deliver)
+        self.hub.nodes.add(self)
+
+    async def stop(self):
+        self.hub.nodes.discard(self)
+        for user_id in list(self._subscribed):
+            await self.unsubscribe(user_id)
+
+    async def subscribe(self, user_id: str):
+        await super().subscribe(user_id)
+        self.hub.channels.setdefault(user_id, set()).add(self)
+
+    async def unsubscribe(self, user_id: str):
+        await super().unsubscribe(user_id)
+        nodes = self.hub.channels.get(user_id)
+        if nodes is not None:
+            nodes.discard(self)
+            if not nodes:
+                del self.hub.channels[user_id]
+
+    async def publish(self, user_id: str, text: str):
+        self.published += 1
+        for node in list(self.hub.channels.get(user_id, ())):
+            if node is not self:
+                await node._receive(self.node_id, user_id, text)
+
+    async def publish_control(self, kind: str, key: str):
+        for node in list(self.hub.nodes):
+            if node is not self:
+                node._receive_control(self.node_id, kind, key)
+
+class RedisBackplane(Backplane):
+    """
+    Backplane dùng Redis Pub/Sub (hoặc server tương thích giao thức Redis).
+    Cần cài thư viện `redis` (redis.asyncio).
+    """
+
+    distributed = True
+
+    def __init__(self, url: str = REDIS_URL, prefix: str = REALTIME_CHANNEL_PREFIX, node_id: Optional[str] = None):
+        super().__init__(node_id)
+        self.url = url
+        self.prefix = prefix
+        self._redis = None
+        self._pubsub = None
+        self._reader: Optional[asyncio.Task] = None
+
+    def _channel(self, user_id: str) -> str:
+        return f"{self.prefix}:user:{user_id}"
+
+    @property
+    def _control_channel(self) -> str:
+        return f"{self.prefix}:control"
+
+    async def start(self, deliver: DeliverCallback):
+        import redis.asyncio as redis
+
+        await super().start(deliver)
+        self._redis = redis.from_url(self.url)
+        self._pubsub = self._redis.pubsub()
+        # Kênh riêng của node giữ kết nối pub/sub luôn mở, kể cả khi chưa có user nào
+        await self._pubsub.subscribe(f"{self.prefix}:node:{self.node_id}", self._control_channel)
+        self._reader = asyncio.create_task(self._read_loop())
+
+    async def stop(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            await asyncio.gather(self._reader, return_exceptions=True)
+            self._reader = None
+        if self._pubsub is not None:
+            await self._pubsub.close()
+            self._pubsub = None
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+        await super().stop()
+
+    async def subscribe(self, user_id: str):
+        if user_id in self._subscribed:
+            return
+        await super().subscribe(user_id)
+        if self._pubsub is not None:
+            await self._pubsub.subscribe(self._channel(user_id))
+
+    async def unsubscribe(self, user_id: str):
+        if user_id not in self._subscribed:
+            return
+        await super().unsubscribe(user_id)
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe(self._channel(user_id))
+
+    def _envelope(self, text: str) -> str:
+        # "<node_id>\n<json>": không cần mã hóa lại payload đã là JSON
+        return f"{self.node_id}\n{text}"
+
+    async def publish(self, user_id: str, text: str):
+        if self._redis is None:
+            return
+        await self._redis.publish(self._channel(user_id), self._envelope(text))
+        self.published += 1
+
+    async def publish_many(self, user_ids: Iterable[str], text: str):
+        if self._redis is None:
+            return
+        # Gửi tất cả lệnh PUBLISH trong một round trip
+        envelope = self._envelope(text)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            count = 0
+            for user_id in user_ids:
+                pipe.publish(self._channel(user_id), envelope)
+                count += 1
+            if count:
+                await pipe.execute()
+        self.published += count
+
+    async def publish_control(self, kind: str, key: str):
+        if self._redis is None:
+            return
+        await self._redis.publish(self._control_channel, f"{self.node_id}\n{kind}\n{key}")
+
+    async def _read_loop(self):
+        user_prefix = f"{self.prefix}:user:"
+        while True:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None:
+                    continue
+                channel = message["channel"]
+                if isinstance(channel, bytes):
+                    channel = channel.decode("utf-8")
+                data = message["data"]
+                if isinstance(data, bytes):
+                    data = data.decode("utf-8")
+                if channel == self._control_channel:
+                    origin, kind, key = data.split("\n", 2)
+                    self._receive_control(origin, kind, key)
+                    continue
+                if not channel.startswith(user_prefix):
+                    continue
+                origin, _, text = data.partition("\n")
+                await self._receive(origin, channel[len(user_prefix):], text)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Lỗi khi đọc sự kiện từ Redis backplane: {e}")
+                await asyncio.sleep(1)
+
+def create_backplane() -> Backplane:
+    """Tạo backplane theo biến môi trường REALTIME_BACKPLANE."""
+    if REALTIME_BACKPLANE == "redis":
+        return RedisBackplane()
+    if REALTIME_BACKPLANE == "memory":
+        return InMemoryBackplane()
+    return Backplane()
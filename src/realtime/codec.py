@@ -0,0 +1,113 @@
+import json
+from datetime import datetime
+from typing import Any, Optional
+
+try:
+    import orjson  # Tùy chọn: encoder JSON nhanh hơn json chuẩn nhiều lần
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack  # Tùy chọn: subprotocol nhị phân MessagePack
+except ImportError:
+    msgpack = None
+
+# Subprotocol WebSocket (Sec-WebSocket-Protocol) mà client có thể yêu cầu
+JSON_SUBPROTOCOL = "relo.json.v1"
+MSGPACK_SUBPROTOCOL = "relo.msgpack.v1"
+
+def _default(obj: Any) -> Any:
+    """Chuyển đổi các kiểu không có sẵn trong JSON (datetime -> ISO string)."""
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def encode_event(data: Any) -> str:
+    """
+    Mã hóa một sự kiện WebSocket thành chuỗi JSON (dùng orjson nếu đã cài).
+    Định dạng giống send_json của Starlette: không khoảng trắng, giữ nguyên Unicode.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(data, default=_default, ensure_ascii=False, separators=(",", ":"))
+
+def decode_event(text: str) -> Any:
+    """Giải mã chuỗi JSON nhận được từ client hoặc backplane."""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+def msgpack_available() -> bool:
+    return msgpack is not None
+
+def encode_event_msgpack(data: Any) -> bytes:
+    """Mã hóa sự kiện bằng MessagePack (datetime -> ISO string giống JSON)."""
+    return msgpack.packb(data, default=_default, use_bin_type=True)
+
+def decode_event_msgpack(payload: bytes) -> Any:
+    """Giải mã frame nhị phân MessagePack nhận được từ client."""
+    return msgpack.unpackb(payload, raw=False)
+
+class EncodedEvent:
+    """
+    Một sự kiện được mã hóa tối đa một lần cho mỗi định dạng, dùng chung cho mọi kết nối.
+    Có thể tạo từ dữ liệu gốc hoặc từ chuỗi JSON đã mã hóa (nhận qua backplane).
+    """
+
+    __slots__ = ("_data", "_text", "_binary")
+
+    def __init__(self, data: Any = None, text: Optional[str] = None):
+        self._data = data
+        self._text = text
+        self._binary: Optional[bytes] = None
+
+    @property
+    def data(self) -> Any:
+        if self._data is None and self._text is not None:
+            self._data = decode_event(self._text)
+        return self._data
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = encode_event(self._data)
+        return self._text
+
+    @property
+    def binary(self) -> bytes:
+        if self._binary is None:
+            self._binary = encode_event_msgpack(self.data)
+        return self._binary
+
+class SequencedEvent(EncodedEvent):
+    """
+    Sự kiện gắn số thứ tự riêng của một người nhận ("seq" là khóa đầu tiên).
+    Ghép seq vào dữ liệu đã mã hóa của sự kiện gốc nên phần payload dùng chung
+    không phải mã hóa lại cho từng người nhận.
+    Frame được dựng mỗi lần đọc và không được cache: đối tượng này chỉ sống trong hàng đợi gửi,
+    bộ đệm phát lại chỉ giữ (seq, sự kiện gốc) dùng chung.
+    """
+
+    __slots__ = ("base", "seq")
+
+    def __init__(self, base: EncodedEvent, seq: int):
+        self.base = base
+        self.seq = seq
+
+    @property
+    def data(self) -> Any:
+        return {"seq": self.seq, **self.base.data}
+
+    @property
+    def text(self) -> str:
+        base = self.base.text
+        separator = "," if base != "{}" else ""
+        return f'{{"seq":{self.seq}{separator}{base[1:]}'
+
+    @property
+    def binary(self) -> bytes:
+        base = self.base.binary
+        # fixmap (0x80-0x8e): tăng số phần tử trong header rồi chèn cặp "seq" vào đầu
+        if 0x80 <= base[0] < 0x8f:
+            return bytes([base[0] + 1]) + msgpack.packb("seq") + msgpack.packb(self.seq) + base[1:]
+        return encode_event_msgpack(self.data)
@@ -0,0 +1,186 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, Optional
+from dotenv import load_dotenv
+from .codec import EncodedEvent
+from .connection import Connection
+
+load_dotenv()
+
+# Độ dài tối đa của tin nhắn văn bản gửi qua WebSocket
+MAX_TEXT_LENGTH = 10000
+# Số lệnh tối đa chờ xử lý trên mỗi kết nối (vượt quá thì trả ack "busy")
+WS_COMMAND_QUEUE_SIZE = int(os.getenv("WS_COMMAND_QUEUE_SIZE", 32))
+
+class CommandError(Exception):
+    """Lỗi xử lý lệnh, được trả về client trong ack với code tương ứng."""
+
+    def __init__(self, code: str, message: str):
+        super().__init__(message)
+        self.code = code
+
+def _require(payload: dict, field: str) -> str:
+    value = payload.get(field)
+    if not isinstance(value, str) or not value.strip():
+        raise CommandError("bad_request", f"Thiếu trường '{field}'.")
+    return value
+
+# Các handler nhận (user_id, payload) và trả về payload của ack.
+# MessageService được import trong hàm vì message_service import websocket.manager.
+
+async def handle_send_message(user_id: str, payload: dict) -> dict:
+    from ..services.message_service import MessageService
+    from ..utils import map_message_to_public_dict
+
+    conversation_id = _require(payload, "conversationId")
+    text = payload.get("text")
+    if text is None and isinstance(payload.get("content"), dict):
+        text = payload["content"].get("text")
+    if not isinstance(text, str) or not text.strip():
+        raise CommandError("bad_request", "Tin nhắn văn bản không được để trống.")
+    if len(text) > MAX_TEXT_LENGTH:
+        raise CommandError("bad_request", "Tin nhắn quá dài.")
+
+    # Chỉ hỗ trợ tin nhắn văn bản; tin nhắn media vẫn gửi qua HTTP (upload file)
+    message = await MessageService.send_message(
+        sender_id=user_id,
+        conversation_id=conversation_id,
+        content={"type": "text", "text": text}
+    )
+    return {"message": map_message_to_public_dict(message)}
+
+async def handle_mark_seen(user_id: str, payload: dict) -> dict:
+    from ..services.message_service import MessageService
+
+    conversation_id = _require(payload, "conversationId")
+    await MessageService.mark_conversation_as_seen(conversation_id=conversation_id, user_id=user_id)
+    return {"conversationId": conversation_id}
+
+async def handle_recall(user_id: str, payload: dict) -> dict:
+    from ..services.message_service import MessageService
+
+    message_id = _require(payload, "messageId")
+    await MessageService.recall_message(message_id=message_id, user_id=user_id)
+    return {"messageId": message_id}
+
+async def handle_typing(user_id: str, payload: dict) -> dict:
+    from ..websocket import manager
+
+    conversation_id = _require(payload, "conversationId")
+    is_typing = bool(payload.get("isTyping", True))
+    await manager.activity.publish(conversation_id, user_id, "typing", is_typing)
+    return {"conversationId": conversation_id}
+
+async def handle_activity(user_id: str, payload: dict) -> dict:
+    from ..websocket import manager
+
+    conversation_id = _require(payload, "conversationId")
+    kind = _require(payload, "kind")
+    try:
+        await manager.activity.publish(conversation_id, user_id, kind, bool(payload.get("active", True)))
+    except ValueError as e:
+        raise CommandError("bad_request", str(e))
+    return {"conversationId": conversation_id, "kind": kind}
+
+CommandHandler = Callable[[str, dict], Awaitable[dict]]
+
+COMMAND_HANDLERS: Dict[str, CommandHandler] = {
+    "send_message": handle_send_message,
+    "mark_seen": handle_mark_seen,
+    "recall": handle_recall,
+    "typing": handle_typing,
+    "activity": handle_activity,
+}
+
+def _ack(request_id: Optional[Any], ok: bool, payload: Optional[dict] = None, error: Optional[dict] = None) -> EncodedEvent:
+    frame = {"type": "ack", "requestId": request_id, "ok": ok}
+    if ok:
+        frame["payload"] = payload or {}
+    else:
+        frame["error"] = error
+    return EncodedEvent(frame)
+
+async def dispatch_command(connection: Connection, event: Any) -> bool:
+    """
+    Xử lý một lệnh từ client: {"type": ..., "requestId": ..., "payload": {...}}.
+    Kết quả được trả về bằng frame {"type": "ack", "requestId": ..., "ok": ...}.
+
+    Returns:
+        bool: False nếu frame không phải là lệnh được hỗ trợ
+    """
+    if not isinstance(event, dict):
+        return False
+    handler = COMMAND_HANDLERS.get(event.get("type"))
+    request_id = event.get("requestId")
+    if handler is None:
+        if request_id is not None:
+            connection.enqueue(_ack(request_id, False, error={
+                "code": "unknown_command",
+                "message": f"Lệnh không được hỗ trợ: {event.get('type')}"
+            }))
+        return False
+
+    payload = event.get("payload") or {}
+    try:
+        if not isinstance(payload, dict):
+            raise CommandError("bad_request", "payload phải là một object.")
+        result = await handler(connection.user_id, payload)
+        frame = _ack(request_id, True, payload=result)
+    except CommandError as e:
+        frame = _ack(request_id, False, error={"code": e.code, "message": str(e)})
+    except PermissionError as e:
+        frame = _ack(request_id, False, error={"code": "forbidden", "message": str(e)})
+    except ValueError as e:
+        frame = _ack(request_id, False, error={"code": "not_found", "message": str(e)})
+    except Exception as e:
+        print(f"Lỗi khi xử lý lệnh WebSocket {event.get('type')}: {e}")
+        frame = _ack(request_id, False, error={"code": "internal", "message": "Lỗi máy chủ."})
+
+    # Sự kiện tạm thời không cần ack nếu client không gửi requestId
+    if request_id is not None or event.get("type") not in ("typing", "activity"):
+        connection.enqueue(frame)
+    return True
+
+class CommandQueue:
+    """
+    Hàng đợi lệnh có giới hạn của một kết nối, xử lý tuần tự bởi một worker task riêng.
+    Vòng đọc socket chỉ đưa lệnh vào hàng đợi nên không bị chặn bởi lệnh chậm (ghi DB, fan-out);
+    thứ tự lệnh của client được giữ nguyên và ack vẫn mang requestId tương ứng.
+    """
+
+    def __init__(self, connection: Connection, size: int = WS_COMMAND_QUEUE_SIZE):
+        self.connection = connection
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=size)
+        self._worker: Optional[asyncio.Task] = None
+        self.rejected = 0
+
+    def submit(self, event: Any) -> bool:
+        """Đưa một lệnh vào hàng đợi. Trả về False (và ack "busy" nếu có requestId) khi hàng đợi đầy."""
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            request_id = event.get("requestId") if isinstance(event, dict) else None
+            if request_id is not None:
+                self.connection.enqueue(_ack(request_id, False, error={
+                    "code": "busy",
+                    "message": "Quá nhiều lệnh đang chờ xử lý, vui lòng thử lại."
+                }))
+            return False
+
+    async def _run(self):
+        while True:
+            event = await self.queue.get()
+            try:
+                await dispatch_command(self.connection, event)
+            except Exception as e:
+                print(f"Lỗi khi xử lý lệnh WebSocket của user {self.connection.user_id}: {e}")
+
+    def stop(self):
+        """Hủy worker (khi socket đã đóng); các lệnh còn chờ bị bỏ."""
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
@@ -0,0 +1,128 @@
+import asyncio
+import os
+import time
+from typing import Any, Callable, Optional, Union
+from dotenv import load_dotenv
+from .codec import EncodedEvent
+
+load_dotenv()
+
+# Số sự kiện tối đa chờ gửi trên mỗi kết nối
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", 256))
+# Xử lý khi hàng đợi đầy: "drop_oldest" (bỏ sự kiện cũ nhất) hoặc "disconnect" (ngắt client chậm)
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "drop_oldest").lower()
+
+# Mã đóng khi ngắt client không đọc kịp (1013: Try Again Later)
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+class Connection:
+    """
+    Một kết nối WebSocket với hàng đợi gửi có giới hạn và writer task riêng.
+    Broadcast chỉ đưa sự kiện vào hàng đợi nên không phải chờ client chậm;
+    kết nối lỗi tự gọi on_closed để ConnectionManager gỡ bỏ.
+    Kết nối binary (subprotocol MessagePack) nhận frame nhị phân thay cho JSON.
+    """
+
+    def __init__(
+        self,
+        websocket: Any,
+        user_id: str,
+        on_closed: Callable[["Connection"], None],
+        queue_size: int = WS_SEND_QUEUE_SIZE,
+        overflow_policy: str = WS_OVERFLOW_POLICY,
+        binary: bool = False,
+        heartbeat: bool = False
+    ):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.binary = binary
+        self.heartbeat = heartbeat  # Client đăng ký heartbeat mức ứng dụng (?heartbeat=1)
+        self.overflow_policy = overflow_policy
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.closed = False
+        self._on_closed = on_closed
+        self._writer: Optional[asyncio.Task] = None
+
+        # Liveness: thời điểm nhận frame gần nhất và thời điểm bắt đầu lần gửi đang dở
+        self.connected_at = time.monotonic()
+        self.last_seen = self.connected_at
+        self.send_started: Optional[float] = None
+
+        # Metrics
+        self.sent = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def touch(self):
+        """Ghi nhận client vừa gửi một frame."""
+        self.last_seen = time.monotonic()
+
+    def start(self):
+        """Khởi động writer task (gọi sau khi websocket đã accept)."""
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_loop())
+
+    def enqueue(self, event: Union[EncodedEvent, str]) -> bool:
+        """
+        Đưa một sự kiện (EncodedEvent hoặc chuỗi JSON đã mã hóa) vào hàng đợi.
+        Trả về False nếu sự kiện không được nhận.
+        """
+        if self.closed:
+            return False
+        if isinstance(event, str):
+            event = EncodedEvent(text=event)
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.overflow_policy == "disconnect":
+                print(f"Ngắt kết nối WebSocket chậm của user {self.user_id} (hàng đợi đầy)")
+                asyncio.create_task(self.close(SLOW_CONSUMER_CLOSE_CODE))
+                return False
+            # Bỏ sự kiện cũ nhất để nhường chỗ cho sự kiện mới
+            self.queue.get_nowait()
+            self.queue.put_nowait(event)
+
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return True
+
+    async def _write_loop(self):
+        try:
+            while True:
+                event = await self.queue.get()
+                self.send_started = time.monotonic()
+                if self.binary:
+                    await self.websocket.send_bytes(event.binary)
+                else:
+                    await self.websocket.send_text(event.text)
+                self.send_started = None
+                self.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Lỗi khi gửi WebSocket đến user {self.user_id}, gỡ kết nối: {e}")
+        finally:
+            self._mark_closed()
+
+    def _mark_closed(self):
+        if not self.closed:
+            self.closed = True
+            self._on_closed(self)
+
+    async def close(self, code: int = 1000):
+        """Dừng writer và đóng socket."""
+        self._mark_closed()
+        self.stop()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def stop(self):
+        """Dừng writer task (khi socket đã bị client đóng)."""
+        self.closed = True
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+
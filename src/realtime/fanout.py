@@ -0,0 +1,189 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Iterable, List, Optional
+from dotenv import load_dotenv
+from .codec import EncodedEvent
+
+load_dotenv()
+
+# Số chunk được giao song song tối đa
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", 4))
+# Số người nhận trong một chunk (mỗi chunk là một lần publish_many + enqueue cục bộ)
+FANOUT_CHUNK_SIZE = int(os.getenv("FANOUT_CHUNK_SIZE", 500))
+# Số chunk tối đa chờ ở lane social; vượt quá thì bỏ sự kiện social (chat không bao giờ bị bỏ)
+FANOUT_SOCIAL_QUEUE_SIZE = int(os.getenv("FANOUT_SOCIAL_QUEUE_SIZE", 10000))
+
+# Lane theo thứ tự ưu tiên: chat luôn được giao trước social
+LANE_CHAT = "chat"
+LANE_SOCIAL = "social"
+LANES = (LANE_CHAT, LANE_SOCIAL)
+
+BroadcastCallable = Callable[[Iterable[str], EncodedEvent], Awaitable[None]]
+
+class FanoutJob:
+    """Một sự kiện cần giao cho nhiều người nhận, đã chia thành các chunk."""
+
+    __slots__ = ("lane", "event", "submitted", "started", "remaining")
+
+    def __init__(self, lane: str, event: EncodedEvent, chunks: int):
+        self.lane = lane
+        self.event = event
+        self.submitted = time.monotonic()
+        self.started: Optional[float] = None
+        self.remaining = chunks
+
+class LaneStats:
+    __slots__ = ("submitted", "started", "completed", "dropped", "failed", "lag_total", "lag_max", "completion_total", "completion_max")
+
+    def __init__(self):
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.completion_total = 0.0
+        self.completion_max = 0.0
+
+class FanoutScheduler:
+    """
+    Hàng đợi giao sự kiện WebSocket cho nhóm người nhận lớn.
+
+    - Người nhận được chia thành chunk, các worker giao song song có giới hạn.
+    - Worker luôn lấy chunk của lane chat trước lane social, nên một bài viết
+      gửi tới hàng nghìn bạn bè không làm chậm tin nhắn.
+    - Các chunk được lấy theo thứ tự gửi vào, nên sự kiện trong cùng lane đến
+      cùng một người nhận theo đúng thứ tự.
+    - Thống kê độ trễ hàng đợi (submit -> bắt đầu giao) và thời gian hoàn tất.
+    """
+
+    def __init__(
+        self,
+        broadcast: BroadcastCallable,
+        concurrency: int = FANOUT_CONCURRENCY,
+        chunk_size: int = FANOUT_CHUNK_SIZE,
+        social_queue_size: int = FANOUT_SOCIAL_QUEUE_SIZE
+    ):
+        self.broadcast = broadcast
+        self.concurrency = concurrency
+        self.chunk_size = max(1, chunk_size)
+        self.social_queue_size = social_queue_size
+        self._queues: Dict[str, Deque[tuple[FanoutJob, List[str]]]] = {lane: deque() for lane in LANES}
+        self._stats: Dict[str, LaneStats] = {lane: LaneStats() for lane in LANES}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self.in_flight = 0
+
+    def start(self):
+        """Khởi động các worker (cần event loop đang chạy)."""
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        for _ in range(self.concurrency):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, user_ids: Iterable[str], data: dict, lane: str = LANE_SOCIAL) -> bool:
+        """
+        Đưa một sự kiện vào hàng đợi giao và trả về ngay (không cần await).
+        Sự kiện chỉ được mã hóa một lần cho mọi chunk.
+
+        Returns:
+            bool: False nếu sự kiện social bị bỏ vì hàng đợi đã đầy
+        """
+        if lane not in self._queues:
+            raise ValueError(f"Lane không hợp lệ: {lane}")
+        # Loại bỏ trùng lặp, giữ nguyên thứ tự
+        user_ids = list(dict.fromkeys(str(uid) for uid in user_ids if uid))
+        if not user_ids:
+            return True
+
+        self.start()
+        queue = self._queues[lane]
+        stats = self._stats[lane]
+        chunks = [user_ids[i:i + self.chunk_size] for i in range(0, len(user_ids), self.chunk_size)]
+        if lane == LANE_SOCIAL and len(queue) + len(chunks) > self.social_queue_size:
+            stats.dropped += 1
+            print(f"Fan-out quá tải, bỏ sự kiện {data.get('type')} tới {len(user_ids)} người nhận")
+            return False
+
+        job = FanoutJob(lane, EncodedEvent(data), len(chunks))
+        for chunk in chunks:
+            queue.append((job, chunk))
+        stats.submitted += 1
+        self._wakeup.set()
+        return True
+
+    def _next(self) -> Optional[tuple[FanoutJob, List[str]]]:
+        for lane in LANES:
+            queue = self._queues[lane]
+            if queue:
+                return queue.popleft()
+        return None
+
+    async def _worker(self):
+        while True:
+            item = self._next()
+            if item is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            job, chunk = item
+            stats = self._stats[job.lane]
+            now = time.monotonic()
+            if job.started is None:
+                job.started = now
+                stats.started += 1
+                lag = now - job.submitted
+                stats.lag_total += lag
+                stats.lag_max = max(stats.lag_max, lag)
+
+            self.in_flight += 1
+            try:
+                await self.broadcast(chunk, job.event)
+            except Exception as e:
+                stats.failed += 1
+                print(f"Lỗi khi fan-out sự kiện tới {len(chunk)} người nhận: {e}")
+            finally:
+                self.in_flight -= 1
+
+            job.remaining -= 1
+            if job.remaining == 0:
+                elapsed = time.monotonic() - job.submitted
+                stats.completed += 1
+                stats.completion_total += elapsed
+                stats.completion_max = max(stats.completion_max, elapsed)
+            # Nhường event loop giữa các chunk
+            await asyncio.sleep(0)
+
+    def stats(self) -> dict:
+        """Thống kê hàng đợi, độ trễ (ms) và thời gian hoàn tất (ms) theo lane."""
+        lanes = {}
+        for lane in LANES:
+            stats = self._stats[lane]
+            lanes[lane] = {
+                "queuedChunks": len(self._queues[lane]),
+                "submitted": stats.submitted,
+                "completed": stats.completed,
+                "dropped": stats.dropped,
+                "failedChunks": stats.failed,
+                "avgLagMs": round(stats.lag_total / stats.started * 1000, 2) if stats.started else 0.0,
+                "maxLagMs": round(stats.lag_max * 1000, 2),
+                "avgCompletionMs": round(stats.completion_total / stats.completed * 1000, 2) if stats.completed else 0.0,
+                "maxCompletionMs": round(stats.completion_max * 1000, 2),
+            }
+        return {
+            "workers": len(self._tasks),
+            "chunkSize": self.chunk_size,
+            "inFlight": self.in_flight,
+            "lanes": lanes,
+        }
@@ -0,0 +1,140 @@
+import asyncio
+import os
+import time
+from typing import Callable, Iterable, List, Optional
+from dotenv import load_dotenv
+from .codec import EncodedEvent
+from .connection import Connection
+
+load_dotenv()
+
+# Chu kỳ gửi frame {"type": "ping"} tới client đăng ký heartbeat (giây, 0 để tắt)
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", 25))
+# Client đăng ký heartbeat mà im lặng quá lâu thì coi là kết nối chết (giây)
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", 90))
+# Một lần gửi bị treo quá lâu (TCP nửa mở) thì coi là kết nối chết (giây)
+WS_SEND_STALL_TIMEOUT = float(os.getenv("WS_SEND_STALL_TIMEOUT", 30))
+# Chu kỳ quét và số kết nối bị đóng mỗi đợt
+WS_REAP_INTERVAL = float(os.getenv("WS_REAP_INTERVAL", 30))
+WS_REAP_BATCH_SIZE = int(os.getenv("WS_REAP_BATCH_SIZE", 100))
+
+# Mã đóng cho kết nối bị thu dọn (1001: Going Away)
+REAPED_CLOSE_CODE = 1001
+CLOSE_TIMEOUT_SECONDS = 5
+
+class HeartbeatMonitor:
+    """
+    Heartbeat mức ứng dụng và thu dọn các kết nối WebSocket chết (mạng di động đổi mạng, TCP nửa mở).
+
+    Ping/pong mức giao thức do uvicorn đảm nhiệm (--ws-ping-interval / --ws-ping-timeout) cho mọi
+    client, kể cả client cũ. Ping JSON chỉ gửi tới kết nối đã đăng ký heartbeat (?heartbeat=1).
+
+    Kết nối bị coi là chết khi:
+    - đã đăng ký heartbeat nhưng im lặng quá WS_IDLE_TIMEOUT, hoặc
+    - một lần gửi bị treo quá WS_SEND_STALL_TIMEOUT.
+    """
+
+    def __init__(
+        self,
+        connections: Callable[[], Iterable[Connection]],
+        interval: float = WS_HEARTBEAT_INTERVAL,
+        idle_timeout: float = WS_IDLE_TIMEOUT,
+        stall_timeout: float = WS_SEND_STALL_TIMEOUT,
+        reap_interval: float = WS_REAP_INTERVAL,
+        batch_size: int = WS_REAP_BATCH_SIZE
+    ):
+        self.connections = connections
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.stall_timeout = stall_timeout
+        self.reap_interval = reap_interval
+        self.batch_size = batch_size
+        self._tasks: List[asyncio.Task] = []
+
+        # Gauges
+        self.active = 0
+        self.stale = 0
+        self.reaped = 0
+        self.pings = 0
+        self.last_reap_at: Optional[float] = None
+
+    async def start(self):
+        if self._tasks:
+            return
+        if self.interval > 0:
+            self._tasks.append(asyncio.create_task(self._ping_loop()))
+        if self.reap_interval > 0:
+            self._tasks.append(asyncio.create_task(self._reap_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def ping(self):
+        """Gửi một frame ping (mã hóa một lần) tới các kết nối đã đăng ký heartbeat đang rảnh."""
+        event = EncodedEvent({"type": "ping", "ts": int(time.time() * 1000)})
+        for connection in list(self.connections()):
+            if not connection.heartbeat:
+                continue
+            # Kết nối còn sự kiện chờ gửi thì không cần ping (và không để ping đẩy sự kiện thật ra)
+            if connection.queue.empty() and connection.enqueue(event):
+                self.pings += 1
+
+    def is_stale(self, connection: Connection, now: float) -> bool:
+        if connection.closed:
+            return True
+        if connection.heartbeat and now - connection.last_seen > self.idle_timeout:
+            return True
+        if connection.send_started is not None and now - connection.send_started > self.stall_timeout:
+            return True
+        return False
+
+    async def reap(self) -> int:
+        """Quét một lượt và đóng các kết nối chết theo từng đợt. Trả về số kết nối đã đóng."""
+        now = time.monotonic()
+        connections = list(self.connections())
+        stale = [connection for connection in connections if self.is_stale(connection, now)]
+        self.active = len(connections) - len(stale)
+        self.stale = len(stale)
+
+        for start in range(0, len(stale), self.batch_size):
+            batch = stale[start:start + self.batch_size]
+            await asyncio.gather(
+                *(asyncio.wait_for(connection.close(REAPED_CLOSE_CODE), CLOSE_TIMEOUT_SECONDS) for connection in batch),
+                return_exceptions=True
+            )
+            self.reaped += len(batch)
+            # Nhường event loop giữa các đợt
+            await asyncio.sleep(0)
+
+        self.last_reap_at = time.time()
+        return len(stale)
+
+    async def _ping_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.ping()
+            except Exception as e:
+                print(f"Lỗi khi gửi heartbeat WebSocket: {e}")
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                reaped = await self.reap()
+                if reaped:
+                    print(f"Đã thu dọn {reaped} kết nối WebSocket chết")
+            except Exception as e:
+                print(f"Lỗi khi thu dọn kết nối WebSocket: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "stale": self.stale,
+            "reaped": self.reaped,
+            "pings": self.pings,
+            "lastReapAt": self.last_reap_at,
+        }
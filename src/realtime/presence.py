@@ -0,0 +1,280 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+from dotenv import load_dotenv
+from ..utils.ttl_cache import TTLCache
+
+load_dotenv()
+
+# User phải ngắt kết nối liên tục trong khoảng này mới bị coi là offline (chống nhấp nháy khi đổi mạng)
+PRESENCE_DEBOUNCE_SECONDS = float(os.getenv("PRESENCE_DEBOUNCE_MS", 5000)) / 1000
+# Chu kỳ gom các thay đổi presence thành frame gửi cho bạn bè
+PRESENCE_FLUSH_INTERVAL_SECONDS = float(os.getenv("PRESENCE_FLUSH_INTERVAL_MS", 1000)) / 1000
+# Cache danh sách bạn bè (bị xóa khi document User thay đổi)
+PRESENCE_FRIEND_CACHE_TTL_SECONDS = int(os.getenv("PRESENCE_FRIEND_CACHE_TTL_SECONDS", 300))
+PRESENCE_FRIEND_CACHE_MAX_SIZE = int(os.getenv("PRESENCE_FRIEND_CACHE_MAX_SIZE", 50000))
+# Số user tối đa được nhớ thời điểm online gần nhất
+PRESENCE_LAST_SEEN_MAX_SIZE = int(os.getenv("PRESENCE_LAST_SEEN_MAX_SIZE", 100000))
+# Khi chạy nhiều node: chu kỳ mỗi node phát lại danh sách user online của mình qua backplane (giây).
+# Trạng thái từ node khác hết hạn sau 3 chu kỳ không được làm mới (node bị tắt đột ngột).
+PRESENCE_REMOTE_REFRESH_SECONDS = float(os.getenv("PRESENCE_REMOTE_REFRESH_SECONDS", 30))
+# Số user tối đa trong một thông điệp presence qua backplane
+PRESENCE_PUBLISH_BATCH_SIZE = 500
+
+# Gửi thông điệp điều khiển qua backplane: publish(kind, key)
+PublishControl = Callable[[str, str], Awaitable[None]]
+
+friend_cache = TTLCache(maxsize=PRESENCE_FRIEND_CACHE_MAX_SIZE, ttl=PRESENCE_FRIEND_CACHE_TTL_SECONDS)
+
+def invalidate_friends(user_id: str):
+    """Xóa danh sách bạn bè đã cache của user (gọi khi document User thay đổi)."""
+    friend_cache.invalidate(str(user_id))
+
+async def get_friend_ids(user_ids: Iterable[str]) -> Dict[str, List[str]]:
+    """Lấy danh sách bạn bè của nhiều user: đọc cache, phần còn thiếu lấy bằng một truy vấn projection."""
+    from bson import ObjectId
+    from ..models.user import User, UserFriends
+
+    result: Dict[str, List[str]] = {}
+    missing = []
+    for user_id in user_ids:
+        cached = friend_cache.get(user_id)
+        if cached is None:
+            missing.append(user_id)
+        else:
+            result[user_id] = cached
+
+    object_ids = [ObjectId(user_id) for user_id in missing if ObjectId.is_valid(user_id)]
+    if object_ids:
+        users = await User.find({"_id": {"$in": object_ids}}).project(UserFriends).to_list()
+        for user in users:
+            result[str(user.id)] = user.friendIds
+            friend_cache.set(str(user.id), user.friendIds)
+
+    for user_id in missing:
+        result.setdefault(user_id, [])
+    return result
+
+def _now() -> datetime:
+    return datetime.utcnow() + timedelta(hours=7)
+
+class PresenceTracker:
+    """
+    Theo dõi trạng thái online/offline từ các sự kiện connect/disconnect của WebSocket.
+
+    - Online ngay khi có kết nối đầu tiên; offline chỉ khi mất kết nối liên tục quá debounce.
+    - Các thay đổi được gom lại và gửi định kỳ cho những người bạn đang kết nối tại node này,
+      mỗi nhóm người nhận có cùng danh sách thay đổi chỉ mã hóa một frame.
+    - Khi chạy nhiều node (có publish), thay đổi online/offline cục bộ được phát qua backplane;
+      user online nếu có kết nối ở bất kỳ node nào. Mỗi node chỉ gửi frame cho socket cục bộ
+      của mình nên bạn bè không nhận trùng.
+    """
+
+    def __init__(
+        self,
+        is_connected: Callable[[str], bool],
+        broadcast: Callable[[Iterable[str], dict], Awaitable[None]],
+        debounce: float = PRESENCE_DEBOUNCE_SECONDS,
+        flush_interval: float = PRESENCE_FLUSH_INTERVAL_SECONDS,
+        node_id: str = "",
+        publish: Optional[PublishControl] = None,
+        remote_refresh: float = PRESENCE_REMOTE_REFRESH_SECONDS
+    ):
+        self.is_connected = is_connected
+        self.broadcast = broadcast
+        self.debounce = debounce
+        self.flush_interval = flush_interval
+        self.node_id = node_id
+        self.publish = publish
+        self.remote_refresh = remote_refresh
+
+        self._online_since: Dict[str, datetime] = {}  # User có kết nối tại node này
+        self._remote: Dict[str, Dict[str, float]] = {}  # user_id -> {node_id: hạn (monotonic)}
+        self._outgoing: Dict[str, bool] = {}  # Thay đổi cục bộ chờ phát qua backplane
+        self._last_refresh = time.monotonic()
+        self._last_seen = TTLCache(maxsize=PRESENCE_LAST_SEEN_MAX_SIZE, ttl=7 * 24 * 3600)
+        self._pending_offline: Dict[str, asyncio.TimerHandle] = {}
+        self._announced: Set[str] = set()  # User đã được báo online cho bạn bè
+        self._dirty: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+
+        # Metrics
+        self.flaps_suppressed = 0
+        self.frames_sent = 0
+        self.changes_sent = 0
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Báo các node khác user của node này đã offline thay vì chờ hết hạn
+        if self.publish is not None and self._online_since:
+            self._outgoing = dict.fromkeys(self._online_since, False)
+            self._online_since.clear()
+            try:
+                await self._publish_changes()
+            except Exception as e:
+                print(f"Lỗi khi gửi presence lúc dừng: {e}")
+        for handle in self._pending_offline.values():
+            handle.cancel()
+        self._pending_offline.clear()
+
+    def on_connect(self, user_id: str):
+        """Gọi khi user có kết nối mới."""
+        handle = self._pending_offline.pop(user_id, None)
+        if handle is not None:
+            # Kết nối lại trong thời gian debounce: vẫn coi là online liên tục
+            handle.cancel()
+            self.flaps_suppressed += 1
+            return
+        if user_id not in self._online_since:
+            self._online_since[user_id] = _now()
+            self._dirty.add(user_id)
+            self._outgoing[user_id] = True
+
+    def on_disconnect(self, user_id: str):
+        """Gọi khi kết nối cuối cùng của user đóng."""
+        if self.is_connected(user_id) or user_id in self._pending_offline:
+            return
+        loop = asyncio.get_running_loop()
+        self._pending_offline[user_id] = loop.call_later(self.debounce, self._go_offline, user_id)
+
+    def _go_offline(self, user_id: str):
+        self._pending_offline.pop(user_id, None)
+        if self.is_connected(user_id):
+            return
+        if self._online_since.pop(user_id, None) is not None:
+            self._outgoing[user_id] = False
+            self._mark_changed(user_id)
+
+    def _mark_changed(self, user_id: str):
+        if not self.is_online(user_id):
+            self._last_seen.set(user_id, _now())
+        self._dirty.add(user_id)
+
+    def is_online(self, user_id: str) -> bool:
+        return user_id in self._online_since or bool(self._remote.get(user_id))
+
+    def on_remote(self, key: str):
+        """Nhận thay đổi presence từ node khác: key = "<node_id> <1|0> <user_id>,<user_id>,..."."""
+        node_id, state, user_ids = key.split(" ", 2)
+        expires = time.monotonic() + 3 * self.remote_refresh
+        for user_id in filter(None, user_ids.split(",")):
+            nodes = self._remote.get(user_id)
+            if state == "1":
+                if nodes is None:
+                    nodes = self._remote[user_id] = {}
+                changed = not nodes
+                nodes[node_id] = expires
+            else:
+                changed = nodes is not None and nodes.pop(node_id, None) is not None
+                if nodes is not None and not nodes:
+                    del self._remote[user_id]
+            if changed:
+                self._mark_changed(user_id)
+
+    def _expire_remote(self, now: float):
+        """Bỏ trạng thái của node không còn làm mới (bị tắt đột ngột)."""
+        for user_id in list(self._remote):
+            nodes = self._remote[user_id]
+            for node_id in [node_id for node_id, expires in nodes.items() if expires <= now]:
+                del nodes[node_id]
+            if not nodes:
+                del self._remote[user_id]
+                self._mark_changed(user_id)
+
+    async def _publish_changes(self):
+        """Phát thay đổi cục bộ (và định kỳ toàn bộ user online cục bộ) tới các node khác."""
+        now = time.monotonic()
+        outgoing, self._outgoing = self._outgoing, {}
+        if now - self._last_refresh >= self.remote_refresh:
+            self._last_refresh = now
+            outgoing.update(dict.fromkeys(self._online_since, True))
+            self._expire_remote(now)
+
+        for state in (True, False):
+            user_ids = [user_id for user_id, online in outgoing.items() if online == state]
+            for start in range(0, len(user_ids), PRESENCE_PUBLISH_BATCH_SIZE):
+                batch = ",".join(user_ids[start:start + PRESENCE_PUBLISH_BATCH_SIZE])
+                await self.publish("presence", f"{self.node_id} {int(state)} {batch}")
+
+    def _entry(self, user_id: str) -> dict:
+        online = self.is_online(user_id)
+        last_seen = None if online else self._last_seen.get(user_id)
+        return {
+            "userId": user_id,
+            "online": online,
+            "lastSeen": last_seen.isoformat() if last_seen else None,
+        }
+
+    def snapshot(self, user_ids: Iterable[str]) -> List[dict]:
+        """Trạng thái hiện tại của nhiều user, trả lời hoàn toàn từ bộ nhớ."""
+        return [self._entry(user_id) for user_id in user_ids]
+
+    async def flush(self):
+        """Gửi các thay đổi presence đã gom tới bạn bè đang kết nối tại node này."""
+        if self.publish is not None:
+            await self._publish_changes()
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+
+        changes: Dict[str, dict] = {}
+        for user_id in dirty:
+            online = self.is_online(user_id)
+            if online == (user_id in self._announced):
+                continue
+            if online:
+                self._announced.add(user_id)
+            else:
+                self._announced.discard(user_id)
+            changes[user_id] = self._entry(user_id)
+        if not changes:
+            return
+
+        # Người nhận -> các user thay đổi mà người nhận là bạn bè
+        friends = await get_friend_ids(list(changes))
+        per_recipient: Dict[str, List[str]] = {}
+        for user_id, friend_ids in friends.items():
+            for friend_id in friend_ids:
+                if self.is_connected(friend_id):
+                    per_recipient.setdefault(friend_id, []).append(user_id)
+
+        # Gom người nhận có cùng danh sách thay đổi để mã hóa frame một lần
+        groups: Dict[tuple, List[str]] = {}
+        for recipient, user_ids in per_recipient.items():
+            groups.setdefault(tuple(sorted(user_ids)), []).append(recipient)
+
+        for user_ids, recipients in groups.items():
+            await self.broadcast(recipients, {
+                "type": "presence",
+                "payload": {"changes": [changes[user_id] for user_id in user_ids]}
+            })
+            self.frames_sent += len(recipients)
+        self.changes_sent += len(changes)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Lỗi khi gửi presence: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "online": len(self._online_since),
+            "remoteOnline": len(self._remote),
+            "pendingOffline": len(self._pending_offline),
+            "flapsSuppressed": self.flaps_suppressed,
+            "framesSent": self.frames_sent,
+            "changesSent": self.changes_sent,
+            "friendCache": friend_cache.stats(),
+        }
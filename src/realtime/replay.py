@@ -0,0 +1,159 @@
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional, Tuple
+from dotenv import load_dotenv
+from .codec import EncodedEvent, SequencedEvent
+
+load_dotenv()
+
+# Số sự kiện gần nhất được giữ lại cho mỗi user để phát lại khi kết nối lại
+REPLAY_BUFFER_SIZE = int(os.getenv("REPLAY_BUFFER_SIZE", 200))
+# Số user tối đa được giữ bộ đệm (LRU) và thời gian giữ bộ đệm của user không có sự kiện mới
+REPLAY_MAX_USERS = int(os.getenv("REPLAY_MAX_USERS", 20000))
+REPLAY_TTL_SECONDS = int(os.getenv("REPLAY_TTL_SECONDS", 900))
+# Giới hạn kích thước (tính theo độ dài JSON của sự kiện) cho mỗi user và cho toàn bộ bộ đệm
+REPLAY_MAX_BYTES_PER_USER = int(os.getenv("REPLAY_MAX_BYTES_PER_USER", 256 * 1024))
+REPLAY_MAX_TOTAL_BYTES = int(os.getenv("REPLAY_MAX_TOTAL_BYTES", 64 * 1024 * 1024))
+
+# Sự kiện tạm thời: không đánh số, không phát lại (client tự lấy lại trạng thái khi cần)
+EPHEMERAL_EVENT_TYPES = frozenset({"ping", "pong", "ack", "hello", "resync_required", "presence", "activity"})
+
+def is_replayable(data) -> bool:
+    return isinstance(data, dict) and data.get("type") not in EPHEMERAL_EVENT_TYPES
+
+# (seq, sự kiện gốc dùng chung, kích thước ước lượng)
+ReplayEntry = Tuple[int, EncodedEvent, int]
+
+class EventStream:
+    """Dòng sự kiện của một user: epoch, seq mới nhất và các sự kiện gần nhất."""
+
+    __slots__ = ("epoch", "seq", "events", "bytes", "touched")
+
+    def __init__(self):
+        # Epoch đổi khi bộ đệm được tạo lại (khởi động lại, bị loại khỏi LRU) để client biết seq cũ không còn dùng được
+        self.epoch = uuid.uuid4().hex[:12]
+        self.seq = 0
+        self.events: Deque[ReplayEntry] = deque()
+        self.bytes = 0
+        self.touched = time.monotonic()
+
+class ReplayBuffer:
+    """
+    Đánh số tăng dần cho sự kiện của từng user và giữ vòng đệm các sự kiện gần nhất.
+    Khi kết nối lại với since=<seq>, client chỉ nhận các sự kiện bị lỡ;
+    nếu khoảng bị lỡ không còn trong bộ đệm thì client phải tải lại toàn bộ (resync).
+    Bộ đệm nằm trong bộ nhớ của process hiện tại.
+
+    Vòng đệm chỉ giữ (seq, sự kiện gốc): sự kiện gửi cho nhiều người nhận được dùng chung,
+    frame có seq được dựng khi gửi/phát lại. Kích thước được giới hạn theo số sự kiện và số byte
+    của từng user, và tổng số byte (tính cho từng user nên sự kiện dùng chung bị tính nhiều lần);
+    user ít được dùng nhất bị loại trước khi vượt giới hạn tổng.
+    """
+
+    def __init__(
+        self,
+        size: int = REPLAY_BUFFER_SIZE,
+        max_users: int = REPLAY_MAX_USERS,
+        ttl: float = REPLAY_TTL_SECONDS,
+        max_user_bytes: int = REPLAY_MAX_BYTES_PER_USER,
+        max_total_bytes: int = REPLAY_MAX_TOTAL_BYTES
+    ):
+        self.size = size
+        self.max_users = max_users
+        self.ttl = ttl
+        self.max_user_bytes = max_user_bytes
+        self.max_total_bytes = max_total_bytes
+        # LRU: user vừa có sự kiện/kết nối nằm cuối
+        self._streams: "OrderedDict[str, EventStream]" = OrderedDict()
+        self.total_bytes = 0
+
+        # Metrics
+        self.recorded = 0
+        self.replayed = 0
+        self.resyncs = 0
+        self.evicted_users = 0
+
+    def _evict(self, keep: Optional[str] = None):
+        """Bỏ bộ đệm đã hết hạn và bộ đệm ít dùng nhất khi vượt giới hạn số user hoặc tổng byte."""
+        now = time.monotonic()
+        while self._streams:
+            user_id, stream = next(iter(self._streams.items()))
+            if user_id == keep:
+                break
+            over_limit = len(self._streams) > self.max_users or self.total_bytes > self.max_total_bytes
+            if not over_limit and stream.touched + self.ttl > now:
+                break
+            del self._streams[user_id]
+            self.total_bytes -= stream.bytes
+            self.evicted_users += 1
+
+    def _stream(self, user_id: str) -> EventStream:
+        stream = self._streams.get(user_id)
+        if stream is not None and stream.touched + self.ttl <= time.monotonic():
+            del self._streams[user_id]
+            self.total_bytes -= stream.bytes
+            stream = None
+        if stream is None:
+            stream = EventStream()
+            self._streams[user_id] = stream
+        else:
+            # Gia hạn TTL của user còn nhận sự kiện
+            self._streams.move_to_end(user_id)
+        stream.touched = time.monotonic()
+        self._evict(keep=user_id)
+        return stream
+
+    def record(self, user_id: str, event: EncodedEvent) -> SequencedEvent:
+        """Gán seq tiếp theo của user cho sự kiện và lưu sự kiện gốc vào vòng đệm."""
+        stream = self._stream(user_id)
+        stream.seq += 1
+        size = len(event.text)
+        stream.events.append((stream.seq, event, size))
+        stream.bytes += size
+        self.total_bytes += size
+        while stream.events and (len(stream.events) > self.size or stream.bytes > self.max_user_bytes):
+            _, _, dropped = stream.events.popleft()
+            stream.bytes -= dropped
+            self.total_bytes -= dropped
+        self._evict(keep=user_id)
+        self.recorded += 1
+        return SequencedEvent(event, stream.seq)
+
+    def position(self, user_id: str) -> Tuple[str, int]:
+        """Epoch và seq mới nhất của user."""
+        stream = self._stream(user_id)
+        return stream.epoch, stream.seq
+
+    def missed(self, user_id: str, since: int, epoch: Optional[str], limit: int) -> Optional[List[SequencedEvent]]:
+        """
+        Các sự kiện có seq > since.
+        Trả về None nếu không thể phát lại đầy đủ (khác epoch, đã bị đẩy khỏi bộ đệm, hoặc nhiều hơn limit).
+        """
+        stream = self._stream(user_id)
+        if epoch != stream.epoch or since > stream.seq or since < 0:
+            self.resyncs += 1
+            return None
+        if since == stream.seq:
+            return []
+        oldest = stream.events[0][0] if stream.events else stream.seq + 1
+        if since + 1 < oldest or stream.seq - since > limit:
+            self.resyncs += 1
+            return None
+        events = [SequencedEvent(event, seq) for seq, event, _ in stream.events if seq > since]
+        self.replayed += len(events)
+        return events
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._streams),
+            "bufferSize": self.size,
+            "bytes": self.total_bytes,
+            "maxUserBytes": self.max_user_bytes,
+            "maxTotalBytes": self.max_total_bytes,
+            "recorded": self.recorded,
+            "replayed": self.replayed,
+            "resyncs": self.resyncs,
+            "evictedUsers": self.evicted_users,
+        }
@@ -2,5 +2,6 @@ from . import auth_router
 from . import message_router
 from . import post_router
 from . import user_router
+from . import ops_router
 
-__all__ = ["auth_router", "message_router", "post_router", "user_router"]
\ No newline at end of file
+__all__ = ["auth_router", "message_router", "post_router", "user_router", "ops_router"]
\ No newline at end of file
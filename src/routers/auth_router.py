@@ -1,9 +1,13 @@
-from fastapi import APIRouter, HTTPException, Depends, Body
+from fastapi import APIRouter, HTTPException, Depends, Body, Request
 from fastapi.security import OAuth2PasswordRequestForm
 from datetime import timedelta, datetime
 from typing import Optional
+import math
 from ..services import AuthService, jwt_service
-from ..security import get_current_user_id
+from ..services.session_service import SessionService
+from ..services.rate_limit_service import auth_admission, get_client_ip, RateLimitExceeded
+from ..security import get_current_user_id, get_current_session_id, get_principal
+from ..websocket import manager
 from ..schemas import (
     UserCreate,
     UserPublic,
@@ -20,12 +24,19 @@ from ..schemas import (
     UpdateEmailRequest,
     UpdateEmailResponse
 )
-from ..services.jwt_service import ACCESS_TOKEN_EXPIRE_MINUTES
 
 router = APIRouter(tags=["Auth"])
 
+def too_many_requests(error: RateLimitExceeded) -> HTTPException:
+    """Chuyển lỗi vượt giới hạn thành HTTP 429 kèm header Retry-After."""
+    return HTTPException(
+        status_code=429,
+        detail=str(error),
+        headers={"Retry-After": str(max(1, math.ceil(error.retry_after)))},
+    )
+
 @router.post("/register", response_model=UserPublic, status_code=201)
-async def register_user(user_data: UserCreate):
+async def register_user(user_data: UserCreate, http_request: Request):
     """
     Endpoint để đăng ký người dùng mới.
     - Nhận dữ liệu người dùng (tên người dùng, email, mật khẩu, tên hiển thị).
@@ -35,12 +46,13 @@ async def register_user(user_data: UserCreate):
     """
     try:
         # Gọi phương thức đăng ký người dùng bất đồng bộ từ service
-        new_user = await AuthService.register_user(
-            username=user_data.username,
-            email=user_data.email,
-            password=user_data.password,
-            displayName=user_data.displayName
-        )
+        async with auth_admission.guard("register", get_client_ip(http_request)):
+            new_user = await AuthService.register_user(
+                username=user_data.username,
+                email=user_data.email,
+                password=user_data.password,
+                displayName=user_data.displayName
+            )
         # Trả về thông tin người dùng công khai, chuyển đổi _id thành id
         return UserPublic(
             id=str(new_user.id),
@@ -48,12 +60,14 @@ async def register_user(user_data: UserCreate):
             email=new_user.email,
             displayName=new_user.displayName
         )
+    except RateLimitExceeded as e:
+        raise too_many_requests(e)
     except ValueError as e:
         # Nếu có lỗi giá trị (ví dụ: người dùng đã tồn tại), trả về lỗi 400
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/login")
-async def login_for_access_token(login_data: UserLogin):
+async def login_for_access_token(login_data: UserLogin, http_request: Request):
     """
     Endpoint để đăng nhập và nhận token truy cập.
     - Sử dụng UserLogin schema để nhận email, mật khẩu và device_token.
@@ -61,14 +75,16 @@ async def login_for_access_token(login_data: UserLogin):
     - Nếu xác thực thành công, tạo token JWT.
     - Trả về token truy cập và loại token.
     - Ném lỗi HTTP 401 nếu thông tin đăng nhập không chính xác.
+    - Ném lỗi HTTP 429 nếu vượt giới hạn đăng nhập theo IP/tài khoản.
     """
     try:
         # Xác thực người dùng bằng username và mật khẩu
-        user = await AuthService.login_user(
-            username=login_data.username,
-            password=login_data.password,
-            device_token=login_data.device_token
-        )
+        async with auth_admission.guard("login", get_client_ip(http_request), login_data.username):
+            user = await AuthService.login_user(
+                username=login_data.username,
+                password=login_data.password,
+                device_token=login_data.device_token
+            )
         if not user:
             # Nếu không tìm thấy người dùng hoặc mật khẩu sai, trả về lỗi 401
             raise HTTPException(
@@ -76,6 +92,8 @@ async def login_for_access_token(login_data: UserLogin):
                 detail="Tên đăng nhập hoặc mật khẩu không chính xác",
                 headers={"WWW-Authenticate": "Bearer"},
             )
+    except RateLimitExceeded as e:
+        raise too_many_requests(e)
     except ValueError as e:
         # Xử lý trường hợp tài khoản bị xóa
         raise HTTPException(
@@ -84,16 +102,13 @@ async def login_for_access_token(login_data: UserLogin):
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    # Tạo token truy cập với thời gian hết hạn
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = jwt_service.create_access_token(
-        data={"sub": str(user.id)}, expires_delta=access_token_expires
-    )
+    # Mỗi lần đăng nhập tạo một phiên (một họ refresh token) cho thiết bị
+    session = await SessionService.create(str(user.id), login_data.device_token)
+    sid = str(session.id)
 
-        # Tạo refresh token (phải dùng user.id giống access token)
-    refresh_token = jwt_service.create_refresh_token(
-        data={"sub": str(user.id)}
-    )
+    # Tạo token truy cập và refresh token gắn với phiên (phải dùng user.id)
+    access_token = SessionService.create_access_token(str(user.id), sid)
+    refresh_token = SessionService.create_refresh_token(str(user.id), sid, session.currentJti)
     
     # Trả về cả hai token
     return {
@@ -106,57 +121,52 @@ async def login_for_access_token(login_data: UserLogin):
 async def refresh_access_token(payload: RefreshTokenRequest):
     """
     Nhận một refresh token và trả về một access token mới.
+    Kiểm tra phiên bị thu hồi trong bộ nhớ và trạng thái user qua cache principal,
+    không cần đọc toàn bộ document User.
     """
     from bson import ObjectId
-    from ..models import User
     
     # Decode refresh token (dùng hàm decode_access_token vì logic giống nhau)
     token_data = jwt_service.decode_access_token(payload.refresh_token)
     
-    if not token_data or not token_data.username:
+    if not token_data or not token_data.username or not ObjectId.is_valid(token_data.username):
         raise HTTPException(
             status_code=401,
             detail="Refresh token không hợp lệ hoặc đã hết hạn",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    # Xác minh user vẫn tồn tại trong database
-    try:
-        user_id = ObjectId(token_data.username)  # token_data.username chứa user ID
-        user = await User.find_one(User.id == user_id)
-        if not user:
-            raise HTTPException(
-                status_code=401,
-                detail="User không tồn tại",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        
-        # Kiểm tra nếu tài khoản đã bị xóa
-        if user.status == 'deleted':
-            raise HTTPException(
-                status_code=403,
-                detail="Tài khoản đã bị xóa. Vui lòng liên hệ hỗ trợ nếu cần khôi phục.",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-    except HTTPException:
-        raise
-    except Exception:
+    # Xác minh user vẫn tồn tại (token_data.username chứa user ID)
+    user = await get_principal(token_data.username)
+    if not user:
         raise HTTPException(
             status_code=401,
-            detail="Refresh token không hợp lệ",
+            detail="User không tồn tại",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    # Tạo access token mới với user ID (không phải username)
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    new_access_token = jwt_service.create_access_token(
-        data={"sub": str(user.id)}, expires_delta=access_token_expires
-    )
+    # Kiểm tra nếu tài khoản đã bị xóa
+    if user.status == 'deleted':
+        raise HTTPException(
+            status_code=403,
+            detail="Tài khoản đã bị xóa. Vui lòng liên hệ hỗ trợ nếu cần khôi phục.",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     
-    return {"access_token": new_access_token, "token_type": "bearer"}
+    try:
+        tokens = await SessionService.refresh(token_data.username, token_data.sid, token_data.jti)
+    except PermissionError as e:
+        raise HTTPException(
+            status_code=401,
+            detail=str(e),
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    
+    # refresh_token chỉ có khi bật xoay vòng, client phải lưu lại token mới
+    return {**tokens, "token_type": "bearer"}
 
 @router.post("/send-otp", response_model=SendOTPResponse)
-async def send_otp(request: SendOTPRequest):
+async def send_otp(request: SendOTPRequest, http_request: Request):
     """
     Endpoint để gửi mã OTP qua email.
     - Nhận username hoặc email của người dùng
@@ -165,16 +175,19 @@ async def send_otp(request: SendOTPRequest):
     - OTP có hiệu lực trong 5 phút
     """
     try:
-        result = await AuthService.send_otp(request.identifier)
+        async with auth_admission.guard("send-otp", get_client_ip(http_request), request.identifier):
+            result = await AuthService.send_otp(request.identifier)
         return SendOTPResponse(
             message=result["message"],
             email=result["email"]
         )
+    except RateLimitExceeded as e:
+        raise too_many_requests(e)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/verify-otp", response_model=VerifyOTPResponse)
-async def verify_otp(request: VerifyOTPRequest):
+async def verify_otp(request: VerifyOTPRequest, http_request: Request):
     """
     Endpoint để xác minh mã OTP.
     - Nhận email và mã OTP
@@ -182,16 +195,19 @@ async def verify_otp(request: VerifyOTPRequest):
     - Đánh dấu OTP đã sử dụng sau khi xác minh thành công
     """
     try:
-        result = await AuthService.verify_otp(request.email, request.otp_code)
+        async with auth_admission.guard("verify-otp", get_client_ip(http_request), request.email):
+            result = await AuthService.verify_otp(request.email, request.otp_code)
         return VerifyOTPResponse(
             message=result["message"],
             email=result["email"]
         )
+    except RateLimitExceeded as e:
+        raise too_many_requests(e)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/reset-password", response_model=ResetPasswordResponse)
-async def reset_password(request: ResetPasswordRequest):
+async def reset_password(request: ResetPasswordRequest, http_request: Request):
     """
     Endpoint để đặt lại mật khẩu mới sau khi xác minh OTP.
     - Nhận email và mật khẩu mới
@@ -199,15 +215,18 @@ async def reset_password(request: ResetPasswordRequest):
     - Hash mật khẩu mới và cập nhật
     """
     try:
-        result = await AuthService.reset_password(request.email, request.new_password)
+        async with auth_admission.guard("reset-password", get_client_ip(http_request), request.email):
+            result = await AuthService.reset_password(request.email, request.new_password)
         return ResetPasswordResponse(
             message=result["message"]
         )
+    except RateLimitExceeded as e:
+        raise too_many_requests(e)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/change-email/verify-password", response_model=ChangeEmailVerifyPasswordResponse)
-async def change_email_verify_password(request: ChangeEmailVerifyPasswordRequest):
+async def change_email_verify_password(request: ChangeEmailVerifyPasswordRequest, http_request: Request):
     """
     Endpoint để xác minh mật khẩu và gửi OTP đến email mới.
     - Nhận user_id, email mới và mật khẩu
@@ -215,15 +234,18 @@ async def change_email_verify_password(request: ChangeEmailVerifyPasswordRequest
     - Gửi OTP đến email mới
     """
     try:
-        result = await AuthService.change_email_verify_password(
-            request.user_id,
-            request.new_email,
-            request.password
-        )
+        async with auth_admission.guard("change-email", get_client_ip(http_request), request.user_id):
+            result = await AuthService.change_email_verify_password(
+                request.user_id,
+                request.new_email,
+                request.password
+            )
         return ChangeEmailVerifyPasswordResponse(
             message=result["message"],
             email=result["email"]
         )
+    except RateLimitExceeded as e:
+        raise too_many_requests(e)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -252,10 +274,12 @@ async def update_email(request: UpdateEmailRequest):
 @router.post("/logout", status_code=200)
 async def logout_user(
     request: dict = Body(...),
-    user_id: str = Depends(get_current_user_id)
+    user_id: str = Depends(get_current_user_id),
+    session_id: Optional[str] = Depends(get_current_session_id)
 ):
     """
     Endpoint để đăng xuất người dùng.
+    - Thu hồi phiên hiện tại (refresh token của thiết bị không dùng được nữa)
     - Xóa device token của thiết bị hiện tại khỏi danh sách deviceTokens của user
     - Chỉ xóa token được gửi đến (nếu có), không xóa tất cả tokens
     - Trả về 200 nếu thành công
@@ -265,30 +289,37 @@ async def logout_user(
         from ..models import User
         
         device_token = request.get("device_token")
+        refresh_token = request.get("refresh_token")
         
-        # Tìm user theo ID
-        user = await User.find_one(User.id == ObjectId(user_id))
-        if not user:
+        # Kiểm tra user tồn tại (qua cache principal)
+        if await get_principal(user_id) is None:
             raise HTTPException(
                 status_code=404,
                 detail="Không tìm thấy người dùng"
             )
         
+        # Phiên cần thu hồi: lấy từ access token, hoặc từ refresh token được gửi kèm
+        if not session_id and refresh_token:
+            refresh_data = jwt_service.decode_access_token(refresh_token)
+            if refresh_data and refresh_data.username == user_id:
+                session_id = refresh_data.sid
+        
+        if session_id:
+            await SessionService.revoke(session_id)
+        
         # Nếu có device_token được gửi đến, xóa nó khỏi list
         if device_token and device_token.strip():
-            # Đảm bảo deviceTokens là list
-            if user.deviceTokens is None:
-                user.deviceTokens = []
+            if not session_id:
+                # Token cũ không có sid: thu hồi các phiên gắn với thiết bị này
+                await SessionService.revoke_by_device(user_id, device_token.strip())
             
-            # Xóa device token nếu có trong list
-            if device_token in user.deviceTokens:
-                user.deviceTokens.remove(device_token)
-                
-                # Save user với updatedAt
-                user.updatedAt = datetime.utcnow() + timedelta(hours=7)
-                
-                # Sử dụng replace() thay vì save() để đảm bảo update được ghi vào database
-                await user.replace()
+            # Xóa device token bằng một lệnh $pull, không ghi lại toàn bộ document
+            await User.find_one({"_id": ObjectId(user_id), "deviceTokens": device_token}).update({
+                "$pull": {"deviceTokens": device_token},
+                "$set": {"updatedAt": datetime.utcnow() + timedelta(hours=7)}
+            })
+            # Cập nhật theo truy vấn không chạy hook after_event của User
+            manager.invalidate("principal", user_id)
         
         return {"message": "Đăng xuất thành công"}
     except HTTPException:
@@ -297,4 +328,4 @@ async def logout_user(
         raise HTTPException(
             status_code=500,
             detail=f"Lỗi khi đăng xuất: {str(e)}"
-        )
\ No newline at end of file
+        )
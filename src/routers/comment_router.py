@@ -2,7 +2,7 @@ from fastapi import APIRouter, Depends, HTTPException, Body
 from typing import List
 from ..services import CommentService
 from ..schemas import CommentPublic, CommentCreate
-from ..models import User
+from ..models import UserPrincipal
 from ..security import get_current_user
 
 router = APIRouter(tags=["Comment"])
@@ -11,7 +11,7 @@ router = APIRouter(tags=["Comment"])
 async def create_comment(
     post_id: str,
     comment_data: CommentCreate,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Tạo một bình luận mới cho bài đăng. Yêu cầu xác thực người dùng."""
     try:
@@ -38,7 +38,7 @@ async def get_comments(
     post_id: str,
     skip: int = 0,
     limit: int = 50,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Lấy danh sách bình luận của một bài đăng."""
     try:
@@ -54,7 +54,7 @@ async def get_comments(
 @router.get("/posts/{post_id}/comments/count")
 async def get_comment_count(
     post_id: str,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Lấy tổng số bình luận của một bài đăng."""
     try:
@@ -66,7 +66,7 @@ async def get_comment_count(
 @router.delete("/comments/{comment_id}", status_code=200)
 async def delete_comment(
     comment_id: str,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Xóa một bình luận. Chỉ tác giả bình luận hoặc tác giả bài đăng mới có quyền xóa."""
     try:
@@ -84,7 +84,7 @@ async def delete_comment(
 async def update_comment(
     comment_id: str,
     comment_data: CommentCreate,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Cập nhật bình luận. Chỉ tác giả bình luận mới có quyền chỉnh sửa."""
     try:
@@ -1,14 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, Form, File, UploadFile, Body
+from fastapi import APIRouter, Depends, HTTPException, Form, File, UploadFile, Body, Query, Response
 from typing import List, Optional
 from pydantic import BaseModel
-from ..services import MessageService
+from fastapi.responses import StreamingResponse
+from ..services import MessageService, InboxService
+from ..realtime import encode_event
 from ..schemas import (
     ConversationCreate,
     ConversationPublic,
     ConversationWithParticipants,
-    SimpleMessagePublic
+    InboxEntryPublic,
+    SimpleMessagePublic,
+    UnreadSummaryPublic
 )
-from ..models import User
+from ..models import UserPrincipal
 from ..security import get_current_user
 from ..utils import map_conversation_to_public_dict, map_message_to_public_dict
 
@@ -19,7 +23,7 @@ router = APIRouter(tags=["Chat"])
 @router.post("/conversations", response_model=ConversationPublic, status_code=201)
 async def get_or_create_conversation(
     convo_data: ConversationCreate,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Lấy hoặc tạo một cuộc trò chuyện mới giữa những người tham gia."""
     participant_ids = set(convo_data.participant_ids)
@@ -37,95 +41,90 @@ async def get_or_create_conversation(
 
 @router.get("/conversations", response_model=List[ConversationWithParticipants])
 async def get_user_conversations(
-    current_user: User = Depends(get_current_user),
+    response: Response,
+    current_user: UserPrincipal = Depends(get_current_user),
+    limit: Optional[int] = Query(None, ge=1, le=200),
+    cursor: Optional[str] = None
 ):
-    """Lấy danh sách các cuộc trò chuyện của người dùng đã được xác thực."""
-    convos = await MessageService.get_conversations_for_user(
-        user_id=str(current_user.id),
-    )
+    """
+    Lấy danh sách các cuộc trò chuyện của người dùng đã được xác thực (mới cập nhật nhất trước).
+    Khi có limit và còn trang sau, header X-Next-Cursor chứa cursor cho request tiếp theo.
+    """
+    try:
+        convos = await MessageService.get_conversations_for_user(
+            user_id=str(current_user.id),
+            limit=limit,
+            cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if limit and len(convos) == limit:
+        response.headers["X-Next-Cursor"] = MessageService.conversation_cursor(convos[-1])
 
     return convos
 
+@router.get("/inbox", response_model=List[InboxEntryPublic])
+async def get_inbox(
+    response: Response,
+    current_user: UserPrincipal = Depends(get_current_user),
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[str] = None,
+    stream: bool = False
+):
+    """
+    Hộp thư của người dùng (mới cập nhật nhất trước), đọc từ bảng inbox đã dựng sẵn.
+    stream=true trả về NDJSON (mỗi dòng một hội thoại) để client hiển thị dần.
+    Khi có limit và còn trang sau, header X-Next-Cursor chứa cursor cho request tiếp theo.
+    """
+    user_id = str(current_user.id)
+    try:
+        if stream:
+            # Kiểm tra cursor trước khi bắt đầu stream để lỗi trả về đúng mã 400
+            InboxService.inbox_query(user_id, cursor)
+
+            async def lines():
+                async for entry in InboxService.stream_inbox(user_id, cursor):
+                    yield encode_event(InboxEntryPublic.model_validate(entry).model_dump()) + "\n"
+
+            return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+        entries = await InboxService.get_inbox(user_id, limit=limit, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if limit and len(entries) == limit:
+        response.headers["X-Next-Cursor"] = InboxService.entry_cursor(entries[-1])
+    return entries
+
+@router.get("/unread", response_model=UnreadSummaryPublic)
+async def get_unread(current_user: UserPrincipal = Depends(get_current_user)):
+    """
+    Tổng số tin nhắn chưa đọc và số chưa đọc theo từng hội thoại (chỉ các hội thoại còn tin chưa đọc).
+    """
+    return await InboxService.get_unread(str(current_user.id))
+
 @router.get("/conversations/{conversation_id}", response_model=ConversationWithParticipants)
 async def get_conversation_by_id(
     conversation_id: str,
-    current_user: User = Depends(get_current_user),
+    current_user: UserPrincipal = Depends(get_current_user),
 ):
     """Lấy thông tin một cuộc trò chuyện theo ID."""
     try:
-        # Thử tìm conversation trong danh sách của user trước (có đầy đủ thông tin)
-        convos = await MessageService.get_conversations_for_user(
-            user_id=str(current_user.id),
-        )
-        
-        # Tìm conversation trong danh sách để có đầy đủ thông tin participants
-        # convos là list của ConversationWithParticipants objects, không phải dict
-        for convo in convos:
-            if convo.id == conversation_id:
-                return convo
-        
-        # Nếu không tìm thấy trong danh sách, thử lấy trực tiếp từ DB
-        conversation = await MessageService.get_conversation_by_id(conversation_id)
-        if not conversation:
-            raise HTTPException(status_code=404, detail="Không tìm thấy cuộc trò chuyện.")
-        
-        # Kiểm tra quyền truy cập
-        participant_ids = [p.userId for p in conversation.participants]
-        if str(current_user.id) not in participant_ids:
-            raise HTTPException(status_code=403, detail="Bạn không có quyền truy cập cuộc trò chuyện này.")
-        
-        # Nếu conversation tồn tại nhưng không có trong danh sách (có thể bị xóa)
-        # Vẫn trả về để user có thể mở lại
-        # Nhưng cần tạo ConversationWithParticipants đầy đủ
-        # Lấy thông tin participants
-        from ..services.user_service import UserService
-        participants = await UserService.get_users_by_ids([p.userId for p in conversation.participants])
-        participants_map = {str(p.id): p for p in participants}
-        
-        participant_publics = []
-        for participant_info in conversation.participants:
-            participant_user = participants_map.get(participant_info.userId)
-            if participant_user and participant_user.status != 'deleted':
-                from ..schemas.user_schema import UserPublic
-                participant_publics.append(
-                    UserPublic(
-                        id=str(participant_user.id),
-                        username=participant_user.username,
-                        email=participant_user.email,
-                        displayName=participant_user.displayName,
-                        avatarUrl=participant_user.avatarUrl,
-                        backgroundUrl=participant_user.backgroundUrl,
-                        bio=participant_user.bio
-                    )
-                )
-        
-        # Tạo ConversationWithParticipants
-        from ..schemas.message_schema import ConversationWithParticipants
-        from ..models.conversation import ParticipantInfo
-        
-        return ConversationWithParticipants(
-            id=str(conversation.id),
-            participantsInfo=conversation.participants,
-            participants=participant_publics,
-            lastMessage=conversation.lastMessage.model_dump() if conversation.lastMessage else None,
-            updatedAt=conversation.updatedAt,
-            seenIds=conversation.seenIds,
-            isGroup=conversation.isGroup,
-            name=conversation.name,
-            avatarUrl=conversation.avatarUrl
+        return await MessageService.get_conversation_for_user(
+            conversation_id=conversation_id,
+            user_id=str(current_user.id)
         )
-    except HTTPException as e:
-        raise e
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
 
 
 @router.post("/conversations/{conversation_id}/messages")
 async def send_message(
     conversation_id: str,
-    current_user: User = Depends(get_current_user),
+    current_user: UserPrincipal = Depends(get_current_user),
     type: str = Form(...),
     files: Optional[List[UploadFile]] = None,
     text: str = Form(None)
@@ -153,26 +152,38 @@ async def send_message(
 @router.get("/conversations/{conversation_id}/messages", response_model=List[SimpleMessagePublic])
 async def get_conversation_messages(
     conversation_id: str,
-    current_user: User = Depends(get_current_user),
+    current_user: UserPrincipal = Depends(get_current_user),
     skip: int = 0,
-    limit: int = 50
+    limit: int = 50,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    around: Optional[str] = None
 ):
-    """Lấy danh sách các tin nhắn trong một cuộc trò chuyện với thông tin đơn giản."""
+    """
+    Lấy danh sách các tin nhắn trong một cuộc trò chuyện với thông tin đơn giản (mới nhất trước).
+    Trang tiếp theo (cũ hơn): before=<id tin nhắn cuối trong trang>; tin mới hơn: after=<id>;
+    nhảy tới tin nhắn: around=<id>.
+    """
     try:
         messages = await MessageService.get_messages_for_conversation(
             conversation_id=conversation_id,
             user_id=str(current_user.id),
             skip=skip,
-            limit=limit
+            limit=limit,
+            before=before,
+            after=after,
+            around=around
         )
         return messages
     except PermissionError as e:
         raise HTTPException(status_code=403, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
 @router.post("/conversations/{conversation_id}/seen", status_code=204)
 async def mark_conversation_as_seen(
     conversation_id: str,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Đánh dấu cuộc trò chuyện là đã xem bởi người dùng hiện tại."""
     try:
@@ -188,7 +199,7 @@ async def mark_conversation_as_seen(
 @router.post("/messages/{message_id}/recall", status_code=200)
 async def recall_message(
     message_id: str,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Thu hồi một tin nhắn đã gửi."""
     try:
@@ -205,7 +216,7 @@ async def recall_message(
 @router.delete("/conversations/{conversation_id}", status_code=204)
 async def delete_conversation(
     conversation_id: str,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """
     Xóa một cuộc trò chuyện bằng cách cập nhật ParticipantInfo của người dùng hiện tại.
@@ -228,7 +239,7 @@ class UpdateGroupNameRequest(BaseModel):
 async def update_group_avatar(
     conversation_id: str,
     avatar: UploadFile = File(...),
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Cập nhật ảnh đại diện của nhóm."""
     try:
@@ -250,7 +261,7 @@ async def update_group_avatar(
 async def update_group_name(
     conversation_id: str,
     request: UpdateGroupNameRequest,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Cập nhật tên nhóm."""
     try:
@@ -272,7 +283,7 @@ class UpdateGroupAvatarRequest(BaseModel):
 async def update_group_avatar(
     conversation_id: str,
     request: UpdateGroupAvatarRequest,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Cập nhật ảnh đại diện nhóm."""
     try:
@@ -290,7 +301,7 @@ async def update_group_avatar(
 @router.post("/conversations/{conversation_id}/leave")
 async def leave_group(
     conversation_id: str,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Rời khỏi nhóm."""
     try:
@@ -308,7 +319,7 @@ async def leave_group(
 async def add_member_to_group(
     conversation_id: str,
     request: dict,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Thêm thành viên vào nhóm."""
     try:
@@ -334,7 +345,7 @@ class MuteConversationRequest(BaseModel):
 async def toggle_mute_conversation(
     conversation_id: str,
     request: MuteConversationRequest,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Bật/tắt thông báo cho conversation."""
     try:
@@ -0,0 +1,22 @@
+from fastapi import APIRouter, Depends
+from ..services import jwt_service
+from ..services.password_hasher import password_hasher
+from ..services.email_service import email_pool
+from ..services.rate_limit_service import auth_admission
+from ..security import require_ops_token
+from ..websocket import manager
+
+router = APIRouter(dependencies=[Depends(require_ops_token)])
+
+@router.get("/stats")
+async def get_ops_stats():
+    """
+    Thống kê vận hành của process hiện tại (chỉ dành cho vận hành, cần header X-Ops-Token).
+    """
+    return {
+        "passwordHasher": password_hasher.stats(),
+        "tokenCache": jwt_service.get_token_cache_stats(),
+        "emailPool": email_pool.stats(),
+        "authAdmission": auth_admission.stats(),
+        "websocket": manager.stats(),
+    }
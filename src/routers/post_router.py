@@ -2,14 +2,14 @@ from fastapi import APIRouter, Depends, HTTPException, Form, File, UploadFile, B
 from typing import List, Optional
 from ..services import PostService
 from ..schemas import PostPublic, ReactionCreate
-from ..models import User
+from ..models import UserPrincipal
 from ..security import get_current_user
 
 router = APIRouter(tags=["Post"])
 
 @router.post("", response_model=PostPublic, status_code=201)
 async def create_post(
-    current_user: User = Depends(get_current_user),
+    current_user: UserPrincipal = Depends(get_current_user),
     content: str = Form(""),
     files: List[UploadFile] = File(default=[])
 ):
@@ -51,7 +51,7 @@ async def create_post(
 async def get_post_feed(
     skip: int = 0, 
     limit: int = 20,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Lấy một nguồn cấp dữ liệu (feed) các bài đăng của bạn bè."""
     # Lấy danh sách bài đăng một cách bất đồng bộ
@@ -68,7 +68,7 @@ async def get_user_posts(
     user_id: str,
     skip: int = 0,
     limit: int = 20,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Lấy danh sách các bài đăng của một người dùng cụ thể."""
     try:
@@ -81,7 +81,7 @@ async def get_user_posts(
 async def react_to_post(
     post_id: str,
     reaction_data: ReactionCreate,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Thêm hoặc thay đổi một phản ứng (reaction) cho một bài đăng. Yêu cầu xác thực."""
     try:
@@ -111,7 +111,7 @@ async def update_post(
     content: str = Form(...),
     existing_image_urls: Optional[List[str]] = Form(None),
     files: Optional[List[UploadFile]] = File(None),
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Cập nhật bài đăng. Chỉ tác giả mới có quyền chỉnh sửa."""
     try:
@@ -143,7 +143,7 @@ async def update_post(
 @router.delete("/{post_id}", status_code=200)
 async def delete_post(
     post_id: str,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Xóa một bài đăng. Chỉ tác giả của bài đăng mới có quyền xóa."""
     try:
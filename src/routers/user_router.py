@@ -1,11 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException, Query, UploadFile, File, Body, Form
-from typing import List
+from typing import List, Optional
 from ..services import UserService
 from ..schemas import FriendRequestCreate, FriendRequestResponse, UserPublic, UserUpdate, UserSearchResult
 from ..schemas.block_schema import BlockUserRequest
 from ..schemas import FriendRequestPublic
-from ..models import User
+from ..models import User, UserPrincipal
 from ..security import get_current_user
+from ..realtime import get_friend_ids
+from ..websocket import manager
 
 router = APIRouter(tags=["User"])
 
@@ -13,7 +15,7 @@ router = APIRouter(tags=["User"])
 @router.post("/batch", response_model=List[UserPublic])
 async def get_users_by_ids(
     request: dict,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """Lấy thông tin nhiều người dùng theo danh sách ID."""
     try:
@@ -42,18 +44,23 @@ async def get_users_by_ids(
 
 # Lấy hồ sơ của người dùng hiện tại
 @router.get("/me", response_model=UserPublic)
-async def read_users_me(current_user: User = Depends(get_current_user)):
+async def read_users_me(current_user: UserPrincipal = Depends(get_current_user)):
     """
     Lấy hồ sơ của người dùng hiện được xác thực.
     """
+    # Principal chỉ chứa các trường xác thực, cần đọc đầy đủ hồ sơ từ DB
+    user = await User.get(current_user.id)
+    if not user:
+        raise HTTPException(status_code=404, detail="Không tìm thấy người dùng.")
+
     return UserPublic(
-        id=str(current_user.id),
-        username=current_user.username,
-        email=current_user.email,
-        displayName=current_user.displayName,
-        avatarUrl=current_user.avatarUrl,
-        backgroundUrl=current_user.backgroundUrl,
-        bio=current_user.bio
+        id=str(user.id),
+        username=user.username,
+        email=user.email,
+        displayName=user.displayName,
+        avatarUrl=user.avatarUrl,
+        backgroundUrl=user.backgroundUrl,
+        bio=user.bio
     )
 
 # Cập nhật hồ sơ của người dùng hiện tại
@@ -63,7 +70,7 @@ async def update_user_me(
     bio: str = Form(None),
     avatar: UploadFile = File(None),
     background: UploadFile = File(None),
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """
     Cập nhật hồ sơ của người dùng hiện tại.
@@ -81,7 +88,7 @@ async def update_user_me(
         user_update = UserUpdate(**user_update_data)
         
         # Upload files nếu có và cập nhật text fields cùng lúc
-        updated_user = current_user
+        updated_user = None
         
         if avatar:
             updated_user = await UserService.update_user_avatar(
@@ -98,10 +105,16 @@ async def update_user_me(
         # Cập nhật text fields nếu có
         if displayName is not None or bio is not None:
             updated_user = await UserService.update_user(
-                user_id=str(updated_user.id),
+                user_id=str(current_user.id),
                 user_update=user_update
             )
         
+        # Không có gì thay đổi: đọc hồ sơ hiện tại để trả về
+        if updated_user is None:
+            updated_user = await User.get(current_user.id)
+            if not updated_user:
+                raise ValueError("Không tìm thấy người dùng.")
+        
         return {
             "message": "Cập nhật thành công.",
             "user": {
@@ -121,7 +134,7 @@ async def update_user_me(
 @router.post("/friend-request", status_code=201)
 async def send_friend_request(
     request_data: FriendRequestCreate,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     try:
         to_user_id = request_data.to_user_id
@@ -138,7 +151,7 @@ async def send_friend_request(
 @router.delete("/friend-request/{user_id}", status_code=200)
 async def cancel_friend_request(
     user_id: str,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     try:
         result = await UserService.cancel_friend_request(str(current_user.id), user_id)
@@ -151,7 +164,7 @@ async def cancel_friend_request(
 async def respond_to_friend_request(
     request_id: str,
     response_data: FriendRequestResponse,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     try:
         await UserService.respond_to_friend_request(
@@ -168,7 +181,7 @@ async def respond_to_friend_request(
 async def respond_to_friend_request_by_user(
     from_user_id: str,
     response_data: FriendRequestResponse,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     try:
         await UserService.respond_to_friend_request_by_from_user(
@@ -182,7 +195,7 @@ async def respond_to_friend_request_by_user(
 
 # Lấy danh sách lời mời kết bạn đang chờ
 @router.get("/friend-requests/pending")
-async def get_pending_friend_requests(current_user: User = Depends(get_current_user)):
+async def get_pending_friend_requests(current_user: UserPrincipal = Depends(get_current_user)):
     """
     Lấy danh sách các lời mời kết bạn đang chờ xử lý cho người dùng hiện tại.
     """
@@ -195,7 +208,7 @@ async def get_pending_friend_requests(current_user: User = Depends(get_current_u
 
 # Lấy danh sách bạn bè
 @router.get("/friends")
-async def get_friends(current_user: User = Depends(get_current_user)):
+async def get_friends(current_user: UserPrincipal = Depends(get_current_user)):
     """
     Lấy danh sách bạn bè cho người dùng hiện được xác thực.
     """
@@ -213,9 +226,26 @@ async def get_friends(current_user: User = Depends(get_current_user)):
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
+# Trạng thái online của bạn bè
+@router.get("/presence")
+async def get_friends_presence(
+    ids: Optional[str] = Query(None, description="Danh sách ID cách nhau bởi dấu phẩy (mặc định: tất cả bạn bè)"),
+    current_user: UserPrincipal = Depends(get_current_user)
+):
+    """
+    Lấy trạng thái online/offline của bạn bè, trả lời từ bộ nhớ.
+    Chỉ trả về trạng thái của những người là bạn bè của người dùng hiện tại.
+    """
+    user_id = str(current_user.id)
+    friend_ids = (await get_friend_ids([user_id]))[user_id]
+    if ids:
+        allowed = set(friend_ids)
+        friend_ids = [fid for fid in dict.fromkeys(i.strip() for i in ids.split(",")) if fid in allowed]
+    return manager.presence.snapshot(friend_ids)
+
 # Tìm kiếm người dùng
 @router.get("/search")
-async def search_users(query: str = Query(..., min_length=1), current_user: User = Depends(get_current_user)):
+async def search_users(query: str = Query(..., min_length=1), current_user: UserPrincipal = Depends(get_current_user)):
     """
     Tìm kiếm người dùng theo username hoặc displayName.
     """
@@ -245,7 +275,7 @@ async def search_users(query: str = Query(..., min_length=1), current_user: User
 
 # Lấy hồ sơ công khai của người dùng
 @router.get("/{user_id}")
-async def get_user_profile(user_id: str, current_user: User = Depends(get_current_user)):
+async def get_user_profile(user_id: str, current_user: UserPrincipal = Depends(get_current_user)):
     """
     Lấy hồ sơ công khai của bất kỳ người dùng nào.
     """
@@ -257,7 +287,7 @@ async def get_user_profile(user_id: str, current_user: User = Depends(get_curren
 
 # Chặn người dùng
 @router.post("/block", status_code=200)
-async def block_user(request: BlockUserRequest, current_user: User = Depends(get_current_user)):
+async def block_user(request: BlockUserRequest, current_user: UserPrincipal = Depends(get_current_user)):
     try:
         result = await UserService.block_user(str(current_user.id), request.user_id)
         return result
@@ -266,7 +296,7 @@ async def block_user(request: BlockUserRequest, current_user: User = Depends(get
 
 # Bỏ chặn người dùng
 @router.post("/unblock", status_code=200)
-async def unblock_user(request: BlockUserRequest, current_user: User = Depends(get_current_user)):
+async def unblock_user(request: BlockUserRequest, current_user: UserPrincipal = Depends(get_current_user)):
     try:
         result = await UserService.unblock_user(str(current_user.id), request.user_id)
         return result
@@ -275,7 +305,7 @@ async def unblock_user(request: BlockUserRequest, current_user: User = Depends(g
 
 # Lấy danh sách người dùng bị chặn
 @router.get("/blocked-lists/{user_id}")
-async def get_blocked_users(user_id: str, current_user: User = Depends(get_current_user)):
+async def get_blocked_users(user_id: str, current_user: UserPrincipal = Depends(get_current_user)):
     """
     Lấy danh sách người dùng bị chặn của người dùng hiện tại.
     """
@@ -292,7 +322,7 @@ async def get_blocked_users(user_id: str, current_user: User = Depends(get_curre
 @router.get("/block-status/{other_user_id}")
 async def check_block_status(
     other_user_id: str,
-    current_user: User = Depends(get_current_user)
+    current_user: UserPrincipal = Depends(get_current_user)
 ):
     """
     Kiểm tra trạng thái block giữa current_user và other_user_id.
@@ -308,7 +338,7 @@ async def check_block_status(
 
 # Kiểm tra trạng thái kết bạn
 @router.get("/{user_id}/friend-status")
-async def check_friend_status(user_id: str, current_user: User = Depends(get_current_user)):
+async def check_friend_status(user_id: str, current_user: UserPrincipal = Depends(get_current_user)):
     """
     Kiểm tra trạng thái kết bạn giữa người dùng hiện tại và người dùng khác.
     """
@@ -320,7 +350,7 @@ async def check_friend_status(user_id: str, current_user: User = Depends(get_cur
 
 # Hủy kết bạn
 @router.post("/{user_id}/unfriend", status_code=200)
-async def unfriend_user(user_id: str, current_user: User = Depends(get_current_user)):
+async def unfriend_user(user_id: str, current_user: UserPrincipal = Depends(get_current_user)):
     """
     Hủy kết bạn với một người dùng.
     """
@@ -332,7 +362,7 @@ async def unfriend_user(user_id: str, current_user: User = Depends(get_current_u
 
 # Xóa tài khoản (soft delete)
 @router.delete("/me", status_code=200)
-async def delete_account(current_user: User = Depends(get_current_user)):
+async def delete_account(current_user: UserPrincipal = Depends(get_current_user)):
     """
     Xóa tài khoản người dùng (soft delete).
     Đổi status thành 'deleted' thay vì xóa khỏi database.
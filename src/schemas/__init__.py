@@ -21,7 +21,9 @@ from .message_schema import (
     MessagePublic,
     LastMessagePublic,
     SimpleMessagePublic,
-    ConversationWithParticipants
+    ConversationWithParticipants,
+    InboxEntryPublic,
+    UnreadSummaryPublic
 )
 from .post_schema import PostCreate, PostPublic, ReactionCreate
 from .user_schema import FriendRequestCreate, FriendRequestResponse, FriendRequestPublic, UserUpdate, UserSearchResult
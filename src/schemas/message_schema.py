@@ -76,3 +76,24 @@ class ConversationWithParticipants(BaseModel):
         json_encoders = {
             datetime: lambda dt: dt.isoformat()
         }
+
+class InboxEntryPublic(BaseModel):
+    conversationId: str
+    isGroup: bool = False
+    name: str | None = None
+    avatarUrl: str | None = None
+    peerId: str | None = None
+    lastMessage: Optional[LastMessagePublic] = None
+    updatedAt: datetime
+    unreadCount: int = 0
+    muted: bool = False
+
+    class Config:
+        from_attributes = True
+        json_encoders = {
+            datetime: lambda dt: dt.isoformat()
+        }
+
+class UnreadSummaryPublic(BaseModel):
+    total: int = 0
+    conversations: Dict[str, int] = {}
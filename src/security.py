@@ -1,8 +1,16 @@
+import hmac
+import logging
+import os
+from typing import Optional
 from bson import ObjectId
-from fastapi import Depends, HTTPException, status, WebSocket
+from fastapi import Depends, Header, HTTPException, status, WebSocket
 from fastapi.security import OAuth2PasswordBearer
 from .services import jwt_service
-from .models import User
+from .services.session_service import revoked_sessions
+from .models import User, UserPrincipal
+from .utils import TTLCache
+
+logger = logging.getLogger(__name__)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
@@ -12,29 +20,66 @@ credentials_exception = HTTPException(
     headers={"WWW-Authenticate": "Bearer"},
 )
 
-async def get_user_from_token(token: str) -> User:
-    import logging
-    logger = logging.getLogger(__name__)
-    
+# Cache principal (projection gọn của User) để xác thực không cần truy vấn Mongo mỗi request
+PRINCIPAL_CACHE_TTL_SECONDS = int(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", 300))
+PRINCIPAL_CACHE_MAX_SIZE = int(os.getenv("PRINCIPAL_CACHE_MAX_SIZE", 10000))
+
+# TTL khi chạy nhiều worker/node: giới hạn thời gian dùng principal cũ nếu thông điệp xóa cache qua backplane bị mất
+PRINCIPAL_CACHE_DISTRIBUTED_TTL_SECONDS = int(os.getenv("PRINCIPAL_CACHE_DISTRIBUTED_TTL_SECONDS", 30))
+
+principal_cache = TTLCache(maxsize=PRINCIPAL_CACHE_MAX_SIZE, ttl=PRINCIPAL_CACHE_TTL_SECONDS)
+
+# Token cho các endpoint vận hành (thống kê nội bộ); để trống thì các endpoint này bị tắt
+OPS_METRICS_TOKEN = os.getenv("OPS_METRICS_TOKEN", "")
+
+def invalidate_principal(user_id: str):
+    """
+    Xóa principal của user khỏi cache tại process này.
+    Service gọi manager.invalidate("principal", user_id) để xóa trên mọi worker/node.
+    """
+    principal_cache.invalidate(str(user_id))
+
+async def get_principal(user_id: str) -> Optional[UserPrincipal]:
+    """
+    Lấy principal của user từ cache, nếu chưa có thì chỉ đọc các trường cần thiết từ DB.
+    """
+    principal = principal_cache.get(user_id)
+    if principal is not None:
+        return principal
+
+    principal = await User.find_one(User.id == ObjectId(user_id)).project(UserPrincipal)
+    if principal is not None:
+        principal_cache.set(user_id, principal)
+    return principal
+
+def get_user_id_from_token(token: str) -> str:
+    """Giải mã token và trả về user ID (không truy vấn cơ sở dữ liệu)."""
+    token_data = jwt_service.decode_access_token(token)
+    if not token_data or not token_data.username:
+        logger.error(f"Token decode failed or missing username: {token_data}")
+        raise credentials_exception
+
+    # Kiểm tra định dạng ObjectId
+    if not ObjectId.is_valid(token_data.username):
+        logger.error(f"Invalid ObjectId format: {token_data.username}")
+        raise credentials_exception
+
+    # Phiên đã đăng xuất / bị thu hồi (kiểm tra trong bộ nhớ)
+    if token_data.sid and revoked_sessions.is_revoked(token_data.sid):
+        raise credentials_exception
+
+    return token_data.username
+
+async def get_user_from_token(token: str) -> UserPrincipal:
     try:
-        token_data = jwt_service.decode_access_token(token)
-        if not token_data or not token_data.username:
-            logger.error(f"Token decode failed or missing username: {token_data}")
-            raise credentials_exception
+        user_id = get_user_id_from_token(token)
+
+        user = await get_principal(user_id)
 
-        # Kiểm tra định dạng ObjectId
-        try:
-            user_id = ObjectId(token_data.username)
-        except Exception as e:
-            logger.error(f"Invalid ObjectId format: {token_data.username}, error: {e}")
-            raise credentials_exception
-        
-        user = await User.find_one(User.id == user_id)
-        
         if user is None:
-            logger.error(f"User not found with ID: {token_data.username}")
+            logger.error(f"User not found with ID: {user_id}")
             raise credentials_exception
-        
+
         return user
     except HTTPException:
         raise
@@ -42,14 +87,28 @@ async def get_user_from_token(token: str) -> User:
         logger.error(f"Unexpected error in get_user_from_token: {e}")
         raise credentials_exception
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserPrincipal:
     return await get_user_from_token(token)
 
 async def get_current_user_id(token: str = Depends(oauth2_scheme)) -> str:
-    user = await get_user_from_token(token)
-    return str(user.id)
+    return get_user_id_from_token(token)
+
+async def get_current_session_id(token: str = Depends(oauth2_scheme)) -> Optional[str]:
+    """Lấy ID phiên từ access token (None với token cũ chưa gắn phiên)."""
+    get_user_id_from_token(token)
+    return jwt_service.decode_access_token(token).sid
+
+async def require_ops_token(x_ops_token: Optional[str] = Header(None)):
+    """
+    Chỉ cho phép request có header X-Ops-Token đúng với OPS_METRICS_TOKEN.
+    Khi chưa cấu hình token, endpoint vận hành trả 404 như không tồn tại.
+    """
+    if not OPS_METRICS_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if not x_ops_token or not hmac.compare_digest(x_ops_token, OPS_METRICS_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
 
-async def get_current_user_ws(websocket: WebSocket) -> User:
+async def get_current_user_ws(websocket: WebSocket) -> UserPrincipal:
 
     token = websocket.query_params.get("token")
     if not token:
@@ -4,6 +4,7 @@ from .message_service import MessageService
 from .post_service import PostService
 from .user_service import UserService
 from .comment_service import CommentService
+from .inbox_service import InboxService
 
 __all__ = [
     "AuthService",
@@ -12,5 +13,6 @@ __all__ = [
     "MessageService",
     "PostService",
     "UserService",
-    "CommentService"
+    "CommentService",
+    "InboxService"
 ]
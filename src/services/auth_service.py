@@ -1,40 +1,52 @@
-from passlib.context import CryptContext
-from ..models.user import User
-from ..models.otp import OTP
+from pymongo.errors import DuplicateKeyError
+from typing import Optional
+from ..models.user import User, CASE_INSENSITIVE
 from ..services.email_service import EmailService
-from datetime import datetime, timedelta
-import random
+from .password_hasher import password_hasher
+from .otp_service import OTPService
 import re
 
-# Thiết lập ngữ cảnh băm mật khẩu
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 class AuthService:
 
     @staticmethod
-    def verify_password(plain_password, hashed_password):
-        """Xác minh mật khẩu thuần túy với mật khẩu đã được băm."""
-        return pwd_context.verify(plain_password, hashed_password)
+    async def verify_password(plain_password, hashed_password):
+        """Xác minh mật khẩu thuần túy với mật khẩu đã được băm (chạy ngoài event loop)."""
+        return await password_hasher.verify(plain_password, hashed_password)
+
+    @staticmethod
+    async def get_password_hash(password):
+        """Băm một mật khẩu thuần túy (chạy ngoài event loop)."""
+        return await password_hasher.hash(password)
+
+    @staticmethod
+    def duplicate_key_field(error: DuplicateKeyError) -> Optional[str]:
+        """Xác định trường (username/email) gây ra lỗi trùng khóa."""
+        details = error.details or {}
+        key_pattern = details.get("keyPattern") or details.get("keyValue") or {}
+        for field in ("username", "email"):
+            if field in key_pattern or f"{field}_unique_ci" in str(error):
+                return field
+        return None
+
+    @staticmethod
+    async def find_user_by_username(username: str) -> Optional[User]:
+        """Tìm user theo username, không phân biệt hoa thường (khớp index username_unique_ci)."""
+        return await User.find_one(User.username == username, collation=CASE_INSENSITIVE)
 
     @staticmethod
-    def get_password_hash(password):
-        """Băm một mật khẩu thuần túy."""
-        return pwd_context.hash(password)
+    async def find_user_by_email(email: str) -> Optional[User]:
+        """Tìm user theo email, không phân biệt hoa thường (khớp index email_unique_ci)."""
+        return await User.find_one(User.email == email, collation=CASE_INSENSITIVE)
 
     @staticmethod
     async def register_user(username, email, password, displayName):
         """
         Xử lý đăng ký người dùng mới.
-        Kiểm tra tên người dùng/email đã tồn tại, băm mật khẩu và tạo người dùng.
+        Trùng username/email (không phân biệt hoa thường) được chặn bởi index duy nhất:
+        chỉ một lần insert, không tốn thêm round trip kiểm tra trước.
         """
-        # Kiểm tra xem người dùng đã tồn tại chưa bằng cách truy vấn bất đồng bộ
-        if await User.find_one(User.username == username):
-            raise ValueError(f"Tên người dùng '{username}' đã tồn tại.")
-        if await User.find_one(User.email == email):
-            raise ValueError(f"Email '{email}' đã tồn tại.")
-
-        # Băm mật khẩu (hoạt động đồng bộ)
-        hashed_password = AuthService.get_password_hash(password)
+        # Băm mật khẩu trên executor riêng
+        hashed_password = await AuthService.get_password_hash(password)
         
         # Tạo một thực thể người dùng mới
         # Salt được passlib xử lý tự động và là một phần của chuỗi băm.
@@ -45,8 +57,13 @@ class AuthService:
             displayName=displayName
         )
         
-        # Lưu người dùng mới vào cơ sở dữ liệu một cách bất đồng bộ
-        await new_user.save()
+        # Chèn người dùng mới, lỗi trùng khóa được chuyển thành thông báo cũ
+        try:
+            await new_user.insert()
+        except DuplicateKeyError as e:
+            if AuthService.duplicate_key_field(e) == "email":
+                raise ValueError(f"Email '{email}' đã tồn tại.")
+            raise ValueError(f"Tên người dùng '{username}' đã tồn tại.")
         return new_user
 
     @staticmethod
@@ -56,7 +73,7 @@ class AuthService:
         Tìm người dùng bằng username và xác minh mật khẩu.
         """
         # Tìm người dùng bằng username một cách bất đồng bộ
-        user = await User.find_one(User.username == username)
+        user = await AuthService.find_user_by_username(username)
         if not user:
             return None # Không tìm thấy người dùng
         
@@ -64,8 +81,8 @@ class AuthService:
         if user.status == 'deleted':
             raise ValueError("Tài khoản đã bị xóa. Vui lòng liên hệ hỗ trợ nếu cần khôi phục.")
         
-        # Xác minh mật khẩu (hoạt động đồng bộ)
-        if not AuthService.verify_password(password, user.hashedPassword):
+        # Xác minh mật khẩu trên executor riêng
+        if not await AuthService.verify_password(password, user.hashedPassword):
             return None # Mật khẩu không hợp lệ
         
         # Thêm device token vào list nếu được cung cấp và chưa có trong list
@@ -99,7 +116,7 @@ class AuthService:
             # Nếu là email
             if require_user_exists:
                 # Tìm user theo email
-                user = await User.find_one(User.email == identifier)
+                user = await AuthService.find_user_by_email(identifier)
                 if not user:
                     raise ValueError(f"Không tìm thấy tài khoản với email '{identifier}'.")
                 # Kiểm tra nếu tài khoản đã bị xóa
@@ -108,7 +125,7 @@ class AuthService:
             email = identifier
         else:
             # Nếu là username, phải tìm user theo username
-            user = await User.find_one(User.username == identifier)
+            user = await AuthService.find_user_by_username(identifier)
             if not user:
                 raise ValueError(f"Không tìm thấy tài khoản với username '{identifier}'.")
             # Kiểm tra nếu tài khoản đã bị xóa
@@ -116,37 +133,16 @@ class AuthService:
                 raise ValueError("Tài khoản đã bị xóa. Vui lòng liên hệ hỗ trợ nếu cần khôi phục.")
             email = user.email
         
-        # Tạo mã OTP 6 chữ số
-        otp_code = str(random.randint(100000, 999999))
-        
-        # Hash mã OTP
-        hashed_otp = AuthService.get_password_hash(otp_code)
+        # Vô hiệu hóa OTP cũ và lưu OTP mới (mã 6 chữ số, băm bằng HMAC)
+        otp_code, new_otp = await OTPService.issue(email)
         
-        # Thời gian hết hạn (5 phút)
-        expires_at = datetime.utcnow() + timedelta(minutes=5)
-        
-        # Vô hiệu hóa các OTP cũ của email này (chưa sử dụng)
-        existing_otps = await OTP.find(
-            OTP.email == email,
-            OTP.is_used == False
-        ).to_list()
-        
-        for existing_otp in existing_otps:
-            existing_otp.is_used = True
-            await existing_otp.save()
-        
-        # Lưu OTP mới vào database
-        new_otp = OTP(
-            email=email,
-            otp_code=hashed_otp,
-            expires_at=expires_at,
-            is_used=False
-        )
-        await new_otp.save()
+        # Xóa OTP nếu email không gửi được sau khi hàng đợi đã thử lại
+        async def discard_otp(error: Exception):
+            await new_otp.delete()
         
-        # Gửi email
+        # Đưa email vào hàng đợi gửi nền và trả về ngay
         try:
-            await EmailService.send_otp_email(email, otp_code)
+            await EmailService.send_otp_email(email, otp_code, on_failure=discard_otp)
         except Exception as e:
             # Xóa OTP nếu không gửi được email
             await new_otp.delete()
@@ -173,18 +169,17 @@ class AuthService:
             ValueError: Nếu OTP không hợp lệ hoặc đã hết hạn
         """
         # Tìm OTP chưa sử dụng và chưa hết hạn
-        current_time = datetime.utcnow()
-        otp_record = await OTP.find_one(
-            OTP.email == email,
-            OTP.is_used == False,
-            OTP.expires_at > current_time
-        )
+        otp_record = await OTPService.find_active(email)
         
         if not otp_record:
             raise ValueError("Mã OTP không hợp lệ hoặc đã hết hạn. Vui lòng yêu cầu mã mới.")
+
+        # Mỗi lần so mã tốn một lượt thử; hết lượt thì mã bị hủy
+        if not await OTPService.consume_attempt(otp_record):
+            raise ValueError("Mã OTP đã bị hủy do nhập sai quá nhiều lần. Vui lòng yêu cầu mã mới.")
         
         # Xác minh mã OTP
-        if not AuthService.verify_password(otp_code, otp_record.otp_code):
+        if not await OTPService.matches(email, otp_code, otp_record.otp_code):
             raise ValueError("Mã OTP không chính xác.")
         
         # Đánh dấu OTP đã sử dụng
@@ -212,7 +207,7 @@ class AuthService:
             ValueError: Nếu không tìm thấy người dùng
         """
         # Tìm user theo email
-        user = await User.find_one(User.email == email)
+        user = await AuthService.find_user_by_email(email)
         if not user:
             raise ValueError(f"Không tìm thấy tài khoản với email '{email}'.")
         
@@ -221,17 +216,14 @@ class AuthService:
             raise ValueError("Tài khoản đã bị xóa. Vui lòng liên hệ hỗ trợ nếu cần khôi phục.")
         
         # Băm mật khẩu mới
-        hashed_password = AuthService.get_password_hash(new_password)
+        hashed_password = await AuthService.get_password_hash(new_password)
         
         # Cập nhật mật khẩu
         user.hashedPassword = hashed_password
         await user.save()
         
         # Vô hiệu hóa tất cả OTP của email này sau khi đổi mật khẩu thành công
-        otps = await OTP.find(OTP.email == email).to_list()
-        for otp in otps:
-            otp.is_used = True
-            await otp.save()
+        await OTPService.invalidate(email, only_unused=False)
         
         return {
             "message": "Đặt lại mật khẩu thành công"
@@ -265,12 +257,12 @@ class AuthService:
             raise ValueError("Tài khoản đã bị xóa. Vui lòng liên hệ hỗ trợ nếu cần khôi phục.")
         
         # Kiểm tra nếu email mới đã được sử dụng
-        existing_user = await User.find_one(User.email == new_email)
+        existing_user = await AuthService.find_user_by_email(new_email)
         if existing_user and str(existing_user.id) != user_id:
             raise ValueError(f"Email '{new_email}' đã được sử dụng bởi tài khoản khác.")
         
         # Xác minh mật khẩu
-        if not AuthService.verify_password(password, user.hashedPassword):
+        if not await AuthService.verify_password(password, user.hashedPassword):
             raise ValueError("Mật khẩu không chính xác.")
         
         # Gửi OTP đến email mới (không cần email phải tồn tại trong hệ thống)
@@ -309,19 +301,19 @@ class AuthService:
         old_email = user.email
         
         # Kiểm tra nếu email mới đã được sử dụng
-        existing_user = await User.find_one(User.email == new_email)
+        existing_user = await AuthService.find_user_by_email(new_email)
         if existing_user and str(existing_user.id) != user_id:
             raise ValueError(f"Email '{new_email}' đã được sử dụng bởi tài khoản khác.")
         
-        # Cập nhật email
+        # Cập nhật email (index duy nhất chặn trường hợp đổi trùng đồng thời)
         user.email = new_email
-        await user.save()
+        try:
+            await user.save()
+        except DuplicateKeyError:
+            raise ValueError(f"Email '{new_email}' đã được sử dụng bởi tài khoản khác.")
         
         # Vô hiệu hóa tất cả OTP của email cũ
-        old_email_otps = await OTP.find(OTP.email == old_email).to_list()
-        for otp in old_email_otps:
-            otp.is_used = True
-            await otp.save()
+        await OTPService.invalidate(old_email, only_unused=False)
         
         return {
             "message": "Đổi email thành công"
@@ -4,6 +4,7 @@ from bson import ObjectId
 from ..models import Comment, AuthorInfo, User, Post
 from ..schemas import CommentPublic
 from ..websocket import manager
+from ..realtime import LANE_SOCIAL
 
 class CommentService:
 
@@ -71,7 +72,7 @@ class CommentService:
                         "commentId": str(new_comment.id)
                     }
                 }
-                await manager.broadcast_to_user(post.authorId, notification_payload)
+                manager.fanout.submit([post.authorId], notification_payload, lane=LANE_SOCIAL)
             
             # Start notification task in background
             asyncio.create_task(create_comment_notification())
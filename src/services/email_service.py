@@ -1,63 +1,37 @@
+import asyncio
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from typing import Awaitable, Callable, List, Optional, Set
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
-class EmailService:
-    
-    @staticmethod
-    def get_email_config():
-        """Lấy cấu hình email từ file .env"""
-        return {
-            'smtp_server': os.getenv('SMTP_SERVER', 'smtp.gmail.com'),
-            'smtp_port': int(os.getenv('SMTP_PORT', '587')),
-            'smtp_username': os.getenv('SMTP_USERNAME'),
-            'smtp_password': os.getenv('SMTP_PASSWORD'),
-            'from_email': os.getenv('FROM_EMAIL')
-        }
-    
-    @staticmethod
-    async def send_otp_email(to_email: str, otp_code: str):
-        """
-        Gửi email chứa mã OTP đến người dùng.
-        
-        Args:
-            to_email: Email người nhận
-            otp_code: Mã OTP 6 chữ số
-            
-        Raises:
-            Exception: Nếu không thể gửi email
-        """
-        config = EmailService.get_email_config()
-        
-        # Kiểm tra cấu hình email
-        if not all([config['smtp_username'], config['smtp_password'], config['from_email']]):
-            raise Exception("Cấu hình email chưa được thiết lập trong file .env")
-        
-        # Tạo message
-        message = MIMEMultipart('alternative')
-        message['Subject'] = 'Mã OTP xác thực - Relo Social Network'
-        message['From'] = config['from_email']
-        message['To'] = to_email
-        
-        # Nội dung email
-        text = f"""
+# Cấu hình hàng đợi gửi email nền
+EMAIL_WORKERS = int(os.getenv("EMAIL_WORKERS", 2))                          # Số worker (mỗi worker giữ 1 kết nối SMTP)
+EMAIL_QUEUE_SIZE = int(os.getenv("EMAIL_QUEUE_SIZE", 1000))                 # Số email tối đa đang chờ gửi
+EMAIL_MAX_RETRIES = int(os.getenv("EMAIL_MAX_RETRIES", 3))                  # Số lần thử lại khi gửi lỗi
+EMAIL_RETRY_BACKOFF_SECONDS = float(os.getenv("EMAIL_RETRY_BACKOFF_SECONDS", 1.0))  # Thời gian chờ cơ sở giữa các lần thử lại
+SMTP_TIMEOUT_SECONDS = float(os.getenv("SMTP_TIMEOUT_SECONDS", 15))
+
+# Template email OTP được dựng sẵn một lần, chỉ chèn mã OTP khi gửi
+OTP_EMAIL_SUBJECT = 'Mã OTP xác thực - Relo Social Network'
+
+OTP_EMAIL_TEXT = """
         Chào bạn,
-        
+
         Mã OTP của bạn là: {otp_code}
-        
+
         Mã này có hiệu lực trong 5 phút.
-        
+
         Nếu bạn không yêu cầu mã này, vui lòng bỏ qua email này.
-        
+
         Trân trọng,
         Đội ngũ Relo Social Network
         """
-        
-        html = f"""
+
+OTP_EMAIL_HTML = """
         <html>
           <body>
             <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
@@ -75,20 +49,222 @@ class EmailService:
           </body>
         </html>
         """
-        
-        # Gắn nội dung vào message
-        part1 = MIMEText(text, 'plain')
-        part2 = MIMEText(html, 'html')
-        message.attach(part1)
-        message.attach(part2)
-        
-        # Gửi email
+
+FailureCallback = Callable[[Exception], Awaitable[None]]
+
+def is_transient_error(error: Exception) -> bool:
+    """
+    Lỗi gửi email có thể thành công nếu thử lại: lỗi kết nối/timeout hoặc mã SMTP 4xx.
+    Lỗi vĩnh viễn (sai đăng nhập, 5xx từ chối người nhận, ...) không được thử lại.
+    """
+    if isinstance(error, (smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected)):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return bool(codes) and all(400 <= code < 500 for code in codes)
+    if isinstance(error, smtplib.SMTPException):
+        return False
+    # smtplib.SMTPException kế thừa OSError nên lỗi socket/timeout được xét sau cùng
+    return isinstance(error, (OSError, TimeoutError))
+
+class SMTPConnection:
+    """
+    Một kết nối SMTP đã STARTTLS và đăng nhập, được dùng lại cho nhiều email.
+    Các phương thức chạy đồng bộ, được gọi trong thread bằng asyncio.to_thread.
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+        self._server: Optional[smtplib.SMTP] = None
+
+    def _connect(self) -> smtplib.SMTP:
+        server = smtplib.SMTP(
+            self.config['smtp_server'],
+            self.config['smtp_port'],
+            timeout=SMTP_TIMEOUT_SECONDS
+        )
+        if self.config['use_tls']:
+            server.starttls()
+        if self.config['smtp_username'] and self.config['smtp_password']:
+            server.login(self.config['smtp_username'], self.config['smtp_password'])
+        return server
+
+    def send(self, message: MIMEMultipart):
+        """Gửi email, tự kết nối lại một lần nếu kết nối cũ đã bị server đóng."""
+        if self._server is None:
+            self._server = self._connect()
         try:
-            with smtplib.SMTP(config['smtp_server'], config['smtp_port']) as server:
-                server.starttls()
-                server.login(config['smtp_username'], config['smtp_password'])
-                server.send_message(message)
-            print(f"Đã gửi OTP đến email: {to_email}")
-        except Exception as e:
-            raise Exception(f"Không thể gửi email: {str(e)}")
+            self._server.send_message(message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            self.close()
+            self._server = self._connect()
+            self._server.send_message(message)
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+class EmailDeliveryPool:
+    """
+    Hàng đợi gửi email nền với các worker giữ kết nối SMTP lâu dài.
+    Email lỗi được thử lại với backoff lũy thừa; hết lượt thử thì gọi callback lỗi.
+    """
+
+    def __init__(self, workers: int, queue_size: int, max_retries: int, backoff: float):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._connections: List[SMTPConnection] = []
+        # Các lần thử lại đang chờ backoff (giữ tham chiếu để task không bị thu gom và hủy được khi dừng)
+        self._retries: Set[asyncio.Task] = set()
+
+        # Metrics
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self):
+        """Khởi động các worker (cần event loop đang chạy)."""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        config = EmailService.get_email_config()
+        for _ in range(self.workers):
+            connection = SMTPConnection(config)
+            self._connections.append(connection)
+            self._tasks.append(asyncio.create_task(self._worker(connection)))
+
+    async def stop(self):
+        """Dừng các worker, hủy các lần thử lại đang chờ và đóng kết nối SMTP."""
+        pending = self._tasks + list(self._retries)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self._retries.clear()
+        for connection in self._connections:
+            await asyncio.to_thread(connection.close)
+        self._tasks = []
+        self._connections = []
+        self._queue = None
+
+    def enqueue(self, message: MIMEMultipart, on_failure: Optional[FailureCallback] = None):
+        """
+        Đưa email vào hàng đợi và trả về ngay.
+
+        Raises:
+            Exception: Nếu hàng đợi đã đầy
+        """
+        self.start()
+        try:
+            self._queue.put_nowait((message, on_failure, 0))
+        except asyncio.QueueFull:
+            raise Exception("Hàng đợi gửi email đang quá tải, vui lòng thử lại sau")
+
+    async def _requeue_later(self, message: MIMEMultipart, on_failure: Optional[FailureCallback], attempt: int):
+        await asyncio.sleep(self.backoff * (2 ** (attempt - 1)))
+        if self._queue is not None:
+            await self._queue.put((message, on_failure, attempt))
+
+    async def _worker(self, connection: SMTPConnection):
+        while True:
+            message, on_failure, attempt = await self._queue.get()
+            try:
+                await asyncio.to_thread(connection.send, message)
+                self.sent += 1
+                print(f"Đã gửi email đến: {message['To']}")
+            except Exception as e:
+                await asyncio.to_thread(connection.close)
+                if attempt < self.max_retries and is_transient_error(e):
+                    # Thử lại sau, không giữ worker trong lúc chờ
+                    self.retried += 1
+                    retry = asyncio.create_task(self._requeue_later(message, on_failure, attempt + 1))
+                    self._retries.add(retry)
+                    retry.add_done_callback(self._retries.discard)
+                else:
+                    self.failed += 1
+                    print(f"Không thể gửi email đến {message['To']}: {e}")
+                    if on_failure:
+                        try:
+                            await on_failure(e)
+                        except Exception as callback_error:
+                            print(f"Lỗi khi xử lý email gửi thất bại: {callback_error}")
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        """Thống kê hàng đợi gửi email."""
+        return {
+            "workers": len(self._tasks),
+            "queued": self._queue.qsize() if self._queue else 0,
+            "queueSize": self.queue_size,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "pendingRetries": len(self._retries),
+        }
+
+class EmailService:
+
+    @staticmethod
+    def get_email_config():
+        """Lấy cấu hình email từ file .env"""
+        return {
+            'smtp_server': os.getenv('SMTP_SERVER', 'smtp.gmail.com'),
+            'smtp_port': int(os.getenv('SMTP_PORT', '587')),
+            'smtp_username': os.getenv('SMTP_USERNAME'),
+            'smtp_password': os.getenv('SMTP_PASSWORD'),
+            'from_email': os.getenv('FROM_EMAIL'),
+            'use_tls': os.getenv('SMTP_USE_TLS', 'true').lower() != 'false'
+        }
+
+    @staticmethod
+    def build_otp_message(from_email: str, to_email: str, otp_code: str) -> MIMEMultipart:
+        """Tạo email OTP từ template dựng sẵn."""
+        message = MIMEMultipart('alternative')
+        message['Subject'] = OTP_EMAIL_SUBJECT
+        message['From'] = from_email
+        message['To'] = to_email
+
+        message.attach(MIMEText(OTP_EMAIL_TEXT.format(otp_code=otp_code), 'plain'))
+        message.attach(MIMEText(OTP_EMAIL_HTML.format(otp_code=otp_code), 'html'))
+        return message
+
+    @staticmethod
+    async def send_otp_email(to_email: str, otp_code: str, on_failure: Optional[FailureCallback] = None):
+        """
+        Đưa email chứa mã OTP vào hàng đợi gửi nền.
+
+        Args:
+            to_email: Email người nhận
+            otp_code: Mã OTP 6 chữ số
+            on_failure: Callback được gọi nếu email không gửi được sau khi đã thử lại
+
+        Raises:
+            Exception: Nếu cấu hình email thiếu hoặc hàng đợi đã đầy
+        """
+        config = EmailService.get_email_config()
+
+        # Kiểm tra cấu hình email (cho phép SMTP không cần đăng nhập khi tắt TLS, ví dụ server test cục bộ)
+        credentials_ok = (config['smtp_username'] and config['smtp_password']) or not config['use_tls']
+        if not config['from_email'] or not credentials_ok:
+            raise Exception("Cấu hình email chưa được thiết lập trong file .env")
+
+        message = EmailService.build_otp_message(config['from_email'], to_email, otp_code)
+        email_pool.enqueue(message, on_failure)
 
+# Instance dùng chung toàn app
+email_pool = EmailDeliveryPool(
+    workers=EMAIL_WORKERS,
+    queue_size=EMAIL_QUEUE_SIZE,
+    max_retries=EMAIL_MAX_RETRIES,
+    backoff=EMAIL_RETRY_BACKOFF_SECONDS
+)
@@ -8,6 +8,7 @@ from google.oauth2 import service_account
 import google.auth.transport.requests
 from dotenv import load_dotenv
 from ..models import User
+from .inbox_service import InboxService
 
 # Load environment variables
 load_dotenv()
@@ -140,9 +141,17 @@ class FCMService:
         
         successful_tokens = []
         failed_tokens = []
+
+        # Badge APNs = tổng số tin chưa đọc của người nhận (một truy vấn cho mọi token)
+        unread_totals = {}
+        if token_to_user_map:
+            recipient_ids = list({str(user.id) for user in token_to_user_map.values()})
+            unread_totals = await InboxService.get_unread_totals(recipient_ids)
         
         # Gửi từng notification (có thể batch sau)
         for i, token in enumerate(device_tokens):
+            recipient = token_to_user_map.get(token) if token_to_user_map else None
+            badge = unread_totals.get(str(recipient.id), 1) if recipient else 1
             # FCM v1 API format - DATA ONLY để client tự hiển thị local notification
             # Không có notification field = Firebase sẽ KHÔNG tự hiển thị
             # Client sẽ nhận qua onMessage và tự hiển thị local notification với avatar, button reply
@@ -170,6 +179,7 @@ class FCMService:
                         "member_count": "0",
                         # Thêm screen để chỉ định màn hình cần mở
                         "screen": screen or ("chat" if conversation_id else ""),
+                        "unread_total": str(badge),
                         **{str(k): str(v) for k, v in (data or {}).items()}
                     },
                     "android": {
@@ -184,7 +194,7 @@ class FCMService:
                             "aps": {
                                 "content-available": 1,  # Background data-only
                                 "sound": "default",
-                                "badge": 1
+                                "badge": badge
                             }
                         },
                     }
@@ -0,0 +1,317 @@
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Union
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from ..models import Conversation, InboxEntry, InboxState, LastMessage, Message, UnreadCounter, User, UserSummary
+from ..utils.ttl_cache import TTLCache
+
+# Tên hiển thị cho tài khoản đã bị xóa (giống danh sách hội thoại)
+DELETED_USER_NAME = "Tài khoản không tồn tại"
+
+# Nhớ các user đã được dựng hộp thư để không phải kiểm tra InboxState mỗi lần đọc
+built_inboxes = TTLCache(maxsize=100000, ttl=3600)
+
+def _peer_fields(user: Optional[Union[User, UserSummary]]) -> dict:
+    if not user or user.status == 'deleted':
+        return {"name": DELETED_USER_NAME, "avatarUrl": None}
+    return {"name": user.displayName, "avatarUrl": user.avatarUrl}
+
+class InboxService:
+    """
+    Duy trì hộp thư phi chuẩn hóa theo từng người dùng (InboxEntry).
+    Các thao tác ghi trên Conversation gọi vào đây để cập nhật các dòng hộp thư
+    bằng một lệnh bulk_write; đọc hộp thư là một lần quét index (userId, hidden, updatedAt).
+    Tổng số chưa đọc của mỗi user (UnreadCounter) được cộng/trừ cùng lúc với unreadCount của từng dòng.
+    """
+
+    @staticmethod
+    async def _bulk(operations: List[UpdateOne]):
+        if operations:
+            await InboxEntry.get_motor_collection().bulk_write(operations, ordered=False)
+
+    @staticmethod
+    async def _adjust_totals(deltas: Dict[str, int]):
+        """Cộng/trừ tổng số chưa đọc của nhiều user bằng một bulk_write (không xuống dưới 0)."""
+        operations = [
+            UpdateOne(
+                {"userId": user_id},
+                [{"$set": {"total": {"$max": [0, {"$add": [{"$ifNull": ["$total", 0]}, delta]}]}}}],
+                upsert=True
+            )
+            for user_id, delta in deltas.items() if delta
+        ]
+        if operations:
+            await UnreadCounter.get_motor_collection().bulk_write(operations, ordered=False)
+
+    @staticmethod
+    async def _reset_unread(conversation_id: str, user_id: str, extra: Optional[dict] = None) -> int:
+        """Đặt unreadCount của một dòng về 0 và trừ phần đó khỏi tổng của user. Trả về số đã trừ."""
+        before = await InboxEntry.get_motor_collection().find_one_and_update(
+            {"userId": user_id, "conversationId": conversation_id},
+            {"$set": {"unreadCount": 0, **(extra or {})}},
+            projection={"unreadCount": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        previous = before.get("unreadCount", 0) if before else 0
+        await InboxService._adjust_totals({user_id: -previous})
+        return previous
+
+    @staticmethod
+    def _conversation_fields(conversation: Conversation) -> dict:
+        fields = {"isGroup": conversation.isGroup}
+        if conversation.isGroup:
+            fields["name"] = conversation.name
+            fields["avatarUrl"] = conversation.avatarUrl
+        return fields
+
+    @staticmethod
+    async def _fill_peers(conversation: Conversation, user_ids: List[str]):
+        """Ghi tên/ảnh của người còn lại cho các dòng chat 1-1 của user_ids."""
+        if conversation.isGroup or not user_ids:
+            return
+        members = [p.userId for p in conversation.participants]
+        peers = {uid: next((m for m in members if m != uid), None) for uid in user_ids}
+        peer_ids = [pid for pid in set(peers.values()) if pid and ObjectId.is_valid(pid)]
+        users = await User.find(
+            {"_id": {"$in": [ObjectId(pid) for pid in peer_ids]}}
+        ).project(UserSummary).to_list() if peer_ids else []
+        users_map = {str(u.id): u for u in users}
+
+        await InboxService._bulk([
+            UpdateOne(
+                {"userId": uid, "conversationId": str(conversation.id)},
+                {"$set": {"peerId": peer_id, **_peer_fields(users_map.get(peer_id))}}
+            )
+            for uid, peer_id in peers.items()
+        ])
+
+    @staticmethod
+    async def sync_members(conversation: Conversation, user_ids: Optional[List[str]] = None):
+        """
+        Tạo (nếu chưa có) dòng hộp thư cho các thành viên của hội thoại, ví dụ khi tạo
+        hội thoại hoặc thêm thành viên. Không đụng tới số chưa đọc của dòng đã có.
+        """
+        conversation_id = str(conversation.id)
+        user_ids = user_ids or [p.userId for p in conversation.participants]
+        last_message = conversation.lastMessage.model_dump() if conversation.lastMessage else None
+        await InboxService._bulk([
+            UpdateOne(
+                {"userId": uid, "conversationId": conversation_id},
+                {
+                    "$set": {**InboxService._conversation_fields(conversation), "hidden": False},
+                    "$setOnInsert": {
+                        "lastMessage": last_message,
+                        "updatedAt": conversation.updatedAt,
+                        "unreadCount": 0,
+                        "muted": False,
+                    },
+                },
+                upsert=True
+            )
+            for uid in user_ids
+        ])
+        await InboxService._fill_peers(conversation, user_ids)
+
+    @staticmethod
+    async def on_message(conversation: Conversation, message: Message):
+        """
+        Cập nhật tin nhắn cuối cho mọi thành viên, tăng số chưa đọc của người nhận
+        và hiện lại hội thoại cho người đã xóa nó.
+        Tin nhắn cuối/updatedAt chỉ được ghi đè khi tin nhắn không cũ hơn tin đang lưu trong dòng hộp thư,
+        nên tin gửi đồng thời đến sau không làm lùi bản xem trước.
+        """
+        conversation_id = str(conversation.id)
+        last_message = LastMessage(
+            content=message.content,
+            senderId=message.senderId,
+            createdAt=message.createdAt
+        ).model_dump()
+        is_newer = {"$or": [
+            {"$eq": [{"$ifNull": ["$lastMessage", None]}, None]},
+            {"$lte": ["$lastMessage.createdAt", message.createdAt]},
+        ]}
+        fields = {
+            **{key: {"$literal": value} for key, value in InboxService._conversation_fields(conversation).items()},
+            "lastMessage": {"$cond": [is_newer, {"$literal": last_message}, "$lastMessage"]},
+            "updatedAt": {"$cond": [is_newer, {"$literal": conversation.updatedAt}, "$updatedAt"]},
+            "hidden": False,
+        }
+        operations = []
+        user_ids = []
+        for participant in conversation.participants:
+            # Người gửi đã xem hội thoại: số chưa đọc được đặt lại riêng để trừ khỏi tổng
+            increment = 0 if participant.userId == message.senderId else 1
+            update = [{"$set": {
+                **fields,
+                "unreadCount": {"$add": [{"$ifNull": ["$unreadCount", 0]}, increment]},
+                "muted": {"$ifNull": ["$muted", participant.muteNotifications]},
+            }}]
+            operations.append(UpdateOne({"userId": participant.userId, "conversationId": conversation_id}, update, upsert=True))
+            user_ids.append(participant.userId)
+
+        result = await InboxEntry.get_motor_collection().bulk_write(operations, ordered=False) if operations else None
+        await InboxService._adjust_totals({uid: 1 for uid in user_ids if uid != message.senderId})
+        if message.senderId in user_ids:
+            await InboxService._reset_unread(conversation_id, message.senderId)
+        # Dòng mới tạo (hội thoại 1-1 lần đầu có tin nhắn) cần tên/ảnh của người còn lại
+        if result and result.upserted_ids:
+            created = [user_ids[i] for i in result.upserted_ids]
+            await InboxService._fill_peers(conversation, created)
+
+    @staticmethod
+    async def update_last_message(conversation: Conversation):
+        """Ghi lại tin nhắn cuối (ví dụ khi tin nhắn cuối bị thu hồi) mà không đổi số chưa đọc."""
+        last_message = conversation.lastMessage.model_dump() if conversation.lastMessage else None
+        await InboxEntry.find(InboxEntry.conversationId == str(conversation.id)).update(
+            {"$set": {"lastMessage": last_message}}
+        )
+
+    @staticmethod
+    async def remove_member(conversation_id: str, user_id: str):
+        """Xóa dòng hộp thư của người đã rời nhóm (và trừ số chưa đọc của dòng đó khỏi tổng)."""
+        removed = await InboxEntry.get_motor_collection().find_one_and_delete(
+            {"userId": user_id, "conversationId": conversation_id},
+            projection={"unreadCount": 1}
+        )
+        if removed:
+            await InboxService._adjust_totals({user_id: -removed.get("unreadCount", 0)})
+
+    @staticmethod
+    async def mark_seen(conversation_id: str, user_id: str):
+        await InboxService._reset_unread(conversation_id, user_id)
+
+    @staticmethod
+    async def hide(conversation_id: str, user_id: str):
+        """Ẩn hội thoại khỏi hộp thư khi user xóa nó (hiện lại khi có tin nhắn mới)."""
+        await InboxService._reset_unread(conversation_id, user_id, extra={"hidden": True})
+
+    @staticmethod
+    async def set_muted(conversation_id: str, user_id: str, muted: bool):
+        await InboxEntry.find(
+            InboxEntry.userId == user_id,
+            InboxEntry.conversationId == conversation_id
+        ).update({"$set": {"muted": muted}})
+
+    @staticmethod
+    async def refresh_peer(user: User):
+        """Cập nhật tên/ảnh của user trong hộp thư của những người chat 1-1 với họ."""
+        await InboxEntry.find(InboxEntry.peerId == str(user.id)).update({"$set": _peer_fields(user)})
+
+    @staticmethod
+    async def rebuild(user_id: str):
+        """Dựng lại toàn bộ hộp thư của user từ các document Conversation."""
+        convos = await Conversation.find({"participants.userId": user_id}).to_list()
+
+        peer_ids = set()
+        for convo in convos:
+            if not convo.isGroup:
+                peer_ids.update(p.userId for p in convo.participants if p.userId != user_id)
+        valid_ids = [ObjectId(pid) for pid in peer_ids if ObjectId.is_valid(pid)]
+        users = await User.find({"_id": {"$in": valid_ids}}).project(UserSummary).to_list() if valid_ids else []
+        users_map = {str(u.id): u for u in users}
+
+        operations = []
+        total = 0
+        for convo in convos:
+            participant = next((p for p in convo.participants if p.userId == user_id), None)
+            delete_time = participant.lastMessageDelete if participant else None
+            last = convo.lastMessage
+            hidden = bool(delete_time) and (not last or last.createdAt <= delete_time)
+            fields = {
+                **InboxService._conversation_fields(convo),
+                "lastMessage": last.model_dump() if last else None,
+                "updatedAt": convo.updatedAt,
+                # seenIds chỉ cho biết đã xem tin cuối hay chưa
+                "unreadCount": 0 if (hidden or not last or last.senderId == user_id or user_id in convo.seenIds) else 1,
+                "muted": participant.muteNotifications if participant else False,
+                "hidden": hidden,
+            }
+            if not convo.isGroup:
+                peer_id = next((p.userId for p in convo.participants if p.userId != user_id), None)
+                fields["peerId"] = peer_id
+                fields.update(_peer_fields(users_map.get(peer_id)))
+            operations.append(UpdateOne({"userId": user_id, "conversationId": str(convo.id)}, {"$set": fields}, upsert=True))
+            total += fields["unreadCount"]
+        await InboxService._bulk(operations)
+
+        await UnreadCounter.find_one(UnreadCounter.userId == user_id).upsert(
+            {"$set": {"total": total}},
+            on_insert=UnreadCounter(userId=user_id, total=total)
+        )
+
+        await InboxState.find_one(InboxState.userId == user_id).upsert(
+            {"$set": {"builtAt": datetime.utcnow()}},
+            on_insert=InboxState(userId=user_id)
+        )
+
+    @staticmethod
+    async def ensure_built(user_id: str):
+        """Dựng hộp thư ở lần đọc đầu tiên của user (dữ liệu có trước khi có hộp thư)."""
+        if user_id in built_inboxes:
+            return
+        if not await InboxState.find_one(InboxState.userId == user_id):
+            await InboxService.rebuild(user_id)
+        built_inboxes.set(user_id, True)
+
+    @staticmethod
+    async def get_unread_totals(user_ids: List[str]) -> Dict[str, int]:
+        """Tổng số chưa đọc của nhiều user bằng một truy vấn (user chưa có bộ đếm: 0)."""
+        counters = await UnreadCounter.find({"userId": {"$in": list(user_ids)}}).to_list() if user_ids else []
+        totals = {uid: 0 for uid in user_ids}
+        totals.update({c.userId: c.total for c in counters})
+        return totals
+
+    @staticmethod
+    async def get_unread(user_id: str) -> dict:
+        """Tổng số chưa đọc và số chưa đọc của từng hội thoại (chỉ các hội thoại có tin chưa đọc)."""
+        await InboxService.ensure_built(user_id)
+        counter = await UnreadCounter.find_one(UnreadCounter.userId == user_id)
+        entries = await InboxEntry.find(
+            InboxEntry.userId == user_id,
+            InboxEntry.hidden == False,
+            InboxEntry.unreadCount > 0
+        ).to_list()
+        return {
+            "total": counter.total if counter else 0,
+            "conversations": {entry.conversationId: entry.unreadCount for entry in entries},
+        }
+
+    @staticmethod
+    def entry_cursor(entry: InboxEntry) -> str:
+        """Cursor trỏ tới một dòng hộp thư: "<updatedAt ISO>_<conversationId>"."""
+        return f"{entry.updatedAt.isoformat()}_{entry.conversationId}"
+
+    @staticmethod
+    def inbox_query(user_id: str, cursor: Optional[str]) -> dict:
+        query: Dict = {"userId": user_id, "hidden": False}
+        if cursor:
+            updated_at, _, conversation_id = cursor.rpartition("_")
+            try:
+                updated_at = datetime.fromisoformat(updated_at)
+            except ValueError:
+                raise ValueError("Cursor không hợp lệ.")
+            query["$or"] = [
+                {"updatedAt": {"$lt": updated_at}},
+                {"updatedAt": updated_at, "conversationId": {"$lt": conversation_id}},
+            ]
+        return query
+
+    @staticmethod
+    async def get_inbox(user_id: str, limit: Optional[int] = None, cursor: Optional[str] = None) -> List[InboxEntry]:
+        """Đọc hộp thư của user, mới cập nhật nhất trước."""
+        await InboxService.ensure_built(user_id)
+        return await InboxEntry.find(
+            InboxService.inbox_query(user_id, cursor),
+            sort=[("updatedAt", -1), ("conversationId", -1)],
+            limit=limit or 0
+        ).to_list()
+
+    @staticmethod
+    async def stream_inbox(user_id: str, cursor: Optional[str] = None) -> AsyncIterator[InboxEntry]:
+        """Duyệt hộp thư theo từng dòng mà không nạp toàn bộ vào bộ nhớ."""
+        await InboxService.ensure_built(user_id)
+        async for entry in InboxEntry.find(
+            InboxService.inbox_query(user_id, cursor),
+            sort=[("updatedAt", -1), ("conversationId", -1)]
+        ):
+            yield entry
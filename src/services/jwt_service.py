@@ -1,9 +1,12 @@
+import hashlib
 import os
+import time
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from pydantic import BaseModel
 from dotenv import load_dotenv
+from ..utils.ttl_cache import TTLCache
 
 # Tải các biến môi trường từ tệp .env
 load_dotenv()
@@ -13,10 +16,17 @@ SECRET_KEY = os.getenv("SECRET_KEY")  # Khóa bí mật để ký và xác minh
 ALGORITHM = os.getenv("ALGORITHM")    # Thuật toán mã hóa để sử dụng
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 120))  # Thời gian hết hạn của token truy cập (tính bằng phút)
 REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 1000)) # Thời gian hết hạn của refresh token (tính bằng ngày)
+TOKEN_CACHE_MAX_SIZE = int(os.getenv("TOKEN_CACHE_MAX_SIZE", 20000)) # Số token đã xác minh tối đa được cache
+TOKEN_CACHE_MAX_TTL_SECONDS = int(os.getenv("TOKEN_CACHE_MAX_TTL_SECONDS", ACCESS_TOKEN_EXPIRE_MINUTES * 60)) # Thời gian cache tối đa của một token
+
+# Cache payload đã xác minh, key là SHA-256 của token, sống tới khi token hết hạn
+_token_cache = TTLCache(maxsize=TOKEN_CACHE_MAX_SIZE, ttl=TOKEN_CACHE_MAX_TTL_SECONDS)
 
 class TokenData(BaseModel):
     """Mô hình dữ liệu cho payload được giải mã từ token."""
     username: Optional[str] = None
+    sid: Optional[str] = None  # ID phiên đăng nhập (Session)
+    jti: Optional[str] = None  # ID của refresh token trong họ token của phiên
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """
@@ -59,6 +69,7 @@ def create_refresh_token(data: dict, expires_delta: Optional[timedelta] = None)
 def decode_access_token(token: str) -> Optional[TokenData]:
     """
     Giải mã một token truy cập JWT và trả về payload của nó.
+    Kết quả hợp lệ được cache theo digest của token cho tới khi token hết hạn.
 
     Args:
         token (str): Token JWT để giải mã.
@@ -66,14 +77,29 @@ def decode_access_token(token: str) -> Optional[TokenData]:
     Returns:
         Optional[TokenData]: Dữ liệu payload của token nếu giải mã thành công, nếu không thì trả về None.
     """
+    cache_key = hashlib.sha256(token.encode("utf-8")).digest()
+    cached = _token_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     try:
         # Cố gắng giải mã token bằng khóa bí mật và thuật toán
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub") # Trích xuất chủ thể (username)
         if username is None:
             return None
-        token_data = TokenData(username=username)
+        token_data = TokenData(username=username, sid=payload.get("sid"), jti=payload.get("jti"))
     except JWTError:
         # Nếu có lỗi trong quá trình giải mã (ví dụ: hết hạn, không hợp lệ), trả về None
         return None
-    return token_data
\ No newline at end of file
+
+    # Chỉ cache tới thời điểm hết hạn của token (và không quá giới hạn cấu hình)
+    exp = payload.get("exp")
+    if exp is not None:
+        ttl = min(float(exp) - time.time(), TOKEN_CACHE_MAX_TTL_SECONDS)
+        _token_cache.set(cache_key, token_data, ttl=ttl)
+    return token_data
+
+def get_token_cache_stats() -> dict:
+    """Thống kê hit/miss của cache token đã xác minh."""
+    return _token_cache.stats()
\ No newline at end of file
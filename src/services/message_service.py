@@ -1,12 +1,16 @@
 import asyncio
 from datetime import datetime, timedelta
 from typing import List, Optional
-from ..models import Conversation, LastMessage, Message, ParticipantInfo, User
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from ..models import Conversation, LastMessage, Message, ParticipantInfo, User, UserSummary, make_pair_key
 from ..websocket import manager
+from ..realtime import LANE_CHAT
 from ..schemas import SimpleMessagePublic, LastMessagePublic, ConversationWithParticipants
 from ..schemas.user_schema import UserPublic
 from .user_service import UserService
 from .fcm_service import FCMService
+from .inbox_service import InboxService
 from ..utils import upload_to_cloudinary
 from fastapi import UploadFile
 from ..utils import map_message_to_public_dict, map_conversation_to_public_dict
@@ -55,34 +59,80 @@ class MessageService:
         # Cập nhật lastMessage
         conversation = await Conversation.get(conversation_id)
         if conversation:
-            conversation.lastMessage = LastMessage(
-                content=message.content,
-                senderId=message.senderId,
-                createdAt=message.createdAt
-            )
-            conversation.updatedAt = datetime.utcnow() + timedelta(hours=7)
-            conversation.seenIds = []
-            await conversation.save()
+            await MessageService._apply_last_message(conversation, message, seen_ids=[])
+            await InboxService.on_message(conversation, message)
             
             # Chỉ broadcast nếu được yêu cầu
             if broadcast:
                 message_data = map_message_to_public_dict(message)
                 conversation_data = map_conversation_to_public_dict(conversation)
                 
-                tasks = [
-                    manager.broadcast_to_user(
-                        uid,
-                        {
-                            "type": "new_message",
-                            "payload": {"message": message_data, "conversation": conversation_data}
-                        }
-                    )
-                    for uid in [p.userId for p in conversation.participants]
-                ]
-                await asyncio.gather(*tasks)
+                manager.fanout.submit(
+                    [p.userId for p in conversation.participants],
+                    {
+                        "type": "new_message",
+                        "payload": {"message": message_data, "conversation": conversation_data}
+                    },
+                    lane=LANE_CHAT
+                )
         
         return message
 
+    @staticmethod
+    async def _apply_last_message(conversation: Conversation, message: Message, seen_ids: List[str]) -> bool:
+        """
+        Ghi lastMessage, updatedAt, seenIds bằng một lệnh $set (không ghi lại mảng participants).
+        Chỉ ghi khi tin nhắn không cũ hơn lastMessage hiện tại, để hai tin gửi đồng thời
+        không ghi đè nhau sai thứ tự.
+        Khi ghi thành công, đối tượng conversation trong bộ nhớ được cập nhật theo; khi đã có tin mới hơn,
+        conversation được đọc lại từ DB để broadcast trạng thái hiện tại. Trả về True nếu đã ghi.
+        """
+        last_message = LastMessage(
+            content=message.content,
+            senderId=message.senderId,
+            createdAt=message.createdAt
+        )
+        updated_at = datetime.utcnow() + timedelta(hours=7)
+        result = await Conversation.find_one({
+            "_id": conversation.id,
+            "$or": [{"lastMessage": None}, {"lastMessage.createdAt": {"$lte": message.createdAt}}]
+        }).update({"$set": {
+            "lastMessage": last_message.model_dump(),
+            "updatedAt": updated_at,
+            "seenIds": seen_ids
+        }})
+
+        if not result.matched_count:
+            # Một tin mới hơn đã được ghi trong lúc gửi: giữ nguyên, lấy trạng thái hiện tại
+            await conversation.sync()
+            return False
+
+        conversation.lastMessage = last_message
+        conversation.updatedAt = updated_at
+        conversation.seenIds = list(seen_ids)
+        return True
+
+    @staticmethod
+    async def _update_participant(conversation_id: str, user_id: str, update: dict, forbidden: str):
+        """
+        Cập nhật nguyên tử phần tử participants của user (toán tử vị trí $) trong một lệnh.
+        Khi không khớp, tra thêm để phân biệt hội thoại không tồn tại (ValueError) và user không thuộc hội thoại (PermissionError).
+        """
+        if not ObjectId.is_valid(conversation_id):
+            raise ValueError("Không tìm thấy cuộc trò chuyện.")
+        conversation_oid = ObjectId(conversation_id)
+
+        result = await Conversation.find_one({
+            "_id": conversation_oid,
+            "participants.userId": user_id
+        }).update(update)
+        if result.matched_count:
+            return
+
+        if not await Conversation.find({"_id": conversation_oid}).count():
+            raise ValueError("Không tìm thấy cuộc trò chuyện.")
+        raise PermissionError(forbidden)
+
     async def get_or_create_conversation(
         participant_ids: List[str],
         is_group: bool = False,
@@ -90,7 +140,7 @@ class MessageService:
     ):
         """
         Tìm một cuộc trò chuyện hiện có hoặc tạo mới.
-        - Nếu là chat 1–1 => tìm chính xác 2 người.
+        - Nếu là chat 1–1 => tìm theo pairKey (index duy nhất, không tạo trùng khi gọi đồng thời).
         - Nếu là group => luôn tạo mới (vì có thể có nhiều nhóm trùng thành viên).
         """
         canonical_participants = sorted(list(set(participant_ids)))
@@ -98,13 +148,13 @@ class MessageService:
         if len(canonical_participants) < 2:
             raise ValueError("Một cuộc trò chuyện yêu cầu ít nhất hai người tham gia.")
 
+        pair_key = None
         if not is_group:
-            # 🔍 Tìm chat 1–1 có đúng 2 user
-            conversation = await Conversation.find_one({
-                "participants": {"$size": len(canonical_participants)},
-                "participants.userId": {"$all": canonical_participants},
-                "isGroup": False
-            })
+            if len(canonical_participants) != 2:
+                raise ValueError("Chat 1-1 yêu cầu đúng hai người tham gia.")
+            # 🔍 Tìm chat 1–1 bằng một lần đọc theo khóa
+            pair_key = make_pair_key(canonical_participants)
+            conversation = await Conversation.find_one(Conversation.pairKey == pair_key)
         else:
             # 🔍 Group chat luôn tạo mới
             conversation = None
@@ -115,8 +165,15 @@ class MessageService:
                 participants=participants,
                 isGroup=is_group,
                 name=name,
+                pairKey=pair_key,
             )
-            await conversation.insert()
+            try:
+                await conversation.insert()
+            except DuplicateKeyError:
+                # Request đồng thời đã tạo chat 1-1 này trước
+                return await Conversation.find_one(Conversation.pairKey == pair_key)
+            await manager.invalidate_membership(str(conversation.id))
+            await InboxService.sync_members(conversation)
             
             # Nếu là nhóm, tạo tin nhắn system
             if is_group and name:
@@ -197,14 +254,8 @@ class MessageService:
         await message.save()
 
         # Cập nhật lastMessage cho conversation
-        conversation.lastMessage = LastMessage(
-            content=message.content,
-            senderId=message.senderId,
-            createdAt=message.createdAt
-        )
-        conversation.updatedAt = datetime.utcnow() + timedelta(hours=7)
-        conversation.seenIds = [sender_id]
-        await conversation.save()
+        await MessageService._apply_last_message(conversation, message, seen_ids=[sender_id])
+        await InboxService.on_message(conversation, message)
 
         # Chỉ lấy sender nếu sender_id hợp lệ (không phải system hoặc deleted)
         sender = None
@@ -235,17 +286,14 @@ class MessageService:
 
         conversation_data = map_conversation_to_public_dict(conversation)
 
-        tasks = [
-            manager.broadcast_to_user(
-                uid,
-                {
-                    "type": "new_message",
-                    "payload": {"message": message_data, "conversation": conversation_data}
-                }
-            )
-            for uid in [p.userId for p in conversation.participants]
-        ]
-        await asyncio.gather(*tasks)
+        manager.fanout.submit(
+            [p.userId for p in conversation.participants],
+            {
+                "type": "new_message",
+                "payload": {"message": message_data, "conversation": conversation_data}
+            },
+            lane=LANE_CHAT
+        )
 
         # Gửi push notification cho tất cả users (không tắt thông báo, không phải sender)
         # Client sẽ tự quyết định hiển thị hay không dựa trên app state
@@ -353,11 +401,23 @@ class MessageService:
         conversation_id: str,
         user_id: str,
         limit: int = 50,
-        skip: int = 0
+        skip: int = 0,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        around: Optional[str] = None
     ):
         """
         Lấy tin nhắn cho một cuộc trò chuyện, chỉ gồm những tin nhắn sau khi user xóa (nếu có).
+        Kết quả luôn xếp từ mới đến cũ.
+
+        Phân trang theo cursor (chi phí mỗi trang không phụ thuộc độ sâu):
+            before: ID tin nhắn hoặc thời điểm ISO - lấy các tin cũ hơn
+            after: ID tin nhắn hoặc thời điểm ISO - lấy các tin mới hơn (gần cursor nhất)
+            around: ID tin nhắn - lấy cửa sổ quanh tin nhắn đó (gồm cả nó), dùng khi nhảy tới tin nhắn
+        skip chỉ còn để tương thích với client cũ khi không dùng cursor.
         """
+        if sum(cursor is not None for cursor in (before, after, around)) > 1:
+            raise ValueError("Chỉ được dùng một trong các tham số before, after, around.")
         conversation = await Conversation.get(conversation_id)
         if not conversation:
             raise PermissionError("Cuộc trò chuyện không tồn tại.")
@@ -375,14 +435,26 @@ class MessageService:
         if delete_time:
             query["createdAt"] = {"$gt": delete_time}
 
-        messages = (
-            await Message.find(
+        if before is not None:
+            position = await MessageService._resolve_cursor(conversation_id, before)
+            messages = await MessageService._page(query, position, older=True, limit=limit)
+        elif after is not None:
+            position = await MessageService._resolve_cursor(conversation_id, after)
+            messages = await MessageService._page(query, position, older=False, limit=limit)
+        elif around is not None:
+            anchor = await MessageService._find_anchor(conversation_id, around)
+            position = (anchor.createdAt, anchor.id)
+            newer = await MessageService._page(query, position, older=False, limit=limit // 2)
+            older = await MessageService._page(query, position, older=True, limit=max(limit - len(newer) - 1, 0))
+            visible = not delete_time or anchor.createdAt > delete_time
+            messages = newer + ([anchor] if visible else []) + older
+        else:
+            messages = await Message.find(
                 query,
-                sort="-createdAt",
+                sort=[("createdAt", -1), ("_id", -1)],
                 skip=skip,
                 limit=limit
             ).to_list()
-        )
 
         # Lấy người gửi để gắn thêm thông tin hiển thị
         sender_ids = list(set(msg.senderId for msg in messages))
@@ -430,18 +502,94 @@ class MessageService:
 
         return simple_messages
 
+    @staticmethod
+    async def _find_anchor(conversation_id: str, message_id: str) -> Message:
+        """Lấy tin nhắn làm mốc phân trang, phải thuộc cuộc trò chuyện."""
+        if not ObjectId.is_valid(message_id):
+            raise ValueError("ID tin nhắn không hợp lệ.")
+        anchor = await Message.find_one({"_id": ObjectId(message_id), "conversationId": conversation_id})
+        if not anchor:
+            raise ValueError("Không tìm thấy tin nhắn.")
+        return anchor
 
     @staticmethod
-    async def get_conversations_for_user(user_id: str):
+    async def _resolve_cursor(conversation_id: str, cursor: str) -> tuple:
+        """Chuyển cursor (ID tin nhắn hoặc thời điểm ISO) thành vị trí (createdAt, _id)."""
+        if ObjectId.is_valid(cursor):
+            anchor = await MessageService._find_anchor(conversation_id, cursor)
+            return anchor.createdAt, anchor.id
+        try:
+            return datetime.fromisoformat(cursor.replace("Z", "+00:00")).replace(tzinfo=None), None
+        except ValueError:
+            raise ValueError("Cursor không hợp lệ (cần ID tin nhắn hoặc thời điểm ISO).")
+
+    @staticmethod
+    async def _page(query: dict, position: tuple, older: bool, limit: int) -> List[Message]:
         """
-        Lấy tất cả các cuộc trò chuyện cho một người dùng cụ thể.
+        Lấy một trang tin nhắn liền kề vị trí (createdAt, _id) theo keyset trên index
+        (conversationId, createdAt, _id). Trả về danh sách xếp từ mới đến cũ.
         """
-        convos = await Conversation.find(
-            {"participants.userId": user_id}
-        ).sort("-updatedAt").to_list()
+        if limit <= 0:
+            return []
+        created_at, message_id = position
+        op = "$lt" if older else "$gt"
+        if message_id is None:
+            boundary = {"createdAt": {op: created_at}}
+        else:
+            # Các tin nhắn cùng createdAt được phân biệt bằng _id
+            boundary = {"$or": [
+                {"createdAt": {op: created_at}},
+                {"createdAt": created_at, "_id": {op: message_id}},
+            ]}
+        direction = -1 if older else 1
+        messages = await Message.find(
+            {"$and": [query, boundary]},
+            sort=[("createdAt", direction), ("_id", direction)],
+            limit=limit
+        ).to_list()
+        if not older:
+            messages.reverse()
+        return messages
 
-        result = []
+    @staticmethod
+    def conversation_cursor(conversation: ConversationWithParticipants) -> str:
+        """Cursor trỏ tới một hội thoại trong danh sách: "<updatedAt ISO>_<id>"."""
+        return f"{conversation.updatedAt.isoformat()}_{conversation.id}"
 
+    @staticmethod
+    def _parse_conversation_cursor(cursor: str) -> tuple:
+        updated_at, _, conversation_id = cursor.rpartition("_")
+        try:
+            if not ObjectId.is_valid(conversation_id):
+                raise ValueError
+            return datetime.fromisoformat(updated_at), ObjectId(conversation_id)
+        except ValueError:
+            raise ValueError("Cursor không hợp lệ.")
+
+    @staticmethod
+    def _is_deleted_for(convo: Conversation, user_id: str) -> bool:
+        """User đã xóa hội thoại và chưa có tin nhắn mới kể từ đó."""
+        participant_info = next((p for p in convo.participants if p.userId == user_id), None)
+        delete_time = participant_info.lastMessageDelete if participant_info else None
+        if not delete_time:
+            return False
+        return not convo.lastMessage or convo.lastMessage.createdAt <= delete_time
+
+    @staticmethod
+    async def build_conversation_views(convos: List[Conversation], user_id: str) -> List[ConversationWithParticipants]:
+        """
+        Dựng ConversationWithParticipants cho nhiều hội thoại.
+        Thông tin mọi người tham gia được lấy bằng một truy vấn projection duy nhất.
+        """
+        participant_ids = list(dict.fromkeys(
+            p.userId for convo in convos for p in convo.participants if ObjectId.is_valid(p.userId)
+        ))
+        users = await User.find(
+            {"_id": {"$in": [ObjectId(uid) for uid in participant_ids]}}
+        ).project(UserSummary).to_list() if participant_ids else []
+        users_map = {str(u.id): u for u in users}
+
+        result = []
         for convo in convos:
             # Lấy participant info của current_user trong conversation này
             participant_info = next(
@@ -450,13 +598,9 @@ class MessageService:
             )
             delete_time = participant_info.lastMessageDelete if participant_info else None
 
-            # Lấy thông tin chi tiết của người tham gia
-            participants = await UserService.get_users_by_ids([p.userId for p in convo.participants])
-            participants_map = {str(p.id): p for p in participants}
-
             participant_publics = []
             for participant_info in convo.participants:
-                participant_user = participants_map.get(participant_info.userId)
+                participant_user = users_map.get(participant_info.userId)
                 # Kiểm tra nếu participant đã bị xóa
                 if participant_user and participant_user.status != 'deleted':
                     participant_publics.append(
@@ -510,21 +654,92 @@ class MessageService:
             result.append(convo_with_participants)
 
         return result
+
+    @staticmethod
+    async def get_conversations_for_user(
+        user_id: str,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        include_deleted: bool = False
+    ) -> List[ConversationWithParticipants]:
+        """
+        Lấy các cuộc trò chuyện của người dùng, mới cập nhật nhất trước.
+
+        Args:
+            limit: Số hội thoại tối đa (None: lấy tất cả)
+            cursor: Cursor của hội thoại cuối trang trước (xem conversation_cursor)
+            include_deleted: Giữ cả hội thoại user đã xóa mà chưa có tin nhắn mới
+        """
+        user_id = str(user_id)
+        query = {"participants.userId": user_id}
+        if cursor:
+            updated_at, conversation_id = MessageService._parse_conversation_cursor(cursor)
+            query["$or"] = [
+                {"updatedAt": {"$lt": updated_at}},
+                {"updatedAt": updated_at, "_id": {"$lt": conversation_id}},
+            ]
+
+        # Hội thoại đã xóa bị lọc sau khi đọc, nên đọc theo lô cho tới khi đủ limit
+        convos: List[Conversation] = []
+        batch_size = limit or 0
+        while True:
+            batch = await Conversation.find(
+                query,
+                sort=[("updatedAt", -1), ("_id", -1)],
+                limit=batch_size
+            ).to_list()
+            for convo in batch:
+                if include_deleted or not MessageService._is_deleted_for(convo, user_id):
+                    convos.append(convo)
+                    if limit and len(convos) == limit:
+                        break
+            if not limit or len(convos) == limit or len(batch) < batch_size:
+                break
+            last = batch[-1]
+            query["$or"] = [
+                {"updatedAt": {"$lt": last.updatedAt}},
+                {"updatedAt": last.updatedAt, "_id": {"$lt": last.id}},
+            ]
+
+        return await MessageService.build_conversation_views(convos, user_id)
+
+    @staticmethod
+    async def get_conversation_for_user(conversation_id: str, user_id: str) -> ConversationWithParticipants:
+        """
+        Lấy một cuộc trò chuyện của người dùng: một truy vấn có điều kiện thành viên
+        và một truy vấn projection cho người tham gia (kể cả hội thoại user đã xóa, để mở lại được).
+        """
+        user_id = str(user_id)
+        if not ObjectId.is_valid(conversation_id):
+            raise ValueError("Không tìm thấy cuộc trò chuyện.")
+        conversation_oid = ObjectId(conversation_id)
+
+        conversation = await Conversation.find_one({"_id": conversation_oid, "participants.userId": user_id})
+        if not conversation:
+            # Chỉ tra thêm khi không khớp để phân biệt 404 và 403
+            if not await Conversation.find({"_id": conversation_oid}).count():
+                raise ValueError("Không tìm thấy cuộc trò chuyện.")
+            raise PermissionError("Bạn không có quyền truy cập cuộc trò chuyện này.")
+
+        views = await MessageService.build_conversation_views([conversation], user_id)
+        return views[0]
     
     @staticmethod
     async def mark_conversation_as_seen(conversation_id: str, user_id: str):
         """
         Đánh dấu một cuộc trò chuyện là đã xem bởi người dùng cụ thể.
         """
-        conversation = await Conversation.get(conversation_id)
-        if not conversation or user_id not in [p.userId for p in conversation.participants]:
+        if not ObjectId.is_valid(conversation_id):
             raise PermissionError("Bạn không được phép xem cuộc trò chuyện này.")
 
-        if user_id not in conversation.seenIds:
-            conversation.seenIds.append(user_id)
-            await conversation.save()
-
-        return conversation
+        # $addToSet nguyên tử: không ghi đè seenIds/lastMessage do người khác cập nhật cùng lúc
+        result = await Conversation.find_one({
+            "_id": ObjectId(conversation_id),
+            "participants.userId": user_id
+        }).update({"$addToSet": {"seenIds": user_id}})
+        if not result.matched_count:
+            raise PermissionError("Bạn không được phép xem cuộc trò chuyện này.")
+        await InboxService.mark_seen(conversation_id, user_id)
     
     @staticmethod
     async def recall_message(message_id: str, user_id: str):
@@ -538,34 +753,36 @@ class MessageService:
         if message.senderId != user_id:
             raise PermissionError("Bạn không có quyền thu hồi tin nhắn này.")
 
-        # Thay đổi nội dung tin nhắn
+        # Thay đổi nội dung tin nhắn (chỉ ghi trường content.type)
         message.content['type'] = 'delete'
-        await message.save()
+        await Message.find_one(Message.id == message.id).update({"$set": {"content.type": "delete"}})
 
-        # Kiểm tra và cập nhật lastMessage trong conversation
+        # Cập nhật lastMessage trong conversation nếu nó vẫn là tin nhắn vừa thu hồi
         conversation = await Conversation.get(message.conversationId)
         if conversation and conversation.lastMessage and conversation.lastMessage.createdAt == message.createdAt:
-            conversation.lastMessage.content = message.content
-            await conversation.save()
+            result = await Conversation.find_one({
+                "_id": conversation.id,
+                "lastMessage.createdAt": message.createdAt
+            }).update({"$set": {"lastMessage.content": message.content}})
+            if result.matched_count:
+                conversation.lastMessage.content = message.content
+                await InboxService.update_last_message(conversation)
 
         # Phát broadcast tin nhắn đã thu hồi
         message_data = map_message_to_public_dict(message)
         conversation_data = map_conversation_to_public_dict(conversation)
 
-        tasks = [
-            manager.broadcast_to_user(
-                uid,
-                {
-                    "type": "recalled_message",
-                    "payload": {
-                        "conversation": conversation_data,
-                        "message": message_data
-                    }
+        manager.fanout.submit(
+            [p.userId for p in conversation.participants],
+            {
+                "type": "recalled_message",
+                "payload": {
+                    "conversation": conversation_data,
+                    "message": message_data
                 }
-            )
-            for uid in [p.userId for p in conversation.participants]
-        ]
-        await asyncio.gather(*tasks)
+            },
+            lane=LANE_CHAT
+        )
 
         return message
     
@@ -574,30 +791,25 @@ class MessageService:
         """
         Xóa một cuộc trò chuyện bằng cách cập nhật ParticipantInfo của người dùng.
         """
-        conversation = await Conversation.get(conversation_id)
-        if not conversation:
-            raise ValueError("Không tìm thấy cuộc trò chuyện.")
-
-        # Kiểm tra xem người dùng có trong danh sách participants không
-        participant = next((p for p in conversation.participants if p.userId == user_id), None)
-        if not participant:
-            raise PermissionError("Bạn không có quyền xóa cuộc trò chuyện này.")
-
-        # Cập nhật thời gian xóa tin nhắn cuối cùng
-        participant.lastMessageDelete = datetime.utcnow() + timedelta(hours=7)
-        await conversation.save()
+        # Cập nhật thời gian xóa tin nhắn cuối cùng của người dùng
+        await MessageService._update_participant(
+            conversation_id,
+            user_id,
+            {"$set": {"participants.$.lastMessageDelete": datetime.utcnow() + timedelta(hours=7)}},
+            forbidden="Bạn không có quyền xóa cuộc trò chuyện này."
+        )
+        await manager.invalidate_membership(conversation_id)
+        await InboxService.hide(conversation_id, user_id)
 
         # Thông báo cho người dùng
-        task = [ 
-            manager.broadcast_to_user(
-                user_id,
-                {
-                    "type": "conversation_deleted",
-                    "payload": {"conversationId": conversation_id}
-                }
-            )
-        ]
-        await asyncio.gather(*task)
+        manager.fanout.submit(
+            [user_id],
+            {
+                "type": "conversation_deleted",
+                "payload": {"conversationId": conversation_id}
+            },
+            lane=LANE_CHAT
+        )
 
 
         return {"message": "Cuộc trò chuyện đã được xóa thành công."}
@@ -620,7 +832,7 @@ class MessageService:
         
         # Cập nhật tên
         conversation.name = new_name
-        await conversation.save()
+        await Conversation.find_one(Conversation.id == conversation.id).update({"$set": {"name": new_name}})
         
         # Tạo notification message
         await MessageService.create_notification_message(
@@ -648,7 +860,7 @@ class MessageService:
         
         # Cập nhật avatar
         conversation.avatarUrl = avatar_url
-        await conversation.save()
+        await Conversation.find_one(Conversation.id == conversation.id).update({"$set": {"avatarUrl": avatar_url}})
         
         # Tạo notification message
         await MessageService.create_notification_message(
@@ -680,9 +892,16 @@ class MessageService:
         # Lấy thông tin người rời
         user = await User.get(user_id)
         
-        # Xóa người dùng khỏi nhóm
+        # Xóa người dùng khỏi nhóm ($pull, không ghi lại cả mảng participants)
+        result = await Conversation.find_one({
+            "_id": conversation.id,
+            "participants.userId": user_id
+        }).update({"$pull": {"participants": {"userId": user_id}}})
+        if not result.matched_count:
+            raise PermissionError("Bạn không có trong nhóm này.")
         conversation.participants = [p for p in conversation.participants if p.userId != user_id]
-        await conversation.save()
+        await manager.invalidate_membership(conversation_id)
+        await InboxService.remove_member(conversation_id, user_id)
         
         # Tạo notification message (không broadcast tự động, sẽ broadcast sau)
         notification_message = await MessageService.create_notification_message(
@@ -729,16 +948,14 @@ class MessageService:
                     "participantIds": participant_ids
                 }
                 
-                await asyncio.gather(*[
-                    manager.broadcast_to_user(participant_id, {
-                        "type": "new_message",
-                        "payload": {
-                            "conversation": conversation_data,
-                            "message": message_data,
-                            "metadata": metadata
-                        }
-                    }) for participant_id in participant_ids
-                ])
+                manager.fanout.submit(participant_ids, {
+                    "type": "new_message",
+                    "payload": {
+                        "conversation": conversation_data,
+                        "message": message_data,
+                        "metadata": metadata
+                    }
+                }, lane=LANE_CHAT)
             except Exception as e:
                 print(f"Failed to broadcast member left message: {e}")
         
@@ -805,9 +1022,17 @@ class MessageService:
         if not member:
             raise ValueError("Không tìm thấy người dùng.")
         
-        # Thêm thành viên mới
-        conversation.participants.append(ParticipantInfo(userId=member_id))
-        await conversation.save()
+        # Thêm thành viên mới ($push có điều kiện, tránh thêm trùng khi hai request chạy đồng thời)
+        participant = ParticipantInfo(userId=member_id)
+        result = await Conversation.find_one({
+            "_id": conversation.id,
+            "participants.userId": {"$ne": member_id}
+        }).update({"$push": {"participants": participant.model_dump()}})
+        if not result.matched_count:
+            raise ValueError("Thành viên này đã có trong nhóm.")
+        conversation.participants.append(participant)
+        await manager.invalidate_membership(conversation_id)
+        await InboxService.sync_members(conversation, [member_id])
         
         # Lấy thông tin người thêm
         adder = await User.get(added_by)
@@ -858,15 +1083,14 @@ class MessageService:
                     "participantIds": participant_ids
                 }
                 
-                for participant_id in participant_ids:
-                    await manager.broadcast_to_user(participant_id, {
-                        "type": "new_message",
-                        "payload": {
-                            "conversation": conversation_data,
-                            "message": message_data,
-                            "metadata": metadata
-                        }
-                    })
+                manager.fanout.submit(participant_ids, {
+                    "type": "new_message",
+                    "payload": {
+                        "conversation": conversation_data,
+                        "message": message_data,
+                        "metadata": metadata
+                    }
+                }, lane=LANE_CHAT)
             except Exception as e:
                 print(f"Failed to broadcast member added message: {e}")
         
@@ -926,22 +1150,14 @@ class MessageService:
             user_id: ID của user
             muted: True để tắt thông báo, False để bật thông báo
         """
-        conversation = await Conversation.get(conversation_id)
-        if not conversation:
-            raise ValueError("Cuộc trò chuyện không tồn tại.")
-        
-        # Tìm participant info của user
-        participant = next(
-            (p for p in conversation.participants if p.userId == user_id),
-            None
+        # Cập nhật muteNotifications của đúng participant
+        await MessageService._update_participant(
+            conversation_id,
+            user_id,
+            {"$set": {"participants.$.muteNotifications": muted}},
+            forbidden="Bạn không thuộc cuộc trò chuyện này."
         )
-        
-        if not participant:
-            raise PermissionError("Bạn không thuộc cuộc trò chuyện này.")
-        
-        # Cập nhật muteNotifications
-        participant.muteNotifications = muted
-        await conversation.save()
+        await InboxService.set_muted(conversation_id, user_id, muted)
         
         return {
             "message": "Đã tắt thông báo" if muted else "Đã bật thông báo",
@@ -971,7 +1187,7 @@ class MessageService:
             
             # Cập nhật avatar trong database
             conversation.avatarUrl = avatar_url
-            await conversation.save()
+            await Conversation.find_one(Conversation.id == conversation.id).update({"$set": {"avatarUrl": avatar_url}})
             
             # Tạo notification message
             notification_message = await MessageService.create_notification_message(
@@ -981,25 +1197,16 @@ class MessageService:
                 metadata={"changed_by": user_id}
             )
             
-            # Broadcast cập nhật conversation đến tất cả thành viên
-            async def broadcast_avatar_changed():
-                try:
-                    participant_ids = [p.userId for p in conversation.participants]
-                    
-                    for participant_id in participant_ids:
-                        await manager.broadcast_to_user(participant_id, {
-                            "type": "conversation_updated",
-                            "payload": {
-                                "conversation": {
-                                    "id": conversation_id,
-                                    "avatarUrl": avatar_url
-                                }
-                            }
-                        })
-                except Exception as e:
-                    pass
-            
-            asyncio.create_task(broadcast_avatar_changed())
+            # Broadcast cập nhật conversation đến tất cả thành viên (giao nền qua fan-out)
+            manager.fanout.submit([p.userId for p in conversation.participants], {
+                "type": "conversation_updated",
+                "payload": {
+                    "conversation": {
+                        "id": conversation_id,
+                        "avatarUrl": avatar_url
+                    }
+                }
+            }, lane=LANE_CHAT)
             
             return {"avatarUrl": avatar_url}
         except Exception as e:
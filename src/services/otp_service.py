@@ -0,0 +1,98 @@
+import hashlib
+import hmac
+import os
+import secrets
+from datetime import datetime, timedelta
+from typing import Optional
+from dotenv import load_dotenv
+from ..models.otp import OTP
+from .password_hasher import password_hasher
+
+load_dotenv()
+
+# Khóa HMAC cho OTP (mặc định dùng chung SECRET_KEY của JWT)
+OTP_SECRET_KEY = os.getenv("OTP_SECRET_KEY") or os.getenv("SECRET_KEY") or ""
+OTP_EXPIRE_MINUTES = int(os.getenv("OTP_EXPIRE_MINUTES", 5))
+# Số lần nhập sai tối đa cho một mã, sau đó mã bị hủy (chặn dò mã trên mọi worker)
+OTP_MAX_ATTEMPTS = int(os.getenv("OTP_MAX_ATTEMPTS", 5))
+
+class OTPService:
+    """
+    Sinh, lưu và xác minh mã OTP.
+    Mã OTP chỉ sống vài phút nên dùng HMAC-SHA256 có khóa thay cho bcrypt.
+    """
+
+    @staticmethod
+    def generate_code() -> str:
+        """Tạo mã OTP 6 chữ số ngẫu nhiên."""
+        return str(secrets.randbelow(900000) + 100000)
+
+    @staticmethod
+    def normalize_email(email: str) -> str:
+        """Email được lưu và tra cứu ở dạng chữ thường để không phụ thuộc cách viết hoa."""
+        return email.strip().lower()
+
+    @staticmethod
+    def digest(email: str, otp_code: str) -> str:
+        """Tính HMAC của mã OTP, gắn với email để không dùng lại được cho email khác."""
+        message = f"{OTPService.normalize_email(email)}:{otp_code}".encode("utf-8")
+        return hmac.new(OTP_SECRET_KEY.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+    @staticmethod
+    async def matches(email: str, otp_code: str, stored: str) -> bool:
+        """So sánh mã OTP với giá trị đã lưu (hỗ trợ OTP cũ được băm bằng bcrypt)."""
+        if stored.startswith("$2"):
+            return await password_hasher.verify(otp_code, stored)
+        return hmac.compare_digest(OTPService.digest(email, otp_code), stored)
+
+    @staticmethod
+    async def invalidate(email: str, only_unused: bool = True):
+        """Vô hiệu hóa các OTP của email bằng một lệnh update_many."""
+        query = [OTP.email == OTPService.normalize_email(email)]
+        if only_unused:
+            query.append(OTP.is_used == False)
+        await OTP.find(*query).update({"$set": {"is_used": True}})
+
+    @staticmethod
+    async def issue(email: str) -> tuple[str, OTP]:
+        """
+        Vô hiệu hóa OTP cũ, tạo và lưu OTP mới cho email.
+
+        Returns:
+            tuple: (mã OTP thuần để gửi email, bản ghi OTP đã lưu)
+        """
+        otp_code = OTPService.generate_code()
+        email = OTPService.normalize_email(email)
+
+        await OTPService.invalidate(email)
+
+        new_otp = OTP(
+            email=email,
+            otp_code=OTPService.digest(email, otp_code),
+            expires_at=datetime.utcnow() + timedelta(minutes=OTP_EXPIRE_MINUTES),
+            is_used=False
+        )
+        await new_otp.insert()
+        return otp_code, new_otp
+
+    @staticmethod
+    async def find_active(email: str) -> Optional[OTP]:
+        """Tìm OTP chưa sử dụng, chưa hết hạn và còn lượt thử của email."""
+        return await OTP.find_one(
+            OTP.email == OTPService.normalize_email(email),
+            OTP.is_used == False,
+            OTP.expires_at > datetime.utcnow(),
+            {"attempts": {"$not": {"$gte": OTP_MAX_ATTEMPTS}}}
+        )
+
+    @staticmethod
+    async def consume_attempt(otp: OTP) -> bool:
+        """
+        Tăng số lần thử của OTP bằng một lệnh nguyên tử trước khi so mã.
+        Trả về False nếu mã đã được dùng hoặc đã hết lượt thử (kể cả khi nhiều request thử cùng lúc).
+        """
+        result = await OTP.get_motor_collection().update_one(
+            {"_id": otp.id, "is_used": False, "attempts": {"$not": {"$gte": OTP_MAX_ATTEMPTS}}},
+            {"$inc": {"attempts": 1}}
+        )
+        return result.modified_count == 1
@@ -0,0 +1,110 @@
+import asyncio
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+from passlib.context import CryptContext
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Thiết lập ngữ cảnh băm mật khẩu
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# Cấu hình executor băm: "thread" (bcrypt nhả GIL) hoặc "process"
+HASH_EXECUTOR_KIND = os.getenv("HASH_EXECUTOR_KIND", "thread")
+HASH_EXECUTOR_WORKERS = int(os.getenv("HASH_EXECUTOR_WORKERS", os.cpu_count() or 2))
+# Số tác vụ băm tối đa được đẩy vào executor cùng lúc, phần còn lại chờ trong event loop
+HASH_EXECUTOR_MAX_QUEUE = int(os.getenv("HASH_EXECUTOR_MAX_QUEUE", 64))
+
+def _hash(secret: str) -> str:
+    return pwd_context.hash(secret)
+
+def _verify(secret: str, hashed: str) -> bool:
+    return pwd_context.verify(secret, hashed)
+
+class PasswordHasher:
+    """
+    Chạy bcrypt trên một executor riêng để không chặn event loop.
+    Giới hạn số tác vụ trong executor và thống kê độ sâu hàng đợi.
+    """
+
+    def __init__(self, kind: str = "thread", max_workers: int = 2, max_queue: int = 64):
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor: Optional[Executor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+        # Metrics
+        self.waiting = 0      # Đang chờ slot (chưa vào executor)
+        self.in_executor = 0  # Đã gửi vào executor (đang chạy hoặc xếp hàng trong pool)
+        self.completed = 0
+        self.failed = 0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix="relo-hash"
+                )
+        return self._executor
+
+    async def _run(self, fn, *args):
+        # Semaphore được tạo khi đã có event loop đang chạy
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_queue)
+
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.in_executor += 1
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._get_executor(), fn, *args)
+            self.completed += 1
+            return result
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_executor -= 1
+            self._slots.release()
+
+    async def hash(self, secret: str) -> str:
+        """Băm một chuỗi bí mật (mật khẩu) trên executor."""
+        return await self._run(_hash, secret)
+
+    async def verify(self, secret: str, hashed: str) -> bool:
+        """Xác minh chuỗi bí mật với giá trị đã băm trên executor."""
+        return await self._run(_verify, secret, hashed)
+
+    def stats(self) -> dict:
+        """Thống kê độ sâu hàng đợi của executor băm."""
+        return {
+            "kind": self.kind,
+            "maxWorkers": self.max_workers,
+            "maxQueue": self.max_queue,
+            "waiting": self.waiting,
+            "inExecutor": self.in_executor,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+    def shutdown(self):
+        """Dừng executor (gọi khi ứng dụng tắt)."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+# Instance dùng chung toàn app
+password_hasher = PasswordHasher(
+    kind=HASH_EXECUTOR_KIND,
+    max_workers=HASH_EXECUTOR_WORKERS,
+    max_queue=HASH_EXECUTOR_MAX_QUEUE
+)
@@ -5,6 +5,7 @@ from fastapi import UploadFile
 from bson import ObjectId
 from ..models import Post, AuthorInfo, Reaction, MediaItem, User
 from ..websocket import manager
+from ..realtime import LANE_SOCIAL
 from ..schemas import PostPublic
 from ..utils import upload_to_cloudinary
 
@@ -87,17 +88,8 @@ class PostService:
                 }
             }
 
-            # Broadcast notification to all friends (chạy nền không block)
-            async def broadcast_notifications_in_background():
-                if author.friendIds:
-                    for fid in author.friendIds:
-                        try:
-                            await manager.broadcast_to_user(fid, notification_payload)
-                        except Exception as e:
-                            print(f"Error broadcasting to user {fid}: {e}")
-            
-            # Start broadcast task in background
-            asyncio.create_task(broadcast_notifications_in_background())
+            # Broadcast notification to all friends (fan-out chạy nền theo chunk, không block)
+            manager.fanout.submit(author.friendIds or [], notification_payload, lane=LANE_SOCIAL)
 
             return new_post
 
@@ -289,7 +281,7 @@ class PostService:
                             "reactionType": reaction_type
                         }
                     }
-                    await manager.broadcast_to_user(post.authorId, notification_payload)
+                    manager.fanout.submit([post.authorId], notification_payload, lane=LANE_SOCIAL)
                 
                 # Start notification task in background
                 asyncio.create_task(create_reaction_notification())
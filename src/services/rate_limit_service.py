@@ -0,0 +1,162 @@
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Giới hạn theo IP (dùng chung cho các endpoint xác thực)
+AUTH_RATE_IP_PER_MINUTE = float(os.getenv("AUTH_RATE_IP_PER_MINUTE", 30))
+AUTH_RATE_IP_BURST = int(os.getenv("AUTH_RATE_IP_BURST", 10))
+# Giới hạn theo username/email trên từng endpoint
+AUTH_RATE_IDENTIFIER_PER_MINUTE = float(os.getenv("AUTH_RATE_IDENTIFIER_PER_MINUTE", 10))
+AUTH_RATE_IDENTIFIER_BURST = int(os.getenv("AUTH_RATE_IDENTIFIER_BURST", 5))
+# Số request xác thực (băm bcrypt) được xử lý đồng thời trên một worker
+AUTH_MAX_CONCURRENT = int(os.getenv("AUTH_MAX_CONCURRENT", 32))
+# Số key (IP/identifier) tối đa được theo dõi, key cũ nhất bị loại trước
+AUTH_RATE_MAX_KEYS = int(os.getenv("AUTH_RATE_MAX_KEYS", 100000))
+# Lấy IP từ X-Forwarded-For (chỉ bật khi chạy sau reverse proxy tin cậy)
+TRUST_PROXY_HEADERS = os.getenv("TRUST_PROXY_HEADERS", "false").lower() == "true"
+
+class RateLimitExceeded(Exception):
+    """Request bị từ chối bởi bộ giới hạn; retry_after là số giây nên chờ."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucketLimiter:
+    """
+    Token bucket theo key, giữ trong bộ nhớ và loại key theo LRU khi vượt kích thước.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int, maxsize: int = 100000):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets: "OrderedDict[Hashable, tuple[float, float]]" = OrderedDict()
+
+    def try_acquire(self, key: Hashable) -> float:
+        """Lấy một token. Trả về 0 nếu được phép, ngược lại là số giây cần chờ."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (float(self.burst), now))
+        tokens = min(float(self.burst), tokens + (now - updated) * self.rate)
+
+        if tokens >= 1:
+            self._buckets[key] = (tokens - 1, now)
+            retry_after = 0.0
+        else:
+            self._buckets[key] = (tokens, now)
+            retry_after = (1 - tokens) / self.rate if self.rate > 0 else 60.0
+
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+class SlidingWindowCounter:
+    """Đếm số sự kiện trong window_seconds giây gần nhất (chia ô 1 giây)."""
+
+    def __init__(self, window_seconds: int = 60):
+        self.window_seconds = window_seconds
+        self._slots: deque = deque()  # (giây, số lượng)
+
+    def _trim(self, now: int):
+        while self._slots and self._slots[0][0] <= now - self.window_seconds:
+            self._slots.popleft()
+
+    def add(self, count: int = 1):
+        now = int(time.monotonic())
+        self._trim(now)
+        if self._slots and self._slots[-1][0] == now:
+            self._slots[-1] = (now, self._slots[-1][1] + count)
+        else:
+            self._slots.append((now, count))
+
+    def total(self) -> int:
+        self._trim(int(time.monotonic()))
+        return sum(count for _, count in self._slots)
+
+class AuthAdmissionControl:
+    """
+    Kiểm soát tải cho các endpoint xác thực tốn CPU (bcrypt, OTP):
+    token bucket theo IP và theo identifier, cộng giới hạn số request đồng thời.
+    Request vượt giới hạn bị từ chối ngay (429) để giữ CPU cho lưu lượng nhắn tin.
+    """
+
+    def __init__(self, max_concurrent: int):
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self.ip_limiter = TokenBucketLimiter(AUTH_RATE_IP_PER_MINUTE, AUTH_RATE_IP_BURST, AUTH_RATE_MAX_KEYS)
+        self.identifier_limiter = TokenBucketLimiter(
+            AUTH_RATE_IDENTIFIER_PER_MINUTE, AUTH_RATE_IDENTIFIER_BURST, AUTH_RATE_MAX_KEYS
+        )
+
+        # Metrics: số request bị từ chối theo lý do (tổng và trong 60 giây gần nhất)
+        self.admitted = 0
+        self.shed_total: Dict[str, int] = {"ip": 0, "identifier": 0, "concurrency": 0}
+        self.shed_recent: Dict[str, SlidingWindowCounter] = {
+            reason: SlidingWindowCounter() for reason in self.shed_total
+        }
+
+    def _shed(self, reason: str, message: str, retry_after: float):
+        self.shed_total[reason] += 1
+        self.shed_recent[reason].add()
+        raise RateLimitExceeded(message, retry_after)
+
+    @asynccontextmanager
+    async def guard(self, endpoint: str, ip: Optional[str], identifier: Optional[str] = None):
+        """
+        Bao quanh phần xử lý của endpoint.
+
+        Raises:
+            RateLimitExceeded: Nếu request vượt giới hạn
+        """
+        # Kiểm tra giới hạn đồng thời trước để không tiêu token của request bị từ chối
+        if self.in_flight >= self.max_concurrent:
+            self._shed("concurrency", "Hệ thống đang bận, vui lòng thử lại sau.", 1.0)
+
+        if ip:
+            retry_after = self.ip_limiter.try_acquire(ip)
+            if retry_after:
+                self._shed("ip", "Bạn thao tác quá nhanh, vui lòng thử lại sau.", retry_after)
+
+        if identifier:
+            retry_after = self.identifier_limiter.try_acquire((endpoint, identifier.strip().lower()))
+            if retry_after:
+                self._shed("identifier", "Quá nhiều yêu cầu cho tài khoản này, vui lòng thử lại sau.", retry_after)
+
+        self.admitted += 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> dict:
+        """Thống kê số request được nhận và bị từ chối."""
+        return {
+            "inFlight": self.in_flight,
+            "maxConcurrent": self.max_concurrent,
+            "admitted": self.admitted,
+            "shedTotal": dict(self.shed_total),
+            "shedLastMinute": {reason: counter.total() for reason, counter in self.shed_recent.items()},
+            "trackedIps": len(self.ip_limiter),
+            "trackedIdentifiers": len(self.identifier_limiter),
+        }
+
+def get_client_ip(request) -> Optional[str]:
+    """Lấy IP của client từ request FastAPI."""
+    if TRUST_PROXY_HEADERS:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else None
+
+# Instance dùng chung toàn app
+auth_admission = AuthAdmissionControl(max_concurrent=AUTH_MAX_CONCURRENT)
@@ -0,0 +1,236 @@
+import asyncio
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+from beanie import UpdateResponse
+from bson import ObjectId
+from dotenv import load_dotenv
+from ..models.session import Session, SessionRevocation
+from . import jwt_service
+
+load_dotenv()
+
+# Xoay vòng refresh token: mỗi lần refresh trả về refresh token mới, token cũ bị vô hiệu.
+# Client cần lưu lại refresh_token trả về từ /api/auth/refresh; đặt "false" để tắt.
+REFRESH_TOKEN_ROTATION = os.getenv("REFRESH_TOKEN_ROTATION", "true").lower() == "true"
+# Chu kỳ đồng bộ danh sách phiên bị thu hồi từ MongoDB (giây)
+SESSION_REVOCATION_SYNC_SECONDS = float(os.getenv("SESSION_REVOCATION_SYNC_SECONDS", 30))
+# Lùi mốc đồng bộ để không bỏ sót phiên do lệch đồng hồ giữa các instance
+SESSION_REVOCATION_SYNC_SKEW = timedelta(seconds=5)
+# Refresh luôn kiểm tra phiên trong MongoDB, nên danh sách trong bộ nhớ chỉ cần chặn
+# access token còn sống: giữ phiên bị thu hồi trong thời gian sống của access token
+SESSION_REVOCATION_HORIZON = timedelta(minutes=jwt_service.ACCESS_TOKEN_EXPIRE_MINUTES) + SESSION_REVOCATION_SYNC_SKEW
+
+def _timestamp(value: datetime) -> float:
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+class RevocationList:
+    """
+    Tập ID phiên đã bị thu hồi, giữ trong bộ nhớ để kiểm tra O(1) khi xác thực access token.
+    Được nạp lúc khởi động và đồng bộ định kỳ từ collection 'sessions'
+    để thấy cả các phiên bị thu hồi trên instance khác. Mỗi phiên chỉ được giữ
+    trong SESSION_REVOCATION_HORIZON kể từ lúc thu hồi (access token cấp trước đó đã hết hạn).
+    """
+
+    def __init__(self, sync_interval: float = 30.0):
+        self.sync_interval = sync_interval
+        self._revoked: Dict[str, float] = {}  # sid -> thời điểm có thể bỏ khỏi danh sách (timestamp)
+        self._last_sync: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, sid: str, revoked_at: Optional[datetime], expires_at: datetime):
+        """Đánh dấu phiên đã bị thu hồi tới khi access token cuối cùng của nó hết hạn."""
+        until = expires_at
+        if revoked_at is not None:
+            until = min(until, revoked_at + SESSION_REVOCATION_HORIZON)
+        self._revoked[str(sid)] = _timestamp(until)
+
+    def is_revoked(self, sid: str) -> bool:
+        return sid in self._revoked
+
+    async def sync(self):
+        """Nạp các phiên bị thu hồi kể từ lần đồng bộ trước và dọn các phiên đã hết hạn."""
+        started = datetime.utcnow()
+        if self._last_sync is None:
+            query = [Session.revoked == True, Session.revokedAt > started - SESSION_REVOCATION_HORIZON]
+        else:
+            query = [Session.revoked == True, Session.revokedAt >= self._last_sync - SESSION_REVOCATION_SYNC_SKEW]
+
+        revoked = await Session.find(*query).project(SessionRevocation).to_list()
+        for item in revoked:
+            self.add(str(item.id), item.revokedAt, item.expiresAt)
+
+        now = time.time()
+        for sid in [sid for sid, expires in self._revoked.items() if expires <= now]:
+            del self._revoked[sid]
+        self._last_sync = started
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                print(f"Lỗi khi đồng bộ danh sách phiên bị thu hồi: {e}")
+
+    async def start(self):
+        """Nạp danh sách lần đầu và chạy tác vụ đồng bộ nền (gọi sau init_db)."""
+        await self.sync()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "revoked": len(self._revoked),
+            "lastSync": self._last_sync.isoformat() if self._last_sync else None,
+        }
+
+class SessionService:
+    """
+    Quản lý phiên đăng nhập: mỗi thiết bị một phiên, mỗi phiên một họ refresh token.
+    """
+
+    @staticmethod
+    def new_jti() -> str:
+        return uuid.uuid4().hex
+
+    @staticmethod
+    async def create(user_id: str, device_token: Optional[str] = None) -> Session:
+        """Tạo phiên mới khi đăng nhập."""
+        session = Session(
+            userId=user_id,
+            currentJti=SessionService.new_jti(),
+            deviceToken=device_token.strip() if device_token and device_token.strip() else None,
+            expiresAt=datetime.utcnow() + timedelta(days=jwt_service.REFRESH_TOKEN_EXPIRE_DAYS)
+        )
+        await session.insert()
+        return session
+
+    @staticmethod
+    def create_access_token(user_id: str, sid: Optional[str] = None) -> str:
+        data = {"sub": user_id}
+        if sid:
+            data["sid"] = sid
+        return jwt_service.create_access_token(
+            data=data,
+            expires_delta=timedelta(minutes=jwt_service.ACCESS_TOKEN_EXPIRE_MINUTES)
+        )
+
+    @staticmethod
+    def create_refresh_token(user_id: str, sid: str, jti: str) -> str:
+        return jwt_service.create_refresh_token(data={"sub": user_id, "sid": sid, "jti": jti})
+
+    @staticmethod
+    async def revoke(sid: str) -> bool:
+        """Thu hồi một phiên (cả họ refresh token). Trả về False nếu phiên không tồn tại hoặc đã bị thu hồi."""
+        if not ObjectId.is_valid(sid):
+            return False
+        session = await Session.find_one(Session.id == ObjectId(sid), Session.revoked == False).update(
+            {"$set": {"revoked": True, "revokedAt": datetime.utcnow()}},
+            response_type=UpdateResponse.NEW_DOCUMENT
+        )
+        if session is None:
+            return False
+        revoked_sessions.add(sid, session.revokedAt, session.expiresAt)
+        return True
+
+    @staticmethod
+    async def revoke_by_device(user_id: str, device_token: str):
+        """Thu hồi các phiên của user gắn với device token (dùng cho token cũ không có sid)."""
+        sessions = await Session.find(
+            Session.userId == user_id,
+            Session.deviceToken == device_token,
+            Session.revoked == False
+        ).project(SessionRevocation).to_list()
+        if not sessions:
+            return
+
+        revoked_at = datetime.utcnow()
+        await Session.find({"_id": {"$in": [item.id for item in sessions]}}).update(
+            {"$set": {"revoked": True, "revokedAt": revoked_at}}
+        )
+        for item in sessions:
+            revoked_sessions.add(str(item.id), revoked_at, item.expiresAt)
+
+    @staticmethod
+    async def rotate(sid: str, jti: str) -> str:
+        """
+        Đổi refresh token hiện tại của phiên bằng một lệnh update có điều kiện.
+
+        Returns:
+            str: jti mới
+
+        Raises:
+            PermissionError: Nếu phiên đã bị thu hồi hoặc refresh token cũ bị dùng lại
+        """
+        new_jti = SessionService.new_jti()
+        result = await Session.find_one(
+            Session.id == ObjectId(sid),
+            Session.currentJti == jti,
+            Session.revoked == False
+        ).update(
+            {"$set": {"currentJti": new_jti, "lastUsedAt": datetime.utcnow()}},
+            response_type=UpdateResponse.UPDATE_RESULT
+        )
+        if result.modified_count == 1:
+            return new_jti
+
+        # Refresh token không còn là token hiện tại: nếu phiên còn hiệu lực thì token cũ
+        # đang bị dùng lại (có thể đã bị lộ) -> thu hồi cả họ token
+        if await SessionService.revoke(sid):
+            print(f"Phát hiện refresh token bị dùng lại, đã thu hồi phiên {sid}")
+        raise PermissionError("Refresh token đã bị thu hồi hoặc đã được sử dụng")
+
+    @staticmethod
+    async def validate(sid: str, jti: Optional[str]):
+        """
+        Kiểm tra phiên trong MongoDB khi không xoay vòng refresh token.
+
+        Raises:
+            PermissionError: Nếu phiên không tồn tại, đã bị thu hồi/hết hạn hoặc jti không khớp
+        """
+        query = [Session.id == ObjectId(sid), Session.revoked == False, Session.expiresAt > datetime.utcnow()]
+        if jti:
+            query.append(Session.currentJti == jti)
+        if await Session.find(*query).count() == 0:
+            raise PermissionError("Phiên đăng nhập đã bị thu hồi")
+
+    @staticmethod
+    async def refresh(user_id: str, sid: Optional[str], jti: Optional[str]) -> dict:
+        """
+        Cấp access token mới từ refresh token đã được giải mã.
+        Phiên luôn được kiểm tra trong MongoDB (danh sách trong bộ nhớ chỉ giữ phiên bị thu hồi gần đây).
+        Nếu bật xoay vòng, trả kèm refresh token mới (token cũ không có sid sẽ được gắn vào phiên mới).
+
+        Raises:
+            PermissionError: Nếu phiên đã bị thu hồi hoặc refresh token bị dùng lại
+        """
+        if sid and revoked_sessions.is_revoked(sid):
+            raise PermissionError("Phiên đăng nhập đã bị thu hồi")
+
+        tokens = {}
+        if REFRESH_TOKEN_ROTATION:
+            if sid and jti and ObjectId.is_valid(sid):
+                new_jti = await SessionService.rotate(sid, jti)
+            else:
+                session = await SessionService.create(user_id)
+                sid, new_jti = str(session.id), session.currentJti
+            tokens["refresh_token"] = SessionService.create_refresh_token(user_id, sid, new_jti)
+        elif sid:
+            if not ObjectId.is_valid(sid):
+                raise PermissionError("Phiên đăng nhập không hợp lệ")
+            await SessionService.validate(sid, jti)
+
+        tokens["access_token"] = SessionService.create_access_token(user_id, sid)
+        return tokens
+
+# Instance dùng chung toàn app
+revoked_sessions = RevocationList(sync_interval=SESSION_REVOCATION_SYNC_SECONDS)
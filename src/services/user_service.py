@@ -7,7 +7,9 @@ from ..models import User
 from ..models import FriendRequest
 from ..schemas import UserUpdate
 from ..websocket import manager
+from ..realtime import LANE_SOCIAL
 from ..services.notification_service import NotificationService
+from ..services.inbox_service import InboxService
 from bson import ObjectId
 import base64
 import tempfile
@@ -74,9 +76,7 @@ class UserService:
                 "avatar": from_user.avatarUrl
             }
         }
-        asyncio.create_task(
-            manager.broadcast_to_user(to_user_id, notification_payload)
-        )
+        manager.fanout.submit([to_user_id], notification_payload, lane=LANE_SOCIAL)
 
         # Gửi push notification cho friend request (chỉ khi user offline)
         # Nếu user đang online, đã nhận qua WebSocket rồi
@@ -177,9 +177,7 @@ class UserService:
                     "avatarUrl": to_user.avatarUrl
                 }
             }
-            asyncio.create_task(
-                manager.broadcast_to_user(friend_request.fromUserId, notification_payload_from)
-            )
+            manager.fanout.submit([friend_request.fromUserId], notification_payload_from, lane=LANE_SOCIAL)
             
             # Gửi cho người chấp nhận
             notification_added = await NotificationService.create_notification(
@@ -199,9 +197,7 @@ class UserService:
                     "avatarUrl": from_user.avatarUrl
                 }
             }
-            asyncio.create_task(
-                manager.broadcast_to_user(str(to_user.id), notification_payload_to)
-            )
+            manager.fanout.submit([str(to_user.id)], notification_payload_to, lane=LANE_SOCIAL)
 
         elif response == 'reject':
             # Từ chối yêu cầu - chỉ xóa khỏi database, không gửi thông báo
@@ -363,6 +359,10 @@ class UserService:
             blocked_user.friendIds.remove(user_id)
             await blocked_user.save()
 
+        # Xóa principal đã cache của cả hai người dùng (trên mọi worker/node)
+        manager.invalidate("principal", user_id)
+        manager.invalidate("principal", block_user_id)
+
         # Xóa tất cả lời mời kết bạn giữa 2 người dùng nếu có (cả 2 hướng)
         friend_requests = await FriendRequest.find({
             "$or": [
@@ -385,9 +385,7 @@ class UserService:
                 "displayName": blocked_user.displayName
             }
         }
-        asyncio.create_task(
-            manager.broadcast_to_user(user_id, notification_payload_blocker)
-        )
+        manager.fanout.submit([user_id], notification_payload_blocker, lane=LANE_SOCIAL)
         
         # Gửi cho người bị chặn
         notification_payload_blocked = {
@@ -397,9 +395,7 @@ class UserService:
                 "displayName": user.displayName
             }
         }
-        asyncio.create_task(
-            manager.broadcast_to_user(block_user_id, notification_payload_blocked)
-        )
+        manager.fanout.submit([block_user_id], notification_payload_blocked, lane=LANE_SOCIAL)
 
         return {"message": "Người dùng đã bị chặn thành công."}
 
@@ -426,9 +422,7 @@ class UserService:
                         "displayName": blocked_user.displayName
                     }
                 }
-                asyncio.create_task(
-                    manager.broadcast_to_user(user_id, notification_payload)
-                )
+                manager.fanout.submit([user_id], notification_payload, lane=LANE_SOCIAL)
 
         return {"message": "Người dùng đã được bỏ chặn thành công."}
 
@@ -685,6 +679,7 @@ class UserService:
 
             # 4️⃣ Lưu vào database
             await user.save()
+            await InboxService.refresh_peer(user)
             
             return user
 
@@ -732,6 +727,7 @@ class UserService:
             user.avatarPublicId = result["public_id"]
             
             await user.save()
+            await InboxService.refresh_peer(user)
             return user
         finally:
             # Clean up temp file
@@ -788,6 +784,7 @@ class UserService:
         user.status = 'deleted'
         user.updatedAt = datetime.utcnow()
         await user.save()
+        await InboxService.refresh_peer(user)
         
         return {"message": "Tài khoản đã được xóa thành công."}
 
@@ -1,2 +1,3 @@
 from .upload_to_cloudinary import upload_to_cloudinary
 from .map_to_dict import map_conversation_to_public_dict, map_message_to_public_dict
+from .ttl_cache import TTLCache
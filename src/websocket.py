@@ -1,71 +1,322 @@
 # api/src/websocket.py
-from typing import Dict, List, Any
+import asyncio
+from typing import Dict, Iterable, List, Optional, Union
 from fastapi import APIRouter, WebSocket, Depends, WebSocketDisconnect
-from datetime import datetime
-from .models import User
-from .security import get_current_user_ws
+from .realtime import (
+    ActivityChannel, Backplane, CommandQueue, Connection, EncodedEvent, FanoutScheduler, HeartbeatMonitor, PresenceTracker,
+    ReplayBuffer, JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL, create_backplane, decode_event,
+    decode_event_msgpack, invalidate_friends, invalidate_membership, is_replayable, msgpack_available,
+    membership_cache, MEMBERSHIP_CACHE_DISTRIBUTED_TTL_SECONDS
+)
+from .models import UserPrincipal
+from .security import get_current_user_ws, invalidate_principal, principal_cache, PRINCIPAL_CACHE_DISTRIBUTED_TTL_SECONDS
 
 router = APIRouter()
 
+# Cận dưới của các khoảng trong histogram độ sâu hàng đợi gửi
+QUEUE_DEPTH_BUCKETS = (0, 1, 8, 32, 128)
+
+def queue_depth_histogram(depths: Iterable[int]) -> Dict[str, int]:
+    """Đếm số kết nối theo khoảng độ sâu hàng đợi: "0", "1-7", "8-31", "32-127", "128+"."""
+    labels = []
+    for i, low in enumerate(QUEUE_DEPTH_BUCKETS):
+        high = QUEUE_DEPTH_BUCKETS[i + 1] - 1 if i + 1 < len(QUEUE_DEPTH_BUCKETS) else None
+        labels.append(str(low) if high == low else (f"{low}-{high}" if high is not None else f"{low}+"))
+    histogram = dict.fromkeys(labels, 0)
+    for depth in depths:
+        index = max(i for i, low in enumerate(QUEUE_DEPTH_BUCKETS) if depth >= low)
+        histogram[labels[index]] += 1
+    return histogram
+
 class ConnectionManager:
-    def __init__(self):
-        # Ánh xạ user_id tới danh sách các kết nối WebSocket đang hoạt động
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+    def __init__(self, backplane: Optional[Backplane] = None):
+        # Ánh xạ user_id tới danh sách các kết nối WebSocket đang hoạt động (trong process này)
+        self.active_connections: Dict[str, List[Connection]] = {}
+        # Pub/sub giữa các worker/node để giao sự kiện tới socket ở process khác
+        self.backplane = backplane or create_backplane()
+        # Ping định kỳ và thu dọn kết nối chết
+        self.heartbeat = HeartbeatMonitor(self.iter_connections)
+        # Trạng thái online/offline, đẩy thay đổi cho bạn bè theo lô
+        # (chỉ gửi cho socket cục bộ; thay đổi trạng thái được phát qua backplane cho node khác)
+        self.presence = PresenceTracker(
+            is_connected=lambda user_id: user_id in self.active_connections,
+            broadcast=self.broadcast_local,
+            node_id=self.backplane.node_id,
+            publish=self.backplane.publish_control if self.backplane.distributed else None
+        )
+        self.backplane.on_control("presence", self.presence.on_remote)
+        # Sự kiện tạm thời (đang nhập, đang ghi âm), không ghi DB
+        self.activity = ActivityChannel(is_reachable=self.is_reachable, broadcast=self.broadcast_to_users)
+        # Cache cục bộ được xóa trên mọi node qua backplane: loại -> hàm xóa theo key
+        self._invalidators = {
+            "membership": invalidate_membership,
+            "principal": invalidate_principal,
+            "friends": invalidate_friends,
+        }
+        for kind, handler in self._invalidators.items():
+            self.backplane.on_control(kind, handler)
+        self._control_tasks = set()
+        if self.backplane.distributed:
+            membership_cache.ttl = min(membership_cache.ttl, MEMBERSHIP_CACHE_DISTRIBUTED_TTL_SECONDS)
+            principal_cache.ttl = min(principal_cache.ttl, PRINCIPAL_CACHE_DISTRIBUTED_TTL_SECONDS)
+        # Số thứ tự sự kiện theo user và vòng đệm để phát lại khi kết nối lại
+        self.replay = ReplayBuffer()
+        # Hàng đợi giao sự kiện cho nhóm người nhận lớn (chia chunk, ưu tiên chat)
+        self.fanout = FanoutScheduler(broadcast=self.broadcast_to_users)
+
+    async def start(self):
+        """Kết nối backplane và chạy heartbeat (gọi khi ứng dụng khởi động)."""
+        await self.backplane.start(self._deliver_remote)
+        await self.heartbeat.start()
+        await self.presence.start()
+        self.fanout.start()
+
+    async def stop(self):
+        await self.fanout.stop()
+        await self.presence.stop()
+        await self.heartbeat.stop()
+        await self.backplane.stop()
+
+    def iter_connections(self) -> Iterable[Connection]:
+        """Duyệt tất cả kết nối trong process này."""
+        for connections in self.active_connections.values():
+            yield from connections
 
-    async def connect(self, user_id: str, websocket: WebSocket):
-        """Đăng ký một kết nối WebSocket mới cho một người dùng."""
-        await websocket.accept()
+    @staticmethod
+    def negotiate_subprotocol(websocket: WebSocket) -> Optional[str]:
+        """
+        Chọn subprotocol theo danh sách client gửi trong Sec-WebSocket-Protocol.
+        Client không yêu cầu gì thì giữ JSON dạng text như cũ.
+        """
+        requested = websocket.scope.get("subprotocols") or []
+        if MSGPACK_SUBPROTOCOL in requested and msgpack_available():
+            return MSGPACK_SUBPROTOCOL
+        if JSON_SUBPROTOCOL in requested:
+            return JSON_SUBPROTOCOL
+        return None
+
+    async def connect(
+        self,
+        user_id: str,
+        websocket: WebSocket,
+        since: Optional[int] = None,
+        epoch: Optional[str] = None,
+        heartbeat: bool = False
+    ) -> Connection:
+        """
+        Đăng ký một kết nối WebSocket mới cho một người dùng.
+        Nếu client gửi since/epoch của lần kết nối trước, phát lại các sự kiện bị lỡ.
+        heartbeat: client trả lời ping JSON, áp dụng WS_IDLE_TIMEOUT cho kết nối này.
+        """
+        subprotocol = self.negotiate_subprotocol(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+        connection = Connection(
+            websocket, user_id,
+            on_closed=self._remove,
+            binary=subprotocol == MSGPACK_SUBPROTOCOL,
+            heartbeat=heartbeat
+        )
+        connection.start()
         if user_id not in self.active_connections:
             self.active_connections[user_id] = []
-        self.active_connections[user_id].append(websocket)
+        self.active_connections[user_id].append(connection)
+        # Phát lại ngay sau khi đăng ký (không có await xen giữa) để không lỡ hay lặp sự kiện
+        self._resume(connection, since, epoch)
+        self.presence.on_connect(user_id)
+        # Nhận sự kiện của user từ các node khác
+        await self.backplane.subscribe(user_id)
+        return connection
+
+    def _resume(self, connection: Connection, since: Optional[int], epoch: Optional[str]):
+        """
+        Gửi frame hello (epoch, seq hiện tại) rồi phát lại sự kiện bị lỡ hoặc yêu cầu client tải lại.
+        Khi chạy nhiều node, bộ đệm của process không chứa sự kiện giao ở node khác trong lúc user
+        không kết nối tại đây, nên kết nối lại luôn nhận resync_required.
+        """
+        user_id = connection.user_id
+        current_epoch, current_seq = self.replay.position(user_id)
+        connection.enqueue(EncodedEvent({"type": "hello", "payload": {"epoch": current_epoch, "seq": current_seq}}))
+        if since is None:
+            return
+
+        missed = None
+        if not self.backplane.distributed:
+            # Chừa chỗ trong hàng đợi gửi để không tự làm rơi sự kiện đang phát lại
+            missed = self.replay.missed(user_id, since, epoch, limit=connection.queue.maxsize - 1)
+        if missed is None:
+            connection.enqueue(EncodedEvent({
+                "type": "resync_required",
+                "payload": {"epoch": current_epoch, "seq": current_seq}
+            }))
+            return
+        for event in missed:
+            connection.enqueue(event)
 
     def disconnect(self, user_id: str, websocket: WebSocket):
-        """Xóa một kết nối WebSocket."""
-        if user_id in self.active_connections:
-            self.active_connections[user_id].remove(websocket)
-            if not self.active_connections[user_id]:
-                del self.active_connections[user_id]
-
-    def _serialize_for_json(self, obj: Any) -> Any:
-        """Chuyển đổi datetime thành ISO string để gửi qua JSON."""
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        if isinstance(obj, dict):
-            return {k: self._serialize_for_json(v) for k, v in obj.items()}
-        if isinstance(obj, list):
-            return [self._serialize_for_json(v) for v in obj]
-        return obj
+        """Xóa một kết nối WebSocket (khi client đã đóng)."""
+        for connection in list(self.active_connections.get(user_id, ())):
+            if connection.websocket is websocket:
+                connection.stop()
+                self._remove(connection)
+
+    def _remove(self, connection: Connection):
+        """Gỡ kết nối khỏi danh sách (gọi được nhiều lần)."""
+        user_id = connection.user_id
+        connections = self.active_connections.get(user_id)
+        if not connections or connection not in connections:
+            return
+        connections.remove(connection)
+        if not connections:
+            del self.active_connections[user_id]
+            self.presence.on_disconnect(user_id)
+            asyncio.create_task(self._release(user_id))
+
+    async def _release(self, user_id: str):
+        # User có thể đã kết nối lại trong lúc chờ
+        if user_id not in self.active_connections:
+            await self.backplane.unsubscribe(user_id)
+
+    def _send_local(self, user_id: str, event: EncodedEvent, replayable: bool = False):
+        """
+        Đưa sự kiện đã mã hóa vào hàng đợi gửi của các kết nối của user trong process này.
+        Sự kiện cần phát lại được gán seq và lưu vào bộ đệm kể cả khi user đang offline;
+        khi chạy nhiều node chỉ gán seq cho user đang kết nối tại đây (không phát lại được).
+        """
+        connections = self.active_connections.get(user_id)
+        if replayable and (connections or not self.backplane.distributed):
+            event = self.replay.record(user_id, event)
+        for connection in list(connections or ()):
+            connection.enqueue(event)
+
+    def invalidate(self, kind: str, key: str):
+        """
+        Xóa một mục cache (principal, membership, ...) tại process này và phát tới các node khác.
+        Không cần await: gọi được từ hook đồng bộ của model.
+        """
+        key = str(key)
+        self._invalidators[kind](key)
+        if not self.backplane.distributed:
+            return
+        try:
+            task = asyncio.get_running_loop().create_task(self.backplane.publish_control(kind, key))
+        except RuntimeError:
+            return
+        self._control_tasks.add(task)
+        task.add_done_callback(self._control_tasks.discard)
+
+    async def invalidate_membership(self, conversation_id: str):
+        """Xóa danh sách thành viên đã cache của cuộc trò chuyện tại process này và mọi node khác."""
+        invalidate_membership(conversation_id)
+        await self.backplane.publish_control("membership", str(conversation_id))
+
+    async def _deliver_remote(self, user_id: str, text: str):
+        """Giao sự kiện nhận được từ node khác qua backplane."""
+        event = EncodedEvent(text=text)
+        self._send_local(user_id, event, replayable=is_replayable(event.data))
+
+    async def broadcast_to_users(self, user_ids: Iterable[str], data: Union[dict, EncodedEvent]):
+        """
+        Gửi cùng một sự kiện đến tất cả các kết nối của nhiều người dùng.
+        Sự kiện chỉ được mã hóa một lần cho mỗi định dạng (JSON, MessagePack), dùng chung
+        cho mọi socket; chuỗi JSON được publish qua backplane cho các worker/node khác.
+        Với nhóm người nhận lớn, dùng fanout.submit thay vì gọi trực tiếp.
+        """
+        # Loại bỏ trùng lặp, giữ nguyên thứ tự
+        user_ids = list(dict.fromkeys(str(uid) for uid in user_ids))
+        if not user_ids:
+            return
+
+        event = data if isinstance(data, EncodedEvent) else EncodedEvent(data)
+        replayable = is_replayable(event.data)
+        # Giao cục bộ trước (đồng bộ) để thứ tự sự kiện giữ đúng thứ tự gọi, kể cả khi publish phải chờ
+        for uid in user_ids:
+            self._send_local(uid, event, replayable)
+        await self.backplane.publish_many(user_ids, event.text)
+
+    async def broadcast_local(self, user_ids: Iterable[str], data: Union[dict, EncodedEvent]):
+        """Gửi sự kiện tạm thời tới các kết nối trong process này (mã hóa một lần), không qua backplane."""
+        event = data if isinstance(data, EncodedEvent) else EncodedEvent(data)
+        for uid in dict.fromkeys(str(uid) for uid in user_ids):
+            self._send_local(uid, event)
 
     async def broadcast_to_user(self, user_id: str, data: dict):
-        """Gửi một tin nhắn JSON đến tất cả các kết nối đang hoạt động của một người dùng."""
-        
-        if user_id in self.active_connections:
-            json_ready_data = self._serialize_for_json(data)
-            for connection in self.active_connections[user_id]:
-                await connection.send_json(json_ready_data)
+        """
+        Gửi một tin nhắn JSON đến tất cả các kết nối đang hoạt động của một người dùng,
+        kể cả các kết nối ở worker/node khác (publish một lần qua backplane).
+        """
+        await self.broadcast_to_users([user_id], data)
 
     
     def is_user_online(self, user_id: str) -> bool:
-        """Kiểm tra user có đang online (có WebSocket connection) không."""
+        """Kiểm tra user có đang online (có WebSocket connection tại process này) không."""
         return user_id in self.active_connections and len(self.active_connections[user_id]) > 0
     
+    def is_reachable(self, user_id: str) -> bool:
+        """User có thể nhận sự kiện: đang kết nối tại process này, hoặc có thể ở node khác qua backplane."""
+        return user_id in self.active_connections or self.backplane.distributed
+
     def get_offline_users(self, user_ids: List[str]) -> List[str]:
         """Lấy danh sách users đang offline từ danh sách user IDs."""
         return [uid for uid in user_ids if not self.is_user_online(uid)]
 
+    def stats(self) -> dict:
+        """Thống kê tổng hợp của process (không chứa ID người dùng)."""
+        connections = list(self.iter_connections())
+        depths = [c.queue.qsize() for c in connections]
+        return {
+            "users": len(self.active_connections),
+            "connections": len(connections),
+            "queued": sum(depths),
+            "dropped": sum(c.dropped for c in connections),
+            "maxQueueDepth": max((c.max_depth for c in connections), default=0),
+            "queueDepthHistogram": queue_depth_histogram(depths),
+            "heartbeat": self.heartbeat.stats(),
+            "presence": self.presence.stats(),
+            "activity": self.activity.stats(),
+            "replay": self.replay.stats(),
+            "fanout": self.fanout.stats(),
+            "backplane": self.backplane.stats(),
+        }
+
 # Tạo một instance duy nhất dùng toàn app
 manager = ConnectionManager()
 
 @router.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket, user: User = Depends(get_current_user_ws)):
+async def websocket_endpoint(websocket: WebSocket, user: UserPrincipal = Depends(get_current_user_ws)):
     user_id = str(user.id)
-    await manager.connect(user_id, websocket)
+    # Kết nối lại: ?since=<seq cuối đã nhận>&epoch=<epoch trong frame hello>
+    since = websocket.query_params.get("since")
+    since = int(since) if since and since.isdigit() else None
+    # Client hỗ trợ heartbeat JSON đăng ký bằng ?heartbeat=1
+    heartbeat = websocket.query_params.get("heartbeat") in ("1", "true")
+    connection = await manager.connect(user_id, websocket, since, websocket.query_params.get("epoch"), heartbeat)
+    commands = CommandQueue(connection)
     try:
         while True:
-            # Chờ tin nhắn từ client
-            data = await websocket.receive_text()
-            # Handle incoming messages if needed in the future
+            # Chờ frame từ client (text JSON hoặc nhị phân MessagePack)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            # Mọi frame từ client đều chứng tỏ kết nối còn sống
+            connection.touch()
+            try:
+                if message.get("bytes") is not None:
+                    if not msgpack_available():
+                        continue
+                    event = decode_event_msgpack(message["bytes"])
+                else:
+                    event = decode_event(message.get("text") or "")
+            except ValueError:
+                continue
+            # Client chủ động ping thì trả pong
+            if isinstance(event, dict) and event.get("type") == "ping":
+                connection.enqueue(EncodedEvent({"type": "pong", "ts": event.get("ts")}))
+                continue
+            # Lệnh chat (send_message, mark_seen, recall, typing) chạy trên socket đã xác thực,
+            # xử lý ngoài vòng đọc để lệnh chậm không chặn frame tiếp theo
+            commands.submit(event)
     except WebSocketDisconnect:
         pass
     finally:
+        commands.stop()
         manager.disconnect(user_id, websocket)